@@ -0,0 +1,61 @@
+import os
+import configparser
+import argparse
+from my_utils.strategies import STRATEGIES
+from my_utils.trainer import Trainer, log_to_stdout
+from my_utils.backend import resolve_device
+
+
+def get_parser(method=None):
+    parser = argparse.ArgumentParser(description='Read configuration file.')
+    parser.add_argument('--method', default=method, required=method is None, choices=sorted(STRATEGIES), help='training method')
+    parser.add_argument('--config', default='config_PhysioNetMIToMengExp12.ini', help='Path to the config.ini file')
+    parser.add_argument('--device', default=None, help='cuda, cuda:<id> or cpu (default: cuda if available, else cpu)')
+    parser.add_argument('--cpu_threads', default=None, help='with --device cpu, intra-op threads of torch (default: the available cores minus the DataLoader workers)')
+    parser.add_argument('--parallel_folds', default='1', help='number of folds trained at the same time, each in its own process with its share of the CPU cores (and of the GPUs)')
+    parser.add_argument('--channels_last', default='0', help='if 1, keep the 2d convolution weights in channels_last (NHWC) memory format, faster with oneDNN on the CPU (see my_utils/backend.py)')
+    parser.add_argument('--cache_prefix', default='parser_test2', help='prefix of the cache (IMPORTANT!)')
+    parser.add_argument('--prior_information', default='1', help='if the prior_information is used')
+    parser.add_argument('--backbone_type', default=None, help='choose the backbone type for feature extractor: EEGNet,ShallowConvNet,DeepConvNet,InceptionEEG,EEGSym (default: the one of the method)')
+    parser.add_argument('--in_memory', default='0', help='if 1, load each train split once onto the training device and batch it there without DataLoader workers')
+    parser.add_argument('--mmap', default='0', help='if 1, open the fold files memory-mapped: the trials are read from the page cache, shared by the DataLoader workers, the folds and the concurrent jobs, instead of being copied into the memory of each process')
+    parser.add_argument('--trial_store', default='0', help='if 1, read the folds from the deduplicated trial store, memory-mapped (see my_utils/trial_store.py)')
+    parser.add_argument('--sharded', default='0', help='if 1, stream the folds from shard directories (see my_utils/sharded_dataset.py)')
+    parser.add_argument('--storage_dtype', default='float64', help='float64 (files as they are), float32 or float16: read compact copies of the fold files (see my_utils/storage_dtype.py)')
+    parser.add_argument('--random_crop', default='none', help='none, trial or batch: draw a random datalen window inside each stored training trial, per trial or per batch')
+    parser.add_argument('--eval_crops', default='1', help='number of evenly spaced windows whose logits are averaged in evaluation')
+    parser.add_argument('--async_eval', default='0', help='if 1, validate a snapshot of the model on a background thread while the next epoch trains (see my_utils/snapshot_evaluation.py)')
+    parser.add_argument('--projection_cache', default='0', help='if 1, apply the fixed channel projections to the fold files once and cache them (see my_utils/projection_cache.py)')
+    parser.add_argument('--drop_last', default='0', help='if 1, drop the last partial batch of each domain so that every step sees full batches')
+    parser.add_argument('--cycle_shorter', default='0', help='if 1, an epoch runs over the longer domain and the shorter one is restarted when it runs out')
+    parser.add_argument('--precision', default='fp32', help='fp32, bf16 or fp16: autocast the training forwards, with the covariance/FFT losses in fp32 and the fp16 losses scaled (see my_utils/amp.py)')
+    parser.add_argument('--compile', default='0', help='if 1, torch.compile the submodules of the model and the alignment losses (see my_utils/compilation.py)')
+    parser.add_argument('--fused_forward', default='0', help='if 1, the paired methods run the backbone and heads once on the concatenated source and target batches (see my_utils/domain_batch.py)')
+    parser.add_argument('--domain_bn', default='1', help='with --fused_forward, if 1 the BatchNorm layers normalize each domain with its own batch statistics, if 0 with those of both domains')
+    parser.add_argument('--mgda_upper_bound', default='0', help='if 1, Infinity004 takes the MGDA weights of the feature extractor objectives from the gradients of the features (MGDA-UB) and backpropagates the backbone once')
+    return parser
+
+
+def main(method=None, argv=None):
+    '''
+    Cross-validate one method. The EEG_<method>_anybackbone.py scripts call main(method=<method>).
+
+    :param argv: the command line arguments, sys.argv[1:] if None
+    '''
+    args = get_parser(method).parse_args(argv)
+    log_to_stdout()
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join("hyperparameters", args.config))
+
+    device = resolve_device(args.device)
+    strategy = STRATEGIES[args.method](config, device=device)
+    if args.mgda_upper_bound == '1':
+        if not hasattr(strategy, 'upper_bound'):
+            raise ValueError("{0} does not use MGDA, --mgda_upper_bound is for Infinity004".format(args.method))
+        strategy.upper_bound = True
+    return Trainer(strategy, config, args, device=device).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,7 @@ from functools import reduce
 from pyriemann.utils.mean import mean_covariance
 
 class EuclideanMeanCovariance(object):
-    def __init__(self, training_data, precision='float64', is_cuda=False):
+    def __init__(self, training_data, precision='float64', is_cuda=False, device=None):
         '''
         Initialize the EuclideanMeanCovariance class.
 
@@ -12,6 +12,7 @@ class EuclideanMeanCovariance(object):
             training_data (numpy.ndarray or torch.tensor): Training data with shape (num_samples, num_channels, num_sampling_points).
             precision (str): Data precision type, either 'float32' or 'float64'. Defaults to 'float64'.
             is_cuda (bool): Whether to use CUDA for computations. Defaults to False.
+            device (str or torch.device): Device of the computations, overrides is_cuda. Defaults to None.
 
         Raises:
             ValueError: If the precision argument is not 'float32' or 'float64'.
@@ -38,8 +39,9 @@ class EuclideanMeanCovariance(object):
         self.re = torch.tensor(np.dot(Q, np.dot(ss, np.linalg.inv(Q))), dtype=getattr(torch, precision))
         self.num_channels = training_data.shape[1]
 
-        if is_cuda:
-            self.re = self.re.cuda()
+        if device is None:
+            device = 'cuda' if is_cuda else 'cpu'
+        self.re = self.re.to(device)
 
     def transform(self, data):
         '''
@@ -57,9 +59,11 @@ class EuclideanMeanCovariance(object):
         '''
         if isinstance(data, np.ndarray):
             data = torch.tensor(data, dtype=self.re.dtype)
+        else:
+            # batches may come in a compact storage dtype (float32/float16)
+            data = data.to(self.re.dtype)
 
-        if self.re.is_cuda:
-            data = data.cuda()
+        data = data.to(self.re.device)
         if len(data.shape) == 2:
             return torch.matmul(self.re, data)
         elif len(data.shape) == 3:
@@ -71,7 +75,7 @@ class EuclideanMeanCovariance(object):
             raise ValueError("Unsupported data shape.")
 
 class RiemannMeanCovariance(object):
-    def __init__(self, training_data, precision='float64', is_cuda=False, metric='riemann'):
+    def __init__(self, training_data, precision='float64', is_cuda=False, metric='riemann', device=None):
         '''
         Initialize the RiemannMeanCovariance class.
 
@@ -80,6 +84,7 @@ class RiemannMeanCovariance(object):
             precision (str): Data precision type, either 'float32' or 'float64'. Defaults to 'float64'.
             is_cuda (bool): Whether to use CUDA for computations. Defaults to False.
             metric (str): The metric for mean covariance. Defaults to 'riemann'.
+            device (str or torch.device): Device of the computations, overrides is_cuda. Defaults to None.
 
         Raises:
             ValueError: If the precision argument is not 'float32' or 'float64'.
@@ -104,8 +109,9 @@ class RiemannMeanCovariance(object):
         self.num_channels = training_data.shape[1]
         self.re = torch.tensor(self.riemann_mean, dtype=getattr(torch, precision))
 
-        if is_cuda:
-            self.re = self.re.cuda()
+        if device is None:
+            device = 'cuda' if is_cuda else 'cpu'
+        self.re = self.re.to(device)
 
     def transform(self, data):
         '''
@@ -123,9 +129,11 @@ class RiemannMeanCovariance(object):
         '''
         if isinstance(data, np.ndarray):
             data = torch.tensor(data, dtype=self.re.dtype)
+        else:
+            # batches may come in a compact storage dtype (float32/float16)
+            data = data.to(self.re.dtype)
 
-        if self.re.is_cuda:
-            data = data.cuda()
+        data = data.to(self.re.device)
         if len(data.shape) == 2:
             return torch.matmul(self.re, data)
         elif len(data.shape) == 3:
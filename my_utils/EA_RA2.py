@@ -4,7 +4,7 @@ from pyriemann.utils.mean import mean_covariance
 
 
 class RiemannMeanCovariance(object):
-    def __init__(self, training_data, precision='float64', is_cuda=False, metric='riemann'):
+    def __init__(self, training_data, precision='float64', is_cuda=False, metric='riemann', device=None):
         '''
         Initialize the RiemannMeanCovariance class.
 
@@ -13,6 +13,7 @@ class RiemannMeanCovariance(object):
             precision (str): Data precision type, either 'float32' or 'float64'. Defaults to 'float64'.
             is_cuda (bool): Whether to use CUDA for computations. Defaults to False.
             metric (str): The metric for mean covariance. Defaults to 'riemann'.
+            device (str or torch.device): Device of the computations, overrides is_cuda. Defaults to None.
 
         Raises:
             ValueError: If the precision argument is not 'float32' or 'float64'.
@@ -37,8 +38,9 @@ class RiemannMeanCovariance(object):
         self.num_channels = training_data.shape[1]
         self.re = torch.tensor(self.riemann_mean, dtype=getattr(torch, precision))
 
-        if is_cuda:
-            self.re = self.re.cuda()
+        if device is None:
+            device = 'cuda' if is_cuda else 'cpu'
+        self.re = self.re.to(device)
 
     def transform(self, data):
         '''
@@ -57,8 +59,7 @@ class RiemannMeanCovariance(object):
         if isinstance(data, np.ndarray):
             data = torch.tensor(data, dtype=self.re.dtype)
 
-        if self.re.is_cuda:
-            data = data.cuda()
+        data = data.to(self.re.device)
         if len(data.shape) == 2:
             return torch.matmul(self.re, data)
         elif len(data.shape) == 3:
@@ -1,11 +1,19 @@
-import numpy as np
+import warnings
 import torch
 
 
 class MinNormSolver:
+    """
+    Min-norm element of the convex hull of a few gradients (MGDA).
+
+    The gradients are flattened into one (n, D) matrix and all of their inner products are taken by a single
+    matmul on their device; only the (n, n) Gram matrix is moved to the CPU, so a call synchronizes once. The
+    iterations then run on that small float64 tensor. n=2 and n=3 are solved in closed form.
+    """
     def __init__(self):
         self.MAX_ITER = 250
         self.STOP_CRIT = 1e-5
+
     def _min_norm_element_from2(self, v1v1, v1v2, v2v2):
         """
         Analytical solution for min_{c} |cx_1 + (1-c)x_2|_2^2
@@ -29,69 +37,79 @@ class MinNormSolver:
         cost = v2v2 + gamma * (v1v2 - v2v2)
         return gamma, cost
 
-    def __convert_to_numpy__(self, __change__):
-        # Check if the type of 'change' is a torch.Tensor
-        if isinstance(__change__, torch.Tensor):
-            # Convert torch.Tensor to numpy.ndarray
-            return __change__.numpy()
-        # If 'change' is already a numpy.ndarray or any other type, return it as is
-        return __change__
-
-    def _min_norm_2d(self, vecs, dps):
+    def gram_matrix(self, vecs):
+        """
+        <x_i, x_j> of the gradients, vecs[i] being the list of the gradient tensors of task i, as a float64 CPU tensor
+        """
+        with torch.no_grad():
+            flat = torch.stack([torch.cat([torch.as_tensor(v).reshape(-1) for v in vec]) for vec in vecs])
+            if flat.dtype in (torch.float16, torch.bfloat16):
+                # gradients of autocast activations (MGDA-UB)
+                flat = flat.float()
+            return torch.matmul(flat, flat.t()).to(device='cpu', dtype=torch.float64)
+
+    def _min_norm_2d(self, grad_mat):
         """
         Find the minimum norm solution as combination of two points
         This is correct only in 2D
         ie. min_c |\sum c_i x_i|_2^2 st. \sum c_i = 1 , 1 >= c_1 >= 0 for all i, c_i + c_j = 1.0 for some i, j
         """
-        dmin = 1e8
-        for i in range(len(vecs)):
-            for j in range(i + 1, len(vecs)):
-                if (i, j) not in dps:
-                    dps[(i, j)] = 0.0
-                    for k in range(len(vecs[i])):
-                        dps[(i, j)] += torch.mul(vecs[i][k], vecs[j][k]).sum().data.cpu()
-                    dps[(j, i)] = dps[(i, j)]
-                if (i, i) not in dps:
-                    dps[(i, i)] = 0.0
-                    for k in range(len(vecs[i])):
-                        dps[(i, i)] += torch.mul(vecs[i][k], vecs[i][k]).sum().data.cpu()
-                if (j, j) not in dps:
-                    dps[(j, j)] = 0.0
-                    for k in range(len(vecs[i])):
-                        dps[(j, j)] += torch.mul(vecs[j][k], vecs[j][k]).sum().data.cpu()
-                c, d = self._min_norm_element_from2(dps[(i, i)], dps[(i, j)], dps[(j, j)])
+        dmin = float('inf')
+        sol = [(0, 1), 0.5, float('nan')]
+        gram = grad_mat.tolist()
+        for i in range(len(gram)):
+            for j in range(i + 1, len(gram)):
+                c, d = self._min_norm_element_from2(gram[i][i], gram[i][j], gram[j][j])
                 if d < dmin:
                     dmin = d
                     sol = [(i, j), c, d]
-        return sol, dps
+        return sol
+
+    def _init_solution(self, grad_mat):
+        init_sol = self._min_norm_2d(grad_mat)
+        sol_vec = torch.zeros(grad_mat.shape[0], dtype=torch.float64)
+        sol_vec[init_sol[0][0]] = init_sol[1]
+        sol_vec[init_sol[0][1]] = 1 - init_sol[1]
+        return sol_vec, init_sol[2]
+
+    def _min_norm_3d(self, grad_mat, sol_vec, cost):
+        """
+        For n=3 the minimum is either inside the triangle, where it solves the KKT system
+        [[G, 1], [1^T, 0]] [c, -lambda] = [0, 1], or on its best edge (sol_vec, cost).
+        """
+        kkt = torch.ones(4, 4, dtype=torch.float64)
+        kkt[:3, :3] = grad_mat
+        kkt[3, 3] = 0
+        rhs = torch.tensor([0.0, 0.0, 0.0, 1.0], dtype=torch.float64)
+        inner, info = torch.linalg.solve_ex(kkt, rhs)
+        inner = inner[:3]
+        if info == 0 and torch.isfinite(inner).all() and (inner >= 0).all():
+            inner_cost = float(inner @ grad_mat @ inner)
+            if inner_cost < cost:
+                return inner, inner_cost
+        return sol_vec, cost
 
     def _projection2simplex(self, y):
         """
         Given y, it solves argmin_z |y-z|_2 st \sum z = 1 , 1 >= z_i >= 0 for all i
         """
         m = len(y)
-        sorted_y = np.flip(np.sort(y), axis=0)
-        tmpsum = 0.0
-        tmax_f = (np.sum(y) - 1.0) / m
-        for i in range(m - 1):
-            tmpsum += sorted_y[i]
-            tmax = (tmpsum - 1) / (i + 1.0)
-            if tmax > sorted_y[i + 1]:
-                tmax_f = tmax
-                break
-        return np.maximum(y - tmax_f, np.zeros(y.shape))
+        sorted_y = torch.sort(y, descending=True)[0]
+        tmax = (torch.cumsum(sorted_y, dim=0)[:-1] - 1) / torch.arange(1, m, dtype=y.dtype)
+        crossed = torch.nonzero(tmax > sorted_y[1:])
+        tmax_f = tmax[crossed[0, 0]] if len(crossed) > 0 else (torch.sum(y) - 1.0) / m
+        return torch.clamp(y - tmax_f, min=0)
 
     def _next_point(self, cur_val, grad, n):
-        proj_grad = grad - (np.sum(grad) / n)
+        proj_grad = grad - (torch.sum(grad) / n)
         tm1 = -1.0 * cur_val[proj_grad < 0] / proj_grad[proj_grad < 0]
         tm2 = (1.0 - cur_val[proj_grad > 0]) / (proj_grad[proj_grad > 0])
 
-        skippers = np.sum(tm1 < 1e-7) + np.sum(tm2 < 1e-7)
         t = 1
         if len(tm1[tm1 > 1e-7]) > 0:
-            t = np.min(tm1[tm1 > 1e-7])
+            t = tm1[tm1 > 1e-7].min()
         if len(tm2[tm2 > 1e-7]) > 0:
-            t = min(t, np.min(tm2[tm2 > 1e-7]))
+            t = min(t, tm2[tm2 > 1e-7].min())
 
         next_point = proj_grad * t + cur_val
         next_point = self._projection2simplex(next_point)
@@ -103,52 +121,49 @@ class MinNormSolver:
         as min |u|_2 st. u = \sum c_i vecs[i] and \sum c_i = 1.
         It is quite geometric, and the main idea is the fact that if d_{ij} = min |u|_2 st u = c x_i + (1-c) x_j; the solution lies in (0, d_{i,j})
         Hence, we find the best 2-task solution, and then run the projected gradient descent until convergence
+
+        :return: the weights c (float64 CPU tensor) and the squared norm of the min-norm element
         """
-        # Solution lying at the combination of two points
-        dps = {}
-        init_sol, dps = self._min_norm_2d(vecs, dps)
+        return self.find_min_norm_element_from_gram(self.gram_matrix(vecs))
 
-        n = len(vecs)
-        sol_vec = np.zeros(n)
-        sol_vec[init_sol[0][0]] = init_sol[1]
-        sol_vec[init_sol[0][1]] = 1 - init_sol[1]
+    def find_min_norm_element_from_gram(self, grad_mat):
+        """
+        find_min_norm_element given the (n, n) Gram matrix <x_i, x_j> of the vectors as a float64 CPU tensor
+        """
+        n = grad_mat.shape[0]
+        if not torch.isfinite(grad_mat).all():
+            # overflowed gradients (a loss-scaled fp16 step that the GradScaler skips): no meaningful solution
+            return torch.full((n,), 1.0 / n, dtype=torch.float64), float('nan')
+        # Solution lying at the combination of two points
+        sol_vec, cost = self._init_solution(grad_mat)
 
         if n < 3:
             # This is optimal for n=2, so return the solution
-            return sol_vec, init_sol[2]
+            return sol_vec, cost
+        if n == 3:
+            return self._min_norm_3d(grad_mat, sol_vec, cost)
 
         iter_count = 0
-
-        grad_mat = np.zeros((n, n))
-        for i in range(n):
-            for j in range(n):
-                grad_mat[i, j] = dps[(i, j)]
-
+        nd = cost
         while iter_count < self.MAX_ITER:
-            grad_dir = -1.0 * np.dot(grad_mat, sol_vec)
-
+            iter_count += 1
+            grad_dir = -1.0 * torch.mv(grad_mat, sol_vec)
 
             new_point = self._next_point(sol_vec, grad_dir, n)
 
             # Re-compute the inner products for line search
-            v1v1 = 0.0
-            v1v2 = 0.0
-            v2v2 = 0.0
-            for i in range(n):
-                for j in range(n):
-                    v1v1 += sol_vec[i] * sol_vec[j] * dps[(i, j)]
-                    v1v2 += sol_vec[i] * new_point[j] * dps[(i, j)]
-                    v2v2 += new_point[i] * new_point[j] * dps[(i, j)]
+            v1v1 = float(sol_vec @ grad_mat @ sol_vec)
+            v1v2 = float(sol_vec @ grad_mat @ new_point)
+            v2v2 = float(new_point @ grad_mat @ new_point)
 
             nc, nd = self._min_norm_element_from2(v1v1, v1v2, v2v2)
             new_sol_vec = nc * sol_vec + (1 - nc) * new_point
 
             change = new_sol_vec - sol_vec
-            change = self.__convert_to_numpy__(change)
-            if np.sum(np.abs(change)) < self.STOP_CRIT:
+            if torch.sum(torch.abs(change)) < self.STOP_CRIT:
                 return sol_vec, nd
             sol_vec = new_sol_vec
-            sol_vec = self.__convert_to_numpy__(sol_vec)
+        return sol_vec, nd
 
     def find_min_norm_element_FW(self, vecs):
         """
@@ -157,54 +172,55 @@ class MinNormSolver:
         It is quite geometric, and the main idea is the fact that if d_{ij} = min |u|_2 st u = c x_i + (1-c) x_j; the solution lies in (0, d_{i,j})
         Hence, we find the best 2-task solution, and then run the Frank Wolfe until convergence
         """
+        grad_mat = self.gram_matrix(vecs)
         # Solution lying at the combination of two points
-        dps = {}
-        init_sol, dps = self._min_norm_2d(vecs, dps)
+        sol_vec, cost = self._init_solution(grad_mat)
 
         n = len(vecs)
-        sol_vec = np.zeros(n)
-        sol_vec[init_sol[0][0]] = init_sol[1]
-        sol_vec[init_sol[0][1]] = 1 - init_sol[1]
-
         if n < 3:
             # This is optimal for n=2, so return the solution
-            return sol_vec, init_sol[2]
+            return sol_vec, cost
+        if n == 3:
+            return self._min_norm_3d(grad_mat, sol_vec, cost)
 
         iter_count = 0
-
-        grad_mat = np.zeros((n, n))
-        for i in range(n):
-            for j in range(n):
-                grad_mat[i, j] = dps[(i, j)]
-
+        nd = cost
         while iter_count < self.MAX_ITER:
-            t_iter = np.argmin(np.dot(grad_mat, sol_vec))
+            iter_count += 1
+            grad_sol = torch.mv(grad_mat, sol_vec)
+            t_iter = int(torch.argmin(grad_sol))
 
-            v1v1 = np.dot(sol_vec, np.dot(grad_mat, sol_vec))
-            v1v2 = np.dot(sol_vec, grad_mat[:, t_iter])
-            v2v2 = grad_mat[t_iter, t_iter]
+            v1v1 = float(sol_vec @ grad_sol)
+            v1v2 = float(grad_sol[t_iter])
+            v2v2 = float(grad_mat[t_iter, t_iter])
 
             nc, nd = self._min_norm_element_from2(v1v1, v1v2, v2v2)
             new_sol_vec = nc * sol_vec
             new_sol_vec[t_iter] += 1 - nc
 
             change = new_sol_vec - sol_vec
-            if np.sum(np.abs(change)) < self.STOP_CRIT:
+            if torch.sum(torch.abs(change)) < self.STOP_CRIT:
                 return sol_vec, nd
             sol_vec = new_sol_vec
+        return sol_vec, nd
+
+
+def _grad_norm(grads):
+    # stays on the device of the gradients: no synchronization per tensor
+    return torch.sqrt(sum(gr.detach().float().pow(2).sum() for gr in grads))
 
 
 def gradient_normalizers(grads, losses, normalization_type):
     gn = {}
     if normalization_type == 'l2':
         for t in grads:
-            gn[t] = np.sqrt(np.sum([gr.pow(2).sum().data.cpu() for gr in grads[t]]))
+            gn[t] = _grad_norm(grads[t])
     elif normalization_type == 'loss':
         for t in grads:
             gn[t] = losses[t]
     elif normalization_type == 'loss+':
         for t in grads:
-            gn[t] = losses[t] * np.sqrt(np.sum([gr.pow(2).sum().data.cpu() for gr in grads[t]]))
+            gn[t] = losses[t] * _grad_norm(grads[t])
     elif normalization_type == 'none':
         for t in grads:
             gn[t] = 1.0
@@ -213,4 +229,156 @@ def gradient_normalizers(grads, losses, normalization_type):
     return gn
 
 
+def gram_normalizers(gram, losses, normalization_type):
+    '''
+    gradient_normalizers of the gradients whose Gram matrix is gram: their norms are the square roots of its diagonal.
 
+    :param losses: tensor of the losses, in the order of the gram rows
+    :return: tensor of the normalizers
+    '''
+    if normalization_type == 'l2':
+        return torch.sqrt(torch.diagonal(gram))
+    if normalization_type == 'loss':
+        return losses
+    if normalization_type == 'loss+':
+        return losses * torch.sqrt(torch.diagonal(gram))
+    if normalization_type == 'none':
+        return torch.ones_like(losses)
+    raise ValueError('Invalid Normalization Type: %s' % normalization_type)
+
+
+class GradientGroup(object):
+    '''
+    Flat .grad storage of a parameter group, for MGDA over the gradients of several objectives.
+
+    The .grad of every parameter of the group is a view into the flat buffer `grad`, allocated once. The gradients
+    of the objectives are used where autograd left them: the Gram matrix is accumulated from dot products of the
+    per-parameter gradients and the combination sum_k sol[k] * g_k is written in place into `grad`. The gradients
+    themselves are still new tensors from autograd at every step.
+    '''
+    def __init__(self, params):
+        self.params = list(params)
+        numels = [param.numel() for param in self.params]
+        self.grad = torch.zeros(sum(numels), dtype=self.params[0].dtype, device=self.params[0].device)
+        self.grad_views = [grad.view_as(param) for grad, param in zip(self.grad.split(numels), self.params)]
+
+    def holds(self, params):
+        return len(params) == len(self.params) and all(a is b for a, b in zip(params, self.params))
+
+    @staticmethod
+    def gram_matrix(grads):
+        '''
+        :param grads: for each objective, its gradients, one per parameter of the group
+        :return: the Gram matrix of the objective gradients, on their device
+        '''
+        n = len(grads)
+        flat = [[grad.reshape(-1) for grad in gradients] for gradients in grads]
+        dots = {}
+        for a in range(n):
+            for b in range(a, n):
+                dots[a, b] = sum(torch.dot(x, y) for x, y in zip(flat[a], flat[b]))
+        return torch.stack([dots[min(a, b), max(a, b)] for a in range(n) for b in range(n)]).view(n, n)
+
+    def min_norm_weights(self, solver, grads, losses, normalization_type='loss+'):
+        '''
+        min_norm_weights of the gradients; the Gram matrix and the losses reach the CPU in one transfer.
+
+        :param grads: for each objective, its gradients, one per parameter of the group
+        :param losses: the losses of the objectives, in the order of grads
+        '''
+        n = len(grads)
+        with torch.no_grad():
+            packed = torch.cat([self.gram_matrix(grads).reshape(-1),
+                                torch.stack([loss.detach() for loss in losses]).to(self.grad.dtype)])
+            packed = packed.to(device='cpu', dtype=torch.float64)
+        gram, losses = packed[:n * n].view(n, n), packed[n * n:]
+        gn = gram_normalizers(gram, losses, normalization_type)
+        return solver.find_min_norm_element_from_gram(gram / torch.outer(gn, gn))
+
+    def combine(self, sol, grads):
+        '''
+        Set the .grad of the parameters to sum_k sol[k] * grads[k].
+        '''
+        weights = sol.tolist()
+        with torch.no_grad():
+            for j, out in enumerate(self.grad_views):
+                torch.mul(grads[0][j], weights[0], out=out)
+                for k in range(1, len(grads)):
+                    out.add_(grads[k][j], alpha=weights[k])
+        for param, grad in zip(self.params, self.grad_views):
+            param.grad = grad
+
+
+def multi_objective_gradients(losses, params, batched=True, retain_graph=False):
+    '''
+    Gradients of each of several scalar losses w.r.t. params, without touching the .grad of the params.
+
+    With batched=True the losses are stacked and their vector-Jacobian products with the rows of the identity
+    are vmapped (torch.autograd.grad with is_grads_batched), so the graph is traversed once for all of them.
+    With batched=False the losses are differentiated one after the other and the graph is kept until the last.
+
+    :param losses: list of n scalar tensors
+    :param params: list of tensors that require grad
+    :param retain_graph: keep the graph after the call
+    :return: list with, for each loss, the list of its gradients w.r.t. params; a gradient is zero where the
+             param does not depend on that loss, and None where the param depends on none of the losses
+    '''
+    if batched:
+        outputs = torch.stack(losses)
+        grad_outputs = torch.eye(len(losses), dtype=outputs.dtype, device=outputs.device)
+        stacked = torch.autograd.grad(outputs, params, grad_outputs=grad_outputs, retain_graph=retain_graph,
+                                      is_grads_batched=True, allow_unused=True)
+        return [[None if grad is None else grad[i] for grad in stacked] for i in range(len(losses))]
+
+    grads = []
+    for i, loss in enumerate(losses):
+        grads.append(list(torch.autograd.grad(loss, params, retain_graph=retain_graph or i < len(losses) - 1,
+                                              allow_unused=True)))
+    for j, param in enumerate(params):
+        if any(grad[j] is not None for grad in grads):
+            for grad in grads:
+                if grad[j] is None:
+                    grad[j] = torch.zeros_like(param)
+    return grads
+
+
+class MultiObjectiveGradients(object):
+    '''
+    multi_objective_gradients that falls back to one backward per loss if the graph cannot be vmapped.
+
+    The batched pass needs a batching rule for the backward of every op of the model. The first call tries it
+    with the graph retained, so that the per-loss pass can still run on the same graph if it fails, and the
+    outcome is kept for the following calls.
+    '''
+    def __init__(self, batched=None):
+        self.batched = batched
+
+    def __call__(self, losses, params, retain_graph=False):
+        if self.batched is None:
+            try:
+                grads = multi_objective_gradients(losses, params, batched=True, retain_graph=True)
+                self.batched = True
+                return grads
+            except RuntimeError as e:
+                warnings.warn("batched gradients are not supported by this model, computing them loss by loss: %s" % e)
+                self.batched = False
+        return multi_objective_gradients(losses, params, batched=self.batched, retain_graph=retain_graph)
+
+
+def min_norm_weights(solver, grads, losses, normalization_type='loss+'):
+    '''
+    MGDA weights of the objectives: the min-norm element of the convex hull of their normalized gradients.
+
+    The gradients may be those of the shared parameters, or, for the MGDA-UB approximation of Sener & Koltun
+    (2018), those of the shared representation (the output of the shared encoder), which only needs a backward
+    pass through the task heads. With 'loss+' the gradients are normalized by loss * gradient norm; the weights
+    apply to the raw gradients.
+
+    :param solver: MinNormSolver
+    :param grads: dict objective -> list of gradient tensors
+    :param losses: dict objective -> loss, for the 'loss' and 'loss+' normalizations
+    :return: the weights in the order of grads (tensor), and the squared min norm
+    '''
+    gn = gradient_normalizers(grads, losses, normalization_type)
+    normalized = [[gr / gn[t] for gr in grads[t]] for t in grads]
+    return solver.find_min_norm_element(normalized)
@@ -0,0 +1,93 @@
+import functools
+import torch
+
+'''
+Mixed precision for the training steps of the strategies.
+
+A Strategy runs its own backward passes, and the Infinity strategies take and combine the gradients of several
+losses themselves (MGDA), so the usual `scaler.scale(loss).backward(); scaler.step(optimizer)` is spread over
+the step: MixedPrecision.autocast() covers the forwards, the strategy passes every loss it differentiates
+through MixedPrecision.scale(), and the Trainer calls MixedPrecision.step(optimizer) instead of
+optimizer.step().
+
+    precision = MixedPrecision('bf16', device='cpu')
+    with precision.autocast():
+        loss = ...
+    precision.scale(loss).backward()
+    precision.step(optimizer)
+
+bf16 needs no loss scaling and also runs on the CPU. fp16 scales the losses with a GradScaler: all the
+gradients then carry the same factor, which does not change the MGDA weights (the 'loss+' normalization
+divides it out), and the .grad of the parameters stay scaled until step() unscales them, skipping the update
+if they overflowed. Code that needs the true gradient values inside the step (the clipping of a Wasserstein
+critic) calls unscale_() first.
+
+The covariance, FFT and distance losses are evaluated in float32 (see float32()).
+'''
+
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def float32(function):
+    '''
+    Run function outside autocast, with its floating point tensor arguments in float32.
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        tensors = [arg for arg in args if torch.is_tensor(arg)]
+        device_type = tensors[0].device.type if tensors else 'cpu'
+        args = [arg.float() if torch.is_tensor(arg) and arg.is_floating_point() else arg for arg in args]
+        with torch.autocast(device_type, enabled=False):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def grad_scaler(device_type):
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device_type)
+    return torch.cuda.amp.GradScaler()
+
+
+class MixedPrecision(object):
+    '''
+    :param precision: fp32 (no autocast), bf16 or fp16
+    :param device: the training device
+    '''
+    def __init__(self, precision='fp32', device='cuda'):
+        if precision not in PRECISIONS:
+            raise ValueError("precision must be one of {0}, not {1}".format(sorted(PRECISIONS), precision))
+        self.precision = precision
+        self.device_type = torch.device(device).type
+        self.dtype = PRECISIONS[precision]
+        self.scaler = grad_scaler(self.device_type) if self.dtype is torch.float16 else None
+        self.optimizer = None
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.dtype is not None)
+
+    def scale(self, loss):
+        return loss if self.scaler is None else self.scaler.scale(loss)
+
+    def unscale_(self):
+        '''
+        Unscale the gradients of the optimizer given to the last step() before they are read; once per step.
+        '''
+        if self.scaler is not None:
+            self.scaler.unscale_(self.optimizer)
+
+    def unscaled(self, grad):
+        '''
+        The value of a (still scaled) gradient, for logging.
+        '''
+        return grad if self.scaler is None else grad / self.scaler.get_scale()
+
+    def bind(self, optimizer):
+        self.optimizer = optimizer
+
+    def step(self, optimizer):
+        if self.scaler is None:
+            optimizer.step()
+        else:
+            self.scaler.step(optimizer)
+            self.scaler.update()
+
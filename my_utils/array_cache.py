@@ -0,0 +1,65 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+'''
+Process-wide cache of the npy files (fold arrays, transfer matrices, electrode indices), keyed by path.
+
+Off by default. The in-process job runner (see job_runner.py) enables it, so that the jobs of a grid that read
+the same files -- every backbone of a task reads the same folds -- load them once. An entry is only used while
+the file keeps the size and modification time it was read with, and the least recently used entries are dropped
+once the cached arrays take more than max_gb.
+
+The cached arrays are shared by every reader: they must not be written to.
+'''
+
+_lock = threading.Lock()
+_cache = OrderedDict()
+_settings = {'enabled': False, 'max_bytes': None}
+
+
+def enable(max_gb=None):
+    '''
+    :param max_gb: largest total size of the cached arrays in GB, None for no limit
+    '''
+    _settings['enabled'] = True
+    _settings['max_bytes'] = None if max_gb is None else int(max_gb * 1024 ** 3)
+
+
+def disable():
+    _settings['enabled'] = False
+    clear()
+
+
+def clear():
+    with _lock:
+        _cache.clear()
+
+
+def cached_bytes():
+    with _lock:
+        return sum(array.nbytes for array in _cache.values() if not isinstance(array, np.memmap))
+
+
+def load(path, mmap_mode=None):
+    '''
+    np.load of an npy file, from the cache if it is enabled.
+    '''
+    if not _settings['enabled']:
+        return np.load(path, mmap_mode=mmap_mode)
+    stat = os.stat(path)
+    key = (os.path.abspath(path), mmap_mode, stat.st_size, stat.st_mtime_ns)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    array = np.load(path, mmap_mode=mmap_mode)
+    with _lock:
+        _cache[key] = array
+        max_bytes = _settings['max_bytes']
+        # memory-mapped arrays live in the page cache, only the arrays read into memory count
+        while max_bytes is not None and len(_cache) > 1 and \
+                sum(a.nbytes for a in _cache.values() if not isinstance(a, np.memmap)) > max_bytes:
+            _cache.popitem(last=False)
+    return array
@@ -0,0 +1,64 @@
+import os
+import torch
+import torch.nn as nn
+
+'''
+Execution device of the training (--device) and the settings of the CPU backend.
+
+Nothing in the models, the Trainer or the evaluation assumes a GPU: the device is chosen once and given to the
+Strategy and to the Trainer (loaders, evaluators, checkpoints); the models keep their fixed matrices in buffers,
+so .to(device) and torch.load(map_location=device) move all of them. On a machine without CUDA the default device
+is the CPU.
+
+On the CPU, configure_cpu() sets the intra-op thread count (--cpu_threads, default: the cores available to the
+process minus the DataLoader workers) and keeps oneDNN (mkldnn) enabled, which runs the convolutions and, with
+--precision bf16, the autocast matmuls. channels_last() stores the weights of the 2d convolutions in NHWC, the
+layout the oneDNN convolutions prefer; the EEGSym backbone has 3d convolutions, which stay as they are.
+
+`python -m my_utils.benchmarks backends --device cpu` trains a few steps of every method with every backbone
+and reports the ones that fail.
+'''
+
+
+def default_device():
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def resolve_device(device=None):
+    '''
+    :param device: 'cuda', 'cuda:1', 'cpu', ... or None for default_device()
+    '''
+    device = device or default_device()
+    if torch.device(device).type == 'cuda' and not torch.cuda.is_available():
+        raise ValueError("device {0} was asked for but CUDA is not available, use --device cpu".format(device))
+    return device
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def configure_cpu(num_threads=None, num_workers=0):
+    '''
+    :param num_threads: intra-op threads of torch, None for the available cores left by the num_workers loader
+                        processes
+    :return: the number of intra-op threads
+    '''
+    if num_threads is None:
+        num_threads = max(1, available_cores() - num_workers)
+    torch.set_num_threads(num_threads)
+    torch.backends.mkldnn.enabled = True
+    return num_threads
+
+
+def channels_last(my_net):
+    '''
+    :return: my_net, with the weights of its 2d convolutions in the channels_last memory format
+    '''
+    for module in my_net.modules():
+        if isinstance(module, nn.Conv2d):
+            module.to(memory_format=torch.channels_last)
+    return my_net
+
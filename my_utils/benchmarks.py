@@ -0,0 +1,329 @@
+import os
+import copy
+import time
+import types
+import argparse
+import configparser
+import torch
+import torch.nn as nn
+from .amp import MixedPrecision
+from .backend import resolve_device, configure_cpu, channels_last
+from .compilation import compile_model
+from .strategies import STRATEGIES
+
+'''
+Checks and timings of the training options on synthetic data, run by hand or by CI; nothing here is used by the
+training itself.
+
+    python -m my_utils.benchmarks precision --method Infinity004 --precision bf16
+    python -m my_utils.benchmarks compile --method Infinity004 --backbone_type EEGNet
+    python -m my_utils.benchmarks fused_forward --backbone_type EEGNet
+    python -m my_utils.benchmarks backends --device cpu
+
+- precision: accuracy of a method trained in bf16/fp16 against fp32 (see amp.py);
+- compile: steady-state step time of a method in eager and in compiled mode (see compilation.py);
+- fused_forward: the fused forward of the source and target batches returns the outputs and running statistics
+  of two forwards, and the time of both (see domain_batch.py);
+- backends: a few training steps of every method with every backbone on a device (see backend.py).
+
+A check that fails exits with a non-zero status.
+'''
+
+
+def synthetic_domains(n_trials, num_channels=16, datalen=384, amplitude=2.0, seed=0):
+    '''
+    Two-class EEG-like data of a source and a target domain: the class sets the frequency of a rhythm on half of
+    the channels, and the target domain mixes the channels of the source.
+
+    :return: [(eeg, label)] of the source and the target, eeg of shape (n_trials, 1, num_channels, datalen)
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    time = torch.arange(datalen, dtype=torch.float32) / 128
+    mixing = torch.eye(num_channels) + 0.3 * torch.randn(num_channels, num_channels, generator=generator) / num_channels ** 0.5
+    domains = []
+    for domain in range(2):
+        label = torch.randint(0, 2, (n_trials,), generator=generator)
+        frequency = torch.where(label == 0, torch.tensor(10.0), torch.tensor(22.0))
+        phase = 2 * torch.pi * torch.rand(n_trials, 1, generator=generator)
+        rhythm = torch.sin(2 * torch.pi * frequency[:, None] * time[None, :] + phase)
+        eeg = torch.randn(n_trials, num_channels, datalen, generator=generator)
+        eeg[:, :num_channels // 2] += amplitude * rhythm[:, None, :]
+        if domain == 1:
+            eeg = torch.matmul(mixing, eeg)
+        domains.append((eeg.unsqueeze(1), label))
+    return domains
+
+
+def synthetic_batches(domains, n_train, batch_size, generator, device):
+    '''
+    :return: [(eeg, subject, label)] batches of the domains, drawn from their first n_train trials
+    '''
+    batches = []
+    for eeg, label in domains:
+        index = torch.randint(0, n_train, (batch_size,), generator=generator)
+        batches.append((eeg[index].to(device), None, label[index].to(device)))
+    return batches
+
+
+def train_step(strategy, my_net, batches, p, optimizer):
+    my_net.zero_grad()
+    strategy.step(my_net, batches[0], batches[1] if strategy.paired else None, p)
+    strategy.amp.step(optimizer)
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def precision_parity(strategy, my_net, domains, precision, n_steps=100, batch_size=32, lr=0.01, seed=0):
+    '''
+    Train my_net with strategy on the first half of the trials of each domain and return its accuracy on the
+    second half, source and target. Same batches for any precision, so the accuracies can be compared.
+    '''
+    strategy.amp = MixedPrecision(precision, strategy.device)
+    optimizer = torch.optim.SGD(my_net.parameters(), lr=lr, momentum=0.9)
+    strategy.amp.bind(optimizer)
+    generator = torch.Generator().manual_seed(seed)
+    n_train = len(domains[0][1]) // 2
+    my_net.train()
+    for i in range(n_steps):
+        train_step(strategy, my_net, synthetic_batches(domains, n_train, batch_size, generator, strategy.device),
+                   i / n_steps, optimizer)
+    my_net.eval()
+    accuracies = []
+    with torch.inference_mode():
+        for domain, (eeg, label) in enumerate(domains):
+            class_output = my_net(input_data=eeg[n_train:].to(strategy.device), domain=domain, alpha=0)[0]
+            accuracies.append(float((class_output.argmax(dim=1).cpu() == label[n_train:]).float().mean()))
+    return accuracies
+
+
+def step_time(strategy, my_net, domains, n_warmup=20, n_steps=50, batch_size=32, lr=0.01, seed=0):
+    '''
+    Time the training steps of strategy on my_net.
+
+    :return: the seconds of the n_warmup first steps (compilation included) and the mean seconds of one of the
+             n_steps following steps
+    '''
+    optimizer = torch.optim.SGD(my_net.parameters(), lr=lr, momentum=0.9)
+    strategy.amp.bind(optimizer)
+    generator = torch.Generator().manual_seed(seed)
+    n_train = len(domains[0][1])
+    my_net.train()
+    times = []
+    for i in range(n_warmup + n_steps):
+        if i in (0, n_warmup):
+            synchronize(strategy.device)
+            times.append(time.perf_counter())
+        train_step(strategy, my_net, synthetic_batches(domains, n_train, batch_size, generator, strategy.device),
+                   i / (n_warmup + n_steps), optimizer)
+    synchronize(strategy.device)
+    times.append(time.perf_counter())
+    return times[1] - times[0], (times[2] - times[1]) / n_steps
+
+
+def forward_twice(my_net, source_data, target_data, alpha):
+    return my_net(input_data=source_data, domain=0, alpha=alpha), my_net(input_data=target_data, domain=1, alpha=alpha)
+
+
+def fused_forward_difference(my_net, source_data, target_data, alpha=1.0):
+    '''
+    :return: the largest difference between the outputs, then the floating point buffers, of two forwards and
+             of a fused forward of copies of my_net
+    '''
+    separate, fused = copy.deepcopy(my_net), copy.deepcopy(my_net)
+    outputs = [forward_twice(separate, source_data, target_data, alpha), fused.forward_domains(source_data, target_data, alpha)]
+    return max([float((a - b).abs().max()) for domain in range(2)
+                for a, b in zip(outputs[0][domain], outputs[1][domain]) if a is not None] +
+               [float((a - b).abs().max()) for a, b in zip(separate.state_dict().values(), fused.state_dict().values())
+                if a.is_floating_point()])
+
+
+def forward_backward_time(forward, my_net, source_data, target_data, device, n_warmup=5, n_steps=50):
+    '''
+    :return: the mean seconds of a forward of the two batches with forward(my_net, source_data, target_data, alpha)
+             and a backward
+    '''
+    for i in range(n_warmup + n_steps):
+        if i == n_warmup:
+            synchronize(device)
+            start = time.perf_counter()
+        my_net.zero_grad()
+        (s_outputs, t_outputs) = forward(my_net, source_data, target_data, 1.0)
+        (s_outputs[0].sum() + t_outputs[0].sum()).backward()
+    synchronize(device)
+    return (time.perf_counter() - start) / n_steps
+
+
+def backend_failures(config, device, methods, backbones, n_steps=2, use_channels_last=False, num_channels=16):
+    '''
+    Train every method with every backbone for n_steps on device.
+
+    :return: the (method, backbone_type, error) that failed
+    '''
+    domains = synthetic_domains(64, num_channels=num_channels)
+    # EEGSym pairs the channels of the two hemispheres
+    right_idx, left_idx = torch.arange(num_channels // 2).to(device), torch.arange(num_channels // 2, num_channels).to(device)
+    failed = []
+    for method in methods:
+        for backbone_type in backbones:
+            strategy = STRATEGIES[method](config, device=device)
+            strategy.amp = MixedPrecision('fp32', device)
+            try:
+                my_net = strategy.build_model(torch.eye(num_channels), torch.eye(num_channels), num_channels=num_channels,
+                                              backbone_type=backbone_type, right_idx=right_idx, left_idx=left_idx).to(device)
+                if use_channels_last:
+                    channels_last(my_net)
+                if method in ('EA', 'RA'):
+                    # the training splits the EA/RA mean covariances are estimated on
+                    strategy.prepare(*[types.SimpleNamespace(trials=lambda eeg=eeg: eeg.squeeze(1)) for eeg, _ in domains])
+                optimizer = torch.optim.SGD(my_net.parameters(), lr=0.01, momentum=0.9)
+                strategy.amp.bind(optimizer)
+                generator = torch.Generator().manual_seed(0)
+                my_net.train()
+                for i in range(n_steps):
+                    train_step(strategy, my_net, synthetic_batches(domains, len(domains[0][1]), 16, generator, device),
+                               i / n_steps, optimizer)
+                print('{0} {1}: ok'.format(method, backbone_type))
+            except Exception as error:
+                failed.append((method, backbone_type, error))
+                print('{0} {1}: {2}: {3}'.format(method, backbone_type, type(error).__name__, error))
+    return failed
+
+
+def read_config(name):
+    config = configparser.ConfigParser()
+    config.read(os.path.join("hyperparameters", name))
+    return config
+
+
+def run_precision(args):
+    strategy = STRATEGIES[args.method](read_config(args.config), device=args.device)
+    num_channels = int(args.num_channels)
+    domains = synthetic_domains(512, num_channels=num_channels)
+    torch.manual_seed(0)
+    my_net = strategy.build_model(torch.eye(num_channels), torch.eye(num_channels), num_channels=num_channels,
+                                  backbone_type=args.backbone_type).to(args.device)
+    results = {}
+    for precision in ['fp32', args.precision]:
+        results[precision] = precision_parity(strategy, copy.deepcopy(my_net), domains, precision, n_steps=int(args.n_steps))
+        print('{0}: source accuracy {1:.4f}, target accuracy {2:.4f}'.format(precision, *results[precision]))
+    difference = max(abs(a - b) for a, b in zip(results['fp32'], results[args.precision]))
+    print('largest difference: {0:.4f}'.format(difference))
+    if difference > float(args.tolerance):
+        raise SystemExit('{0} is more than {1} away from fp32'.format(args.precision, args.tolerance))
+
+
+def run_compile(args):
+    config = read_config(args.config)
+    num_channels = int(args.num_channels)
+    domains = synthetic_domains(256, num_channels=num_channels)
+    torch.manual_seed(0)
+    my_net = STRATEGIES[args.method](config, device=args.device).build_model(
+        torch.eye(num_channels), torch.eye(num_channels), num_channels=num_channels,
+        backbone_type=args.backbone_type).to(args.device)
+    results = {}
+    for mode in ['eager', 'compiled']:
+        strategy = STRATEGIES[args.method](config, device=args.device)
+        strategy.amp = MixedPrecision(args.precision, args.device)
+        model = copy.deepcopy(my_net)
+        if mode == 'compiled':
+            compile_model(model, mode=args.mode)
+            strategy.compile(mode=args.mode)
+        warmup, results[mode] = step_time(strategy, model, domains, n_warmup=int(args.n_warmup),
+                                          n_steps=int(args.n_steps), batch_size=int(args.batch_size))
+        print('{0}: {1:.2f} ms/step ({2} warm-up steps: {3:.1f} s)'.format(
+            mode, 1000 * results[mode], args.n_warmup, warmup))
+    print('speed-up: {0:.2f}x'.format(results['eager'] / results['compiled']))
+
+
+def run_fused_forward(args):
+    num_channels, batch_size = int(args.num_channels), int(args.batch_size)
+    (s_eeg, _), (t_eeg, _) = synthetic_domains(batch_size, num_channels=num_channels)
+    s_eeg, t_eeg = s_eeg.to(args.device), t_eeg.to(args.device)
+    torch.manual_seed(0)
+    strategy = STRATEGIES[args.method](None, device=args.device)
+    strategy.fused_forward = True
+    my_net = strategy.build_model(torch.eye(num_channels), torch.eye(num_channels), num_channels=num_channels,
+                                  backbone_type=args.backbone_type).to(args.device)
+    my_net.train()
+    for module in my_net.modules():
+        if isinstance(module, nn.Dropout):
+            # the dropout masks of the two ways differ
+            module.eval()
+
+    # the same outputs and the same running statistics afterwards
+    difference = fused_forward_difference(my_net, s_eeg, t_eeg)
+    print('largest difference of the outputs and buffers: {0:.2e}'.format(difference))
+    for name, forward in [('two forwards', forward_twice), ('fused forward', type(my_net).forward_domains)]:
+        seconds = forward_backward_time(forward, my_net, s_eeg, t_eeg, args.device, n_steps=int(args.n_steps))
+        print('{0}: {1:.2f} ms/step'.format(name, 1000 * seconds))
+    if difference > float(args.tolerance):
+        raise SystemExit('the fused forward is more than {0} away from two forwards'.format(args.tolerance))
+
+
+def run_backends(args):
+    device = resolve_device(args.device)
+    if torch.device(device).type == 'cpu':
+        print('{0} threads'.format(configure_cpu(int(args.cpu_threads) if args.cpu_threads else None)))
+    failed = backend_failures(read_config(args.config), device, args.methods.split(','), args.backbones.split(','),
+                              n_steps=int(args.n_steps), use_channels_last=args.channels_last == '1')
+    if failed:
+        raise SystemExit('{0} combinations failed'.format(len(failed)))
+
+
+def get_parser():
+    default_device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    parser = argparse.ArgumentParser(description='Checks and timings of the training options, on synthetic data.')
+    subparsers = parser.add_subparsers(dest='check', required=True)
+
+    precision = subparsers.add_parser('precision', help='accuracy of a method trained in bf16/fp16 against fp32')
+    precision.add_argument('--method', default='Infinity004', choices=sorted(STRATEGIES), help='training method')
+    precision.add_argument('--config', default='config_PhysioNetMIToMengExp12.ini', help='Path to the config.ini file')
+    precision.add_argument('--precision', default='bf16', help='bf16 or fp16')
+    precision.add_argument('--device', default=default_device)
+    precision.add_argument('--backbone_type', default='EEGNet')
+    precision.add_argument('--num_channels', default='16')
+    precision.add_argument('--n_steps', default='100')
+    precision.add_argument('--tolerance', default='0.05', help='largest accepted accuracy difference')
+    precision.set_defaults(run=run_precision)
+
+    compiled = subparsers.add_parser('compile', help='step time of a method in eager and in compiled mode')
+    compiled.add_argument('--method', default='Infinity004', choices=sorted(STRATEGIES), help='training method')
+    compiled.add_argument('--config', default='config_PhysioNetMIToMengExp12.ini', help='Path to the config.ini file')
+    compiled.add_argument('--device', default=default_device)
+    compiled.add_argument('--backbone_type', default='EEGNet')
+    compiled.add_argument('--precision', default='fp32', help='fp32, bf16 or fp16')
+    compiled.add_argument('--mode', default='default', help='mode of torch.compile: default, reduce-overhead or max-autotune')
+    compiled.add_argument('--num_channels', default='64')
+    compiled.add_argument('--batch_size', default='32')
+    compiled.add_argument('--n_warmup', default='20', help='steps before the timing, the compilation happens there')
+    compiled.add_argument('--n_steps', default='50', help='timed steps')
+    compiled.set_defaults(run=run_compile)
+
+    fused = subparsers.add_parser('fused_forward', help='fused forward of the source and target batches against two forwards')
+    fused.add_argument('--method', default='Infinity004', choices=sorted(name for name, strategy in STRATEGIES.items() if strategy.paired))
+    fused.add_argument('--device', default=default_device)
+    fused.add_argument('--backbone_type', default='EEGNet')
+    fused.add_argument('--num_channels', default='16')
+    fused.add_argument('--batch_size', default='32')
+    fused.add_argument('--n_steps', default='50', help='timed forward and backward passes')
+    fused.add_argument('--tolerance', default='1e-4', help='largest accepted difference of the outputs and buffers')
+    fused.set_defaults(run=run_fused_forward)
+
+    backends = subparsers.add_parser('backends', help='a few training steps of every method x backbone on a device')
+    backends.add_argument('--config', default='config_PhysioNetMIToMengExp12.ini', help='Path to the config.ini file')
+    backends.add_argument('--device', default='cpu')
+    backends.add_argument('--cpu_threads', default=None)
+    backends.add_argument('--channels_last', default='0')
+    backends.add_argument('--methods', default=','.join(sorted(STRATEGIES)))
+    backends.add_argument('--backbones', default='EEGNet,ShallowConvNet,DeepConvNet,InceptionEEG,EEGSym')
+    backends.add_argument('--n_steps', default='2')
+    backends.set_defaults(run=run_backends)
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    args.run(args)
@@ -0,0 +1,31 @@
+
+'''
+Compiled mode (--compile) of the EEG_Infinity models and of the alignment losses.
+
+A step runs many small operations: the two matmuls and the padded FIR convolution of the alignment head, the
+ChannelNorm, the backbone and the two MLP heads, then the covariance and FFT losses. torch.compile fuses them.
+
+compile_model() compiles the submodules of the model in place (nn.Module.compile), not EEG_Infinity.forward
+itself: forward picks the alignment head of the domain and applies the gradient reversal with the GRL alpha,
+which changes at every step and would make a compiled forward recompile. The parameter names, state_dict and
+torch.save of the model are the ones of the eager model, a saved model is loaded uncompiled. The losses are
+compiled by Strategy.compile(). `python -m my_utils.benchmarks compile` times a method in eager and in compiled
+mode.
+'''
+
+# the submodules of EEG_Infinity that compile_model() compiles
+COMPILED_SUBMODULES = ['alignment_head_source', 'alignment_head_target', 'channel_norm', 'feature',
+                       'class_classifier', 'domain_classifier']
+
+
+def compile_model(my_net, **options):
+    '''
+    :param options: keyword arguments of torch.compile (mode, dynamic, ...)
+    :return: my_net, with its submodules compiled
+    '''
+    for name in COMPILED_SUBMODULES:
+        module = getattr(my_net, name, None)
+        if module is not None:
+            module.compile(**options)
+    return my_net
+
@@ -1,9 +1,15 @@
 import torch.utils.data as data
 import numpy as np
 import os
+import queue
+import logging
+import threading
 import torch
+from . import array_cache
 # from .my_tool import channel_norm, cov_loss
 
+logger = logging.getLogger(__name__)
+
 def cov_loss(tensorA, tensorB):
     """
         Calculate the L2 distance between the average covariance matrices of two tensors (tensorA and tensorB).
@@ -44,37 +50,415 @@ def channel_norm(input, channel=64):
     B=temp_trial_ch_std+epsilon
     out = torch.div(A, B)
     return out
+def torch_dtype(dtype):
+    '''
+    :return: the torch dtype of a numpy dtype (or dtype name)
+    '''
+    return torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+
+
+def open_eeg_dataset(data_root, data_list, **kwargs):
+    '''
+    EEGDataSet for a [data_file, label_file] list or a trial_store.StoreSplit, or a streaming
+    sharded_dataset.ShardedEEGDataset when data_list is the path of a shard directory (or of its index.json).
+    '''
+    if isinstance(data_list, str):
+        from .sharded_dataset import ShardedEEGDataset
+        kwargs.pop('mmap', None)
+        kwargs.pop('transforms', None)
+        kwargs.pop('isChannelNorm', None)
+        return ShardedEEGDataset(data_root=data_root, data_list=data_list, **kwargs)
+    return EEGDataSet(data_root=data_root, data_list=data_list, **kwargs)
+
+
 class EEGDataSet(data.Dataset):
     def __init__(self, data_root, data_list,
                  start=0,
                  datalen=256,
                  num_channel=64,
                  transforms=None,
-                 isChannelNorm=0):
+                 isChannelNorm=0,
+                 mmap=False,
+                 random_crop=None,
+                 n_crops=1,
+                 batch_dtype=None):
+        '''
+        :param mmap: if True, the npy files are opened memory-mapped (copy-on-write) instead of being read into
+                     private memory. Trials are then returned as views into the page-cached file, so every
+                     DataLoader worker and every concurrent job reading the same fold file shares one copy.
+        :param data_list: [data_file, label_file] relative to data_root, or a trial_store.StoreSplit to read one
+                          split of a deduplicated trial store (see EEGDataSet.from_store).
+        :param random_crop: None for the fixed [start, start + datalen) window, 'trial' to draw a random window
+                            start in [start, stored length - datalen] for every trial, or 'batch' to draw one
+                            start per get_batch call. Windows are strided views of the stored trials, no copy
+                            is made before the batch itself is gathered.
+        :param n_crops: if > 1, every trial gives n_crops evenly spaced windows (deterministic multi-crop for
+                        evaluation); eegs then have the shape (B, n_crops, 1, C, datalen), see
+                        test_MengData_new.crop_average_forward.
+        :param batch_dtype: if set (e.g. 'float32'), the arrays stay in their stored dtype (see
+                            storage_dtype.py for float32/float16 copies) and only the returned trials or batches
+                            are cast to batch_dtype.
+        '''
         self.root = data_root
         self.isChannelNorm = isChannelNorm
         self.start = start
         self.datalen = datalen
         self.num_channel = num_channel
         self.transforms = transforms
-        self.eeg_data = np.load(os.path.join(data_root, data_list[0]))
-        self.eeg_labels = np.load(os.path.join(data_root, data_list[1]))
-        self.n_data = self.eeg_labels.shape[0]
+        self.mmap = mmap
+        # 'c' (copy-on-write) keeps the mapping shared but gives writable arrays, which torch.from_numpy expects
+        mmap_mode = 'c' if mmap else None
+        # trial indices into eeg_data/eeg_labels, only used when several splits share one mapped trial store
+        self.index = None
+        if isinstance(data_list, (list, tuple)):
+            self.eeg_data = array_cache.load(os.path.join(data_root, data_list[0]), mmap_mode=mmap_mode)
+            self.eeg_labels = array_cache.load(os.path.join(data_root, data_list[1]), mmap_mode=mmap_mode)
+        else:
+            from .trial_store import open_store_split
+            if mmap:
+                self.eeg_data, self.eeg_labels, self.index = open_store_split(data_root, data_list, mmap_mode)
+            else:
+                # only read the rows of this split into private memory
+                eeg_data, eeg_labels, index = open_store_split(data_root, data_list, 'r')
+                self.eeg_data = eeg_data[index]
+                self.eeg_labels = eeg_labels[index]
+        self.n_data = self.eeg_labels.shape[0] if self.index is None else self.index.shape[0]
+        if random_crop not in (None, 'trial', 'batch'):
+            raise ValueError("random_crop must be None, 'trial' or 'batch'")
+        self.random_crop = random_crop
+        self.n_crops = n_crops
+        self.batch_dtype = None if batch_dtype is None else np.dtype(batch_dtype)
+        # number of window starts after `start` that still fit in the stored trials
+        self.max_offset = self.eeg_data.shape[-1] - start - datalen
+        if self.max_offset < 0:
+            raise ValueError("stored trials have {0} samples, shorter than start + datalen = {1}".format(
+                self.eeg_data.shape[-1], start + datalen))
+        if (random_crop is not None or n_crops > 1) and self.max_offset == 0:
+            logger.warning("stored trials are exactly start + datalen long, every crop is the same window")
+
+    @classmethod
+    def from_store(cls, store, fold, split, data_root='', mmap=True, **kwargs):
+        '''
+        Dataset of one split of one fold of a trial store written by trial_store.pack_concated_data.
+        Memory mapping is on by default so that all folds and splits share the single stored copy.
+        '''
+        from .trial_store import StoreSplit
+        return cls(data_root=data_root, data_list=StoreSplit(store, fold, split), mmap=mmap, **kwargs)
+
+    def trials(self):
+        '''
+        :return: all trials of this split with their full stored length, (N, C, T)
+        '''
+        if self.index is None:
+            return self.eeg_data
+        return self.eeg_data[self.index]
+
+    def windows(self):
+        '''
+        :return: every window of datalen samples of every stored trial, (N, C, T - datalen + 1, datalen), as a
+                 strided view of eeg_data (nothing is copied)
+        '''
+        return np.lib.stride_tricks.sliding_window_view(self.eeg_data, self.datalen, axis=-1)
+
+    def crop_offsets(self, n):
+        '''
+        :return: window starts for n trials, following random_crop. torch's RNG is used because DataLoader
+                 seeds it differently in every worker.
+        '''
+        if self.random_crop == 'trial':
+            return self.start + torch.randint(0, self.max_offset + 1, (n,)).numpy()
+        if self.random_crop == 'batch':
+            return np.full(n, self.start + int(torch.randint(0, self.max_offset + 1, (1,))), dtype=np.int64)
+        return np.full(n, self.start, dtype=np.int64)
+
+    def multi_crop_offsets(self):
+        '''
+        :return: the n_crops evenly spaced window starts used for evaluation
+        '''
+        return self.start + np.round(np.linspace(0, self.max_offset, self.n_crops)).astype(np.int64)
 
     def __getitem__(self, item):
-        eegs = self.eeg_data[item, :, :]
+        if not isinstance(item, (int, np.integer)):
+            # a list of indices coming from a BatchSampler (see make_batch_loader)
+            return self.get_batch(item)
+        if self.index is not None:
+            item = self.index[item]
+        if self.n_crops > 1:
+            # (n_crops, C, datalen)
+            eegs = self.windows()[item, :, self.multi_crop_offsets()]
+            eegs = np.expand_dims(eegs, axis=1)
+        else:
+            offset = self.crop_offsets(1)[0]
+            eegs = self.eeg_data[item, :, offset:offset + self.datalen]
+            eegs = np.expand_dims(eegs, axis=0)
         labels = self.eeg_labels[item]
         subjects = 1
-        eegs = eegs[:, self.start:self.start + self.datalen]
-        eegs = np.expand_dims(eegs, axis=0)
-        eegs = torch.tensor(eegs)
+        if self.batch_dtype is not None:
+            eegs = eegs.astype(self.batch_dtype, copy=False)
+        if self.mmap:
+            # zero-copy: the tensor shares memory with the mapped file
+            eegs = torch.from_numpy(eegs)
+        else:
+            eegs = torch.tensor(eegs)
         labels = int(labels)
         return eegs, subjects, labels
 
+    def get_batch(self, items):
+        '''
+        Gather a whole batch with one fancy-index into the contiguous array.
+
+        :param items: sequence of trial indices
+        :return: eegs (B, 1, C, datalen), subjects (B,), labels (B,) -- the same as the default collate of
+                 B calls of __getitem__, without any per-trial Python work. With n_crops > 1 eegs is
+                 (B, n_crops, 1, C, datalen).
+        '''
+        items = np.asarray(items, dtype=np.int64)
+        if self.index is not None:
+            items = self.index[items]
+        if self.n_crops > 1:
+            # the trial and crop indices broadcast to (B, n_crops) ahead of the sliced channel axis
+            eegs = self.windows()[items[:, None], :, self.multi_crop_offsets()[None, :]]
+            eegs = torch.from_numpy(eegs).unsqueeze(2)
+        elif self.random_crop == 'trial':
+            # one gather straight from the strided windows: (B, C, datalen)
+            eegs = self.windows()[items, :, self.crop_offsets(len(items))]
+            eegs = torch.from_numpy(eegs).unsqueeze(1)
+        else:
+            offset = self.crop_offsets(1)[0]
+            eegs = self.eeg_data[items, :, offset:offset + self.datalen]
+            eegs = torch.from_numpy(eegs).unsqueeze(1)
+        if self.batch_dtype is not None:
+            eegs = eegs.to(torch_dtype(self.batch_dtype))
+        labels = torch.from_numpy(np.asarray(self.eeg_labels[items]).astype(np.int64))
+        subjects = torch.ones(len(items), dtype=torch.int64)
+        return eegs, subjects, labels
+
     def __len__(self):
         return self.n_data
 
 
+def make_batch_loader(dataset, batch_size, shuffle=False, drop_last=False, num_workers=0, **kwargs):
+    '''
+    Build a DataLoader that fetches whole batches through dataset.get_batch instead of collating
+    batch_size single trials. It is a drop-in for torch.utils.data.DataLoader(dataset, batch_size, shuffle, ...):
+    len() and the (eegs, subjects, labels) batches are the same.
+
+    A streamed split (sharded_dataset.ShardedEEGDataset) cannot be sampled by index: it shuffles itself and the
+    DataLoader collates its trials as usual.
+    '''
+    if isinstance(dataset, data.IterableDataset):
+        dataset.shuffle = shuffle
+        return data.DataLoader(dataset=dataset, batch_size=batch_size, drop_last=drop_last,
+                               num_workers=num_workers, **kwargs)
+    if shuffle:
+        sampler = data.RandomSampler(dataset)
+    else:
+        sampler = data.SequentialSampler(dataset)
+    batch_sampler = data.BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last)
+    # batch_size=None disables automatic batching: each sampled index list goes to dataset[...] as a whole
+    return data.DataLoader(dataset=dataset, batch_size=None, sampler=batch_sampler, num_workers=num_workers,
+                           **kwargs)
+
+
+class TensorEEGDataset(data.Dataset):
+    '''
+    A whole split held as one contiguous tensor on the training device.
+
+    Each fold's split is small enough to live in (GPU) memory, so it is loaded once from an EEGDataSet and
+    afterwards batches are plain index operations on the device: no workers, no IPC, no pickling per epoch.
+    '''
+    def __init__(self, eeg_dataset, device='cpu'):
+        eegs, subjects, labels = eeg_dataset.get_batch(np.arange(len(eeg_dataset)))
+        self.device = torch.device(device)
+        self.random_crop = getattr(eeg_dataset, 'random_crop', None)
+        if self.random_crop is not None:
+            # keep the stored trials from `start` on, the windows are cropped on the device for every batch
+            self.datalen = eeg_dataset.datalen
+            self.max_offset = eeg_dataset.max_offset
+            eegs = torch.from_numpy(np.asarray(eeg_dataset.trials()[:, :, eeg_dataset.start:])).unsqueeze(1)
+        self.batch_dtype = None
+        if getattr(eeg_dataset, 'batch_dtype', None) is not None:
+            # keep the stored (compact) dtype on the device as well, batches are cast in get_batch
+            self.batch_dtype = torch_dtype(eeg_dataset.batch_dtype)
+            eegs = eegs.to(torch_dtype(eeg_dataset.eeg_data.dtype))
+        self.eegs = eegs.contiguous().to(self.device)
+        self.subjects = subjects.to(self.device)
+        self.labels = labels.to(self.device)
+        self.n_data = self.labels.shape[0]
+
+    def __getitem__(self, item):
+        return self.get_batch(item)
+
+    def get_batch(self, items):
+        if self.random_crop == 'trial':
+            offsets = torch.randint(0, self.max_offset + 1, torch.as_tensor(items).shape, device=self.device)
+            # unfold is a strided view (N, 1, C, windows, datalen); the gather gives (B, 1, C, datalen)
+            eegs = self.eegs.unfold(-1, self.datalen, 1)[items, :, :, offsets]
+        elif self.random_crop == 'batch':
+            offset = int(torch.randint(0, self.max_offset + 1, (1,)))
+            eegs = self.eegs[items, ..., offset:offset + self.datalen]
+        else:
+            eegs = self.eegs[items]
+        if self.batch_dtype is not None:
+            eegs = eegs.to(self.batch_dtype)
+        return eegs, self.subjects[items], self.labels[items]
+
+    def __len__(self):
+        return self.n_data
+
+
+class TensorEEGLoader(object):
+    '''
+    Batch iterator over a TensorEEGDataset, shuffled with torch.randperm on the data's device.
+    Drop-in for the DataLoader in the training loops: len(loader) is the number of batches and
+    iter(loader) yields (eegs, subjects, labels) batches that are already on the device.
+    '''
+    def __init__(self, dataset, batch_size, shuffle=False, drop_last=False, generator=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n_data = len(self.dataset)
+        device = self.dataset.device
+        if self.shuffle:
+            if self.generator is None:
+                order = torch.randperm(n_data, device=device)
+            else:
+                order = torch.randperm(n_data, generator=self.generator).to(device)
+        else:
+            order = torch.arange(n_data, device=device)
+        for i in range(len(self)):
+            yield self.dataset.get_batch(order[i * self.batch_size:(i + 1) * self.batch_size])
+
+
+def make_eeg_loader(dataset, batch_size, shuffle=False, drop_last=False, num_workers=0, in_memory=False,
+                    device='cpu'):
+    '''
+    Return a TensorEEGLoader over the split loaded once onto `device` if in_memory is set, otherwise a
+    worker-based make_batch_loader.
+    '''
+    if in_memory:
+        if isinstance(dataset, data.IterableDataset):
+            raise ValueError("a streamed (sharded) split is not loaded into memory, use in_memory=False")
+        return TensorEEGLoader(TensorEEGDataset(dataset, device=device), batch_size=batch_size, shuffle=shuffle,
+                               drop_last=drop_last)
+    return make_batch_loader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last,
+                             num_workers=num_workers)
+
+
+class PairedDomainLoader(object):
+    '''
+    Iterate a source and a target loader in lockstep, yielding (source_batch, target_batch) pairs of equal size.
+
+    - len(loader) is min(len(source), len(target)), or max(...) with cycle=True, in which case the shorter
+      domain is restarted (and so reshuffled) whenever it runs out.
+    - If the two batches of a pair differ in size (the last, partial batch of a loader built without
+      drop_last), the larger one is cut to the smaller, so no step is skipped and the step count only depends
+      on the loader lengths. Build both loaders with drop_last=True to only get full batches.
+    - A background thread fetches the next `prefetch` pairs and moves them to `device` while the current
+      step runs. On CUDA the copies go through a side stream that the consuming stream waits on.
+    '''
+    def __init__(self, source_loader, target_loader, cycle=False, prefetch=2, device=None):
+        self.source_loader = source_loader
+        self.target_loader = target_loader
+        self.cycle = cycle
+        self.prefetch = prefetch
+        self.device = None if device is None else torch.device(device)
+
+    def __len__(self):
+        if self.cycle:
+            return max(len(self.source_loader), len(self.target_loader))
+        return min(len(self.source_loader), len(self.target_loader))
+
+    def _pairs(self):
+        n_pairs = len(self)
+        source_iter = iter(self.source_loader)
+        target_iter = iter(self.target_loader)
+        for _ in range(n_pairs):
+            try:
+                data_source = next(source_iter)
+            except StopIteration:
+                source_iter = iter(self.source_loader)
+                data_source = next(source_iter)
+            try:
+                data_target = next(target_iter)
+            except StopIteration:
+                target_iter = iter(self.target_loader)
+                data_target = next(target_iter)
+            n = min(len(data_source[-1]), len(data_target[-1]))
+            if len(data_source[-1]) != n:
+                data_source = [item[:n] for item in data_source]
+            if len(data_target[-1]) != n:
+                data_target = [item[:n] for item in data_target]
+            yield data_source, data_target
+
+    def _to_device(self, batch):
+        return [item.to(self.device, non_blocking=True) for item in batch]
+
+    def _producer(self, pairs, out_queue, stop):
+        stream = None
+        if self.device is not None and self.device.type == 'cuda':
+            stream = torch.cuda.Stream(device=self.device)
+        try:
+            for data_source, data_target in pairs:
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        data_source = self._to_device(data_source)
+                        data_target = self._to_device(data_target)
+                    event = torch.cuda.Event()
+                    event.record(stream)
+                elif self.device is not None:
+                    data_source = self._to_device(data_source)
+                    data_target = self._to_device(data_target)
+                item = (data_source, data_target, event)
+                while not stop.is_set():
+                    try:
+                        out_queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            out_queue.put(e)
+            return
+        out_queue.put(None)
+
+    def __iter__(self):
+        out_queue = queue.Queue(maxsize=max(self.prefetch, 1))
+        stop = threading.Event()
+        worker = threading.Thread(target=self._producer, args=(self._pairs(), out_queue, stop), daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = out_queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                data_source, data_target, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    for tensor in list(data_source) + list(data_target):
+                        # the tensors were allocated on the side stream but are used (and freed) on this one
+                        tensor.record_stream(current_stream)
+                yield data_source, data_target
+        finally:
+            # also reached when the training loop breaks early: let the producer exit
+            stop.set()
+            worker.join()
+
+
 if __name__ == "__main__":
     import configparser
     import argparse
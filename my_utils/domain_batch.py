@@ -0,0 +1,92 @@
+import contextlib
+import torch
+import torch.nn as nn
+
+'''
+Fused source+target forward (--fused_forward) of the EEG_Infinity models.
+
+A paired step calls the model twice, on a source and on a target batch, and each call runs the backbone and the
+heads on one small batch. EEG_Infinity.forward_domains(source_data, target_data, alpha) applies the alignment
+head of each domain to its batch, then runs the shared layers once on the concatenation and splits their outputs
+back, returning the two output tuples of forward(source_data, 0, alpha) and forward(target_data, 1, alpha).
+
+Over a concatenated batch, a BatchNorm layer in training mode would normalize with the statistics of both
+domains together. use_domain_batch_norm() turns the BatchNorm layers of a model into DomainBatchNorm layers once,
+when the model is built; within domain_batch_norm(), these normalize the part of each domain with its own batch
+statistics and update their running statistics with the source part then the target part, as the two separate
+forwards did; the convolutions and linear layers still run once. The split is an attribute the layers read, so
+the forward of a compiled model is not changed from step to step. Without it (--domain_bn 0) the statistics are
+shared between the domains. `python -m my_utils.benchmarks fused_forward` checks that the fused
+forward returns the outputs of the two forwards and times both.
+'''
+
+
+def split_domains(outputs, sizes):
+    '''
+    :param outputs: outputs of the shared layers over the concatenated domains, None for the missing ones
+    :param sizes: [source batch size, target batch size]
+    :return: the tuples of the source and of the target parts of outputs
+    '''
+    parts = [(None, None) if output is None else output.split(sizes) for output in outputs]
+    return tuple(part[0] for part in parts), tuple(part[1] for part in parts)
+
+
+class DomainBatchNorm(object):
+    '''
+    BatchNorm that normalizes the parts of domain_sizes of its input separately while domain_sizes is set, and
+    the whole input otherwise. Its parameters, buffers and state_dict are those of the BatchNorm it replaces.
+    '''
+    domain_sizes = None
+
+    def forward(self, input):
+        if self.domain_sizes is None:
+            return super(DomainBatchNorm, self).forward(input)
+        return torch.cat([super(DomainBatchNorm, self).forward(part) for part in input.split(self.domain_sizes)])
+
+
+class DomainBatchNorm1d(DomainBatchNorm, nn.BatchNorm1d):
+    pass
+
+
+class DomainBatchNorm2d(DomainBatchNorm, nn.BatchNorm2d):
+    pass
+
+
+class DomainBatchNorm3d(DomainBatchNorm, nn.BatchNorm3d):
+    pass
+
+
+DOMAIN_BATCH_NORMS = {nn.BatchNorm1d: DomainBatchNorm1d, nn.BatchNorm2d: DomainBatchNorm2d,
+                      nn.BatchNorm3d: DomainBatchNorm3d}
+
+
+def use_domain_batch_norm(my_net):
+    '''
+    :return: my_net, with its BatchNorm layers turned into the DomainBatchNorm of their dimension
+    '''
+    for module in my_net.modules():
+        if type(module) in DOMAIN_BATCH_NORMS:
+            module.__class__ = DOMAIN_BATCH_NORMS[type(module)]
+    return my_net
+
+
+@contextlib.contextmanager
+def domain_batch_norm(my_net, sizes, enabled=True):
+    '''
+    Within the context, the DomainBatchNorm layers of my_net normalize the parts of sizes of their input
+    separately.
+    '''
+    if not enabled:
+        yield
+        return
+    norms = [module for module in my_net.modules() if isinstance(module, nn.modules.batchnorm._BatchNorm)]
+    if not all(isinstance(module, DomainBatchNorm) for module in norms):
+        raise ValueError("the BatchNorm layers of the model normalize the domains together, "
+                         "build it with use_domain_batch_norm() or call forward_domains with domain_bn=False")
+    for module in norms:
+        module.domain_sizes = tuple(sizes)
+    try:
+        yield
+    finally:
+        for module in norms:
+            module.domain_sizes = None
@@ -0,0 +1,128 @@
+import os
+import re
+import sys
+import gc
+import time
+import logging
+import importlib
+
+from . import array_cache
+from .scheduler import DONE, FAILED, JobState, job_id, default_state_file
+
+'''
+In-process runner of the (script_path, work_dir, cmd_args) jobs of the run_scripts_*.py grids (--in_process 1).
+
+A subprocess per job pays the import of torch, tensorboard, pandas and pyriemann and reads the fold files that
+the previous job just read. Here the libraries are imported once (preload()), the training entry point
+EEG_train.main is called in this process with the method of the job's EEG_<method>_anybackbone.py script and its
+arguments, and the npy files go through the process-wide array_cache, so the jobs of a task share its folds and
+transfer matrices.
+
+Nothing process-wide is swapped for a job: the training reports through the my_utils loggers, which get a file
+handler on the log of the job for its duration. The jobs run in the working directory of the grid.
+
+The jobs run one after the other, with the same state file, logs and retries as the scheduler (see
+scheduler.py); a job that raises is recorded as failed and the next one starts.
+'''
+
+# the libraries every job imports
+PRELOADED_MODULES = ['numpy', 'torch', 'torch.utils.tensorboard', 'pandas', 'pyriemann', 'scipy.io',
+                     'my_utils.strategies', 'my_utils.trainer', 'EEG_train']
+# the logger the training reports to, see trainer.py
+TRAINING_LOGGER = 'my_utils'
+
+
+def preload():
+    for name in PRELOADED_MODULES:
+        importlib.import_module(name)
+
+
+def release_memory():
+    gc.collect()
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def job_method(script_path):
+    '''
+    :return: the method an EEG_<method>_anybackbone.py script trains
+    '''
+    match = re.match(r'EEG_(\w+)_anybackbone\.py$', os.path.basename(script_path))
+    if match is None:
+        raise ValueError("{0} is not an EEG_<method>_anybackbone.py script".format(script_path))
+    return match.group(1)
+
+
+def run_in_process(job, log_file):
+    '''
+    Train the job with EEG_train.main in this process, the messages of the training going to log_file.
+
+    :return: 0 if the job ran through, 1 if it raised
+    '''
+    from EEG_train import main
+
+    script_path, work_dir, cmd_args = job
+    logger = logging.getLogger(TRAINING_LOGGER)
+    handler = logging.FileHandler(log_file)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    level, propagate = logger.level, logger.propagate
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    try:
+        if os.path.abspath(work_dir) != os.getcwd():
+            raise ValueError("in process, the jobs run in {0}, not in {1}".format(os.getcwd(), work_dir))
+        main(method=job_method(script_path), argv=list(cmd_args))
+        return 0
+    except (Exception, SystemExit):
+        logger.exception("job {0} failed".format(job_id(job)))
+        return 1
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+        logger.setLevel(level)
+        logger.propagate = propagate
+        release_memory()
+
+
+def run_jobs_in_process(jobs, retries=1, state_file=None, log_dir=os.path.join('logs', 'jobs'), cache_gb=None):
+    '''
+    Run the jobs one after the other in this process; see the module docstring.
+
+    :param cache_gb: largest size of the cached arrays in GB, None for no limit
+    :return: the ids of the jobs that failed on every attempt
+    '''
+    state = JobState(state_file or default_state_file())
+    pending = [job for job in jobs if not state.done(job_id(job))]
+    print('{0} jobs, {1} already done, in process'.format(len(jobs), len(jobs) - len(pending)))
+    start = time.time()
+    preload()
+    print('libraries imported in {0:.1f} s'.format(time.time() - start))
+    array_cache.enable(cache_gb)
+    os.makedirs(log_dir, exist_ok=True)
+    failed = []
+    for job in pending:
+        name = job_id(job)
+        for attempt in range(retries + 1):
+            state.update(name, status='running', attempts=state.attempts(name) + 1)
+            print('start {0} (attempt {1})'.format(name, state.attempts(name)))
+            start = time.time()
+            log_file = os.path.join(log_dir, name + '.log')
+            with open(log_file, 'a') as log:
+                log.write('==== {0} in process: {1}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'),
+                                                              ' '.join([job[0]] + list(job[2]))))
+            returncode = run_in_process(job, log_file)
+            seconds = round(time.time() - start)
+            if returncode == 0:
+                state.update(name, status=DONE, returncode=0, seconds=seconds)
+                print('done {0} in {1} s'.format(name, seconds))
+                break
+            state.update(name, status=FAILED, returncode=returncode, seconds=seconds)
+            print('failed {0}, see {1}'.format(name, log_file))
+        else:
+            failed.append(name)
+    array_cache.disable()
+    if failed:
+        print('{0} jobs failed: {1}'.format(len(failed), ', '.join(failed)))
+    return failed
@@ -138,7 +138,7 @@ class Alignment_head(nn.Module):
         self.k = k
         self.dc = dc
         self.channel_transfer_matrix = nn.Parameter(torch.eye(transfer_matrix.size()[0]))
-        self.channel_transfer_matrix_fixed = transfer_matrix.cuda()
+        self.register_buffer('channel_transfer_matrix_fixed', transfer_matrix)
         self.channel_norm = ChannelNorm()
         self.domain_filter = FIR_convolution(FIR_n, FIR_order)
 
@@ -136,7 +136,7 @@ class Alignment_head(nn.Module):
     def __init__(self, transfer_matrix, FIR_order=17, FIR_n=1):
         super(Alignment_head, self).__init__()
         self.channel_transfer_matrix = nn.Parameter(torch.eye(transfer_matrix.size()[0]))
-        self.channel_transfer_matrix_fixed = transfer_matrix.cuda()
+        self.register_buffer('channel_transfer_matrix_fixed', transfer_matrix)
         self.domain_filter = FIR_convolution(FIR_n, FIR_order)
 
 
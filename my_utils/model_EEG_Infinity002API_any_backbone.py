@@ -18,7 +18,7 @@ class EEG_Infinity(nn.Module):
     '''
 
     def __init__(self, transfer_matrix_source, transfer_matrix_target, num_channels = 64, FIR_order=17, FIR_n=1,
-                 backbone_type='InceptionEEG', right_idx=None, left_idx=None):
+                 backbone_type='InceptionEEG', right_idx=None, left_idx=None, input_projected=False):
         super(EEG_Infinity, self).__init__()
 
         self.num_classes = 2
@@ -26,9 +26,9 @@ class EEG_Infinity(nn.Module):
 
         # define alignment heads for source domain
         self.alignment_head_source = Alignment_head(transfer_matrix=transfer_matrix_source,
-                                                    FIR_order=FIR_order, FIR_n=FIR_n)
+                                                    FIR_order=FIR_order, FIR_n=FIR_n, input_projected=input_projected)
         self.alignment_head_target = Alignment_head(transfer_matrix=transfer_matrix_target,
-                                                    FIR_order=FIR_order, FIR_n=FIR_n)
+                                                    FIR_order=FIR_order, FIR_n=FIR_n, input_projected=input_projected)
 
         # define feature extractor
         if backbone_type == 'EEGNet':
@@ -87,12 +87,19 @@ class depthwise_separable_conv(nn.Module):
 
 
 class Alignment_head(nn.Module):
-    def __init__(self, transfer_matrix, FIR_order=17, FIR_n=1):
+    # True when the data loader already applied channel_transfer_matrix_fixed (see my_utils/projection_cache.py)
+    input_projected = False
+
+    def __init__(self, transfer_matrix, FIR_order=17, FIR_n=1, input_projected=False):
         super(Alignment_head, self).__init__()
-        self.channel_transfer_matrix_fixed = transfer_matrix.cuda()
+        # a buffer, so that .to() and torch.load(map_location=...) move it with the model
+        self.register_buffer('channel_transfer_matrix_fixed', transfer_matrix)
+        self.input_projected = input_projected
 
     def forward(self, input_data):
         _input_data_ = input_data.to(torch.float32)
+        if self.input_projected:
+            return _input_data_, None
         _output_ = torch.matmul(self.channel_transfer_matrix_fixed, _input_data_)
         return _output_, None
 class EEGNetFeatureExtractor(nn.Module):
@@ -244,7 +251,6 @@ class ShallowNetFeatureExtractor(nn.Module):
             init.zeros_(self.bnorm.bias)
 
     def forward(self, x):
-        x = x.type(torch.cuda.FloatTensor)
         x = x.permute(0, 2, 3, 1)
         features = self.feature_extractor(x)
         return features
@@ -412,7 +418,6 @@ class DeepNetFeatureExtractor(nn.Sequential):
 
     def forward(self, input_data):
         # Define the forward pass
-        input_data = input_data.type(torch.cuda.FloatTensor)
         input_data = input_data.permute(0, 2, 3, 1)
         features = self.feature_extractor(input_data)
         # print(features.shape)
@@ -548,7 +553,6 @@ class InceptionEEGFeatureExtractor(nn.Module):
         self.__hidden_len__ = __hidden_feature__.shape[1] * __hidden_feature__.shape[2] * __hidden_feature__.shape[3]
 
     def forward(self, input_data):
-        input_data = input_data.type(torch.cuda.FloatTensor)
         feature = self.feature(input_data)
         return feature
 
@@ -782,8 +786,8 @@ class EEGSymFeatureExtractor(nn.Module):
             EEGSym_residual_mini_block(18, 18, [5], [2]),
             nn.AvgPool3d(kernel_size=(1, 2, 1))
         )
-        self.Block4 = EEGSym_Channel_Merging_block(18, 18, 18, self.num_channels).cuda()
-        self.Block5 = EEGSym_Temporal_Merging_block(18, 18, 36, 6).cuda()
+        self.Block4 = EEGSym_Channel_Merging_block(18, 18, 18, self.num_channels)
+        self.Block5 = EEGSym_Temporal_Merging_block(18, 18, 36, 6)
         self.Block6 = nn.Sequential(
             EEGSym_residual_mini_block(36, 36, [1], [0]),
             EEGSym_residual_mini_block(36, 36, [1], [0]),
@@ -801,20 +805,11 @@ class EEGSymFeatureExtractor(nn.Module):
         )
 
     def forward(self, input_data):
-        input_data = input_data.type(torch.cuda.FloatTensor)
-        torch.cuda.empty_cache()
         output = self.sym_layer(input_data)
-        torch.cuda.empty_cache()
         output = self.Block1(output)
-        torch.cuda.empty_cache()
         output = self.Block2(output)
-        torch.cuda.empty_cache()
         output = self.Block3(output)
-        torch.cuda.empty_cache()
         output = self.Block4(output)
-        torch.cuda.empty_cache()
         output = self.Block5(output)
-        torch.cuda.empty_cache()
         output = self.Block6(output)
-        torch.cuda.empty_cache()
         return output
@@ -7,6 +7,7 @@ from .model_utils.model_standard_deep4_functions import (
     identity, safe_log, square, transpose_time_to_spat
 )
 from torch.nn import init
+from .domain_batch import domain_batch_norm, split_domains
 
 
 class EEG_Infinity(nn.Module):
@@ -15,7 +16,7 @@ class EEG_Infinity(nn.Module):
     '''
 
     def __init__(self, transfer_matrix_source, transfer_matrix_target, num_channels = 64, FIR_order=17, FIR_n=1,
-                 backbone_type='InceptionEEG', right_idx=None, left_idx=None):
+                 backbone_type='InceptionEEG', right_idx=None, left_idx=None, input_projected=False):
         super(EEG_Infinity, self).__init__()
 
         self.num_classes = 2
@@ -23,9 +24,9 @@ class EEG_Infinity(nn.Module):
 
         # define alignment heads for source domain
         self.alignment_head_source = Alignment_head(transfer_matrix=transfer_matrix_source,
-                                                    FIR_order=FIR_order, FIR_n=FIR_n)
+                                                    FIR_order=FIR_order, FIR_n=FIR_n, input_projected=input_projected)
         self.alignment_head_target = Alignment_head(transfer_matrix=transfer_matrix_target,
-                                                    FIR_order=FIR_order, FIR_n=FIR_n)
+                                                    FIR_order=FIR_order, FIR_n=FIR_n, input_projected=input_projected)
 
         # define features extractor
         if backbone_type == 'EEGNet':
@@ -76,6 +77,26 @@ class EEG_Infinity(nn.Module):
 
         return class_output, __feature0__, __feature1__, __feature2__
 
+    def forward_domains(self, source_data, target_data, alpha, domain_bn=True):
+        '''
+        forward() of a source and a target batch, with the shared layers run once on their concatenation.
+
+        :param domain_bn: if True, the BatchNorm layers normalize each domain with its own batch statistics (see
+                          domain_batch.py)
+        :return: the outputs of forward(source_data, 0, alpha) and of forward(target_data, 1, alpha)
+        '''
+        s_filter_output, _ = self.alignment_head_source(source_data.to(torch.float32))
+        t_filter_output, _ = self.alignment_head_target(target_data.to(torch.float32))
+        sizes = [len(source_data), len(target_data)]
+        filter_output = torch.cat([s_filter_output, t_filter_output])
+        with domain_batch_norm(self, sizes, enabled=domain_bn):
+            __feature0__ = self.feature(filter_output).view(-1, self.feature_map_size)
+            __feature1__ = self.class_classifier1(__feature0__)
+            __feature2__ = self.class_classifier2(__feature1__)
+            class_output = self.class_classifier3(__feature2__)
+
+        return split_domains([class_output, __feature0__, __feature1__, __feature2__], sizes)
+
 
 class depthwise_separable_conv(nn.Module):
     def __init__(self, nin, nout, kernel_size):
@@ -90,12 +111,19 @@ class depthwise_separable_conv(nn.Module):
 
 
 class Alignment_head(nn.Module):
-    def __init__(self, transfer_matrix, FIR_order=17, FIR_n=1):
+    # True when the data loader already applied channel_transfer_matrix_fixed (see my_utils/projection_cache.py)
+    input_projected = False
+
+    def __init__(self, transfer_matrix, FIR_order=17, FIR_n=1, input_projected=False):
         super(Alignment_head, self).__init__()
-        self.channel_transfer_matrix_fixed = transfer_matrix.cuda()
+        # a buffer, so that .to() and torch.load(map_location=...) move it with the model
+        self.register_buffer('channel_transfer_matrix_fixed', transfer_matrix)
+        self.input_projected = input_projected
 
     def forward(self, input_data):
         _input_data_ = input_data.to(torch.float32)
+        if self.input_projected:
+            return _input_data_, None
         _output_ = torch.matmul(self.channel_transfer_matrix_fixed, _input_data_)
         return _output_, None
 
@@ -247,7 +275,6 @@ class ShallowNetFeatureExtractor(nn.Module):
             init.zeros_(self.bnorm.bias)
 
     def forward(self, x):
-        x = x.type(torch.cuda.FloatTensor)
         x = x.permute(0, 2, 3, 1)
 
         features = self.feature_extractor(x)
@@ -416,7 +443,6 @@ class DeepNetFeatureExtractor(nn.Sequential):
 
     def forward(self, input_data):
         # Define the forward pass
-        input_data = input_data.type(torch.cuda.FloatTensor)
         input_data = input_data.permute(0, 2, 3, 1)
         features = self.feature_extractor(input_data)
         # print(features.shape)
@@ -552,7 +578,6 @@ class InceptionEEGFeatureExtractor(nn.Module):
         self.__hidden_len__ = __hidden_feature__.shape[1] * __hidden_feature__.shape[2] * __hidden_feature__.shape[3]
 
     def forward(self, input_data):
-        input_data = input_data.type(torch.cuda.FloatTensor)
         feature = self.feature(input_data)
         return feature
 
@@ -786,8 +811,8 @@ class EEGSymFeatureExtractor(nn.Module):
             EEGSym_residual_mini_block(18, 18, [5], [2]),
             nn.AvgPool3d(kernel_size=(1, 2, 1))
         )
-        self.Block4 = EEGSym_Channel_Merging_block(18, 18, 18, self.num_channels).cuda()
-        self.Block5 = EEGSym_Temporal_Merging_block(18, 18, 36, 6).cuda()
+        self.Block4 = EEGSym_Channel_Merging_block(18, 18, 18, self.num_channels)
+        self.Block5 = EEGSym_Temporal_Merging_block(18, 18, 36, 6)
         self.Block6 = nn.Sequential(
             EEGSym_residual_mini_block(36, 36, [1], [0]),
             EEGSym_residual_mini_block(36, 36, [1], [0]),
@@ -805,20 +830,11 @@ class EEGSymFeatureExtractor(nn.Module):
         )
 
     def forward(self, input_data):
-        input_data = input_data.type(torch.cuda.FloatTensor)
-        torch.cuda.empty_cache()
         output = self.sym_layer(input_data)
-        torch.cuda.empty_cache()
         output = self.Block1(output)
-        torch.cuda.empty_cache()
         output = self.Block2(output)
-        torch.cuda.empty_cache()
         output = self.Block3(output)
-        torch.cuda.empty_cache()
         output = self.Block4(output)
-        torch.cuda.empty_cache()
         output = self.Block5(output)
-        torch.cuda.empty_cache()
         output = self.Block6(output)
-        torch.cuda.empty_cache()
         return output
@@ -12,10 +12,11 @@ from .model_utils.model_standard_deep4_functions import (
     identity, safe_log, square, transpose_time_to_spat, squeeze_final_output
 )
 from torch.nn import init
+from .domain_batch import domain_batch_norm, split_domains
 
 class EEG_Infinity(nn.Module):
 
-    def __init__(self, transfer_matrix_source, transfer_matrix_target, num_channels = 64, FIR_order=17, FIR_n=1, backbone_type='InceptionEEG',right_idx=None, left_idx=None):
+    def __init__(self, transfer_matrix_source, transfer_matrix_target, num_channels = 64, FIR_order=17, FIR_n=1, backbone_type='InceptionEEG',right_idx=None, left_idx=None, input_projected=False):
         super(EEG_Infinity, self).__init__()
 
         self.num_classes = 2
@@ -23,9 +24,9 @@ class EEG_Infinity(nn.Module):
 
         # Defined the source domain alignment heads
         self.alignment_head_source = Alignment_head(transfer_matrix=transfer_matrix_source,
-                                                    FIR_order=FIR_order, FIR_n=FIR_n)
+                                                    FIR_order=FIR_order, FIR_n=FIR_n, input_projected=input_projected)
         self.alignment_head_target = Alignment_head(transfer_matrix=transfer_matrix_target,
-                                                    FIR_order=FIR_order, FIR_n=FIR_n)
+                                                    FIR_order=FIR_order, FIR_n=FIR_n, input_projected=input_projected)
         # Freeze the source domain's channel_transfer_matrix
         self.alignment_head_source.frozen_transfer_matrix()
 
@@ -88,6 +89,27 @@ class EEG_Infinity(nn.Module):
 
         return class_output, domain_output, filter_output, spatial_output
 
+    def forward_domains(self, source_data, target_data, alpha, domain_bn=True):
+        '''
+        forward() of a source and a target batch, with the shared layers run once on their concatenation.
+
+        :param domain_bn: if True, the BatchNorm layers normalize each domain with its own batch statistics (see
+                          domain_batch.py)
+        :return: the outputs of forward(source_data, 0, alpha) and of forward(target_data, 1, alpha)
+        '''
+        s_filter_output, s_spatial_output = self.alignment_head_source(source_data.to(torch.float32))
+        t_filter_output, t_spatial_output = self.alignment_head_target(target_data.to(torch.float32))
+        sizes = [len(source_data), len(target_data)]
+        filter_output = torch.cat([s_filter_output, t_filter_output])
+        with domain_batch_norm(self, sizes, enabled=domain_bn):
+            _feature_ = self.feature(self.channel_norm(filter_output)).view(-1, self.feature_map_size)
+            _reverse_feature_ = ReverseLayerF.apply(_feature_, alpha)
+            class_output = self.class_classifier(_feature_)
+            domain_output = self.domain_classifier(_reverse_feature_)
+
+        s_outputs, t_outputs = split_domains([class_output, domain_output], sizes)
+        return s_outputs + (s_filter_output, s_spatial_output), t_outputs + (t_filter_output, t_spatial_output)
+
 
 class ReverseLayerF(Function):
     @staticmethod
@@ -159,15 +181,21 @@ class FIR_convolution(nn.Module):
 
 
 class Alignment_head(nn.Module):
-    def __init__(self, transfer_matrix, FIR_order=17, FIR_n=1):
+    # True when the data loader already applied channel_transfer_matrix_fixed (see my_utils/projection_cache.py)
+    input_projected = False
+
+    def __init__(self, transfer_matrix, FIR_order=17, FIR_n=1, input_projected=False):
         super(Alignment_head, self).__init__()
         self.channel_transfer_matrix = nn.Parameter(torch.eye(transfer_matrix.size()[0]))
-        self.channel_transfer_matrix_fixed = transfer_matrix.cuda()
+        # a buffer, so that .to() and torch.load(map_location=...) move it with the model
+        self.register_buffer('channel_transfer_matrix_fixed', transfer_matrix)
+        self.input_projected = input_projected
         self.domain_filter = FIR_convolution(FIR_n, FIR_order)
 
     def forward(self, input_data):
         _input_data_ = input_data.to(torch.float32)
-        _input_data_ = torch.matmul(self.channel_transfer_matrix_fixed, _input_data_)
+        if not self.input_projected:
+            _input_data_ = torch.matmul(self.channel_transfer_matrix_fixed, _input_data_)
         output_spatial = torch.matmul(self.channel_transfer_matrix, _input_data_)
         output_filter = self.domain_filter(output_spatial)
         return output_filter, output_spatial
@@ -357,7 +385,6 @@ class ShallowNetFeatureExtractor(nn.Module):
             init.zeros_(self.bnorm.bias)
 
     def forward(self, x):
-        x = x.type(torch.cuda.FloatTensor)
         x = x.permute(0, 2, 3, 1)
         # Define the forward propagation
         features = self.feature_extractor(x)
@@ -525,7 +552,6 @@ class DeepNetFeatureExtractor(nn.Sequential):
 
     def forward(self, input_data):
         # Define the forward pass
-        input_data = input_data.type(torch.cuda.FloatTensor)
         input_data = input_data.permute(0, 2, 3, 1)
         features = self.feature_extractor(input_data)
         # print(features.shape)
@@ -659,7 +685,6 @@ class InceptionEEGFeatureExtractor(nn.Module):
         self.__hidden_len__ = __hidden_feature__.shape[1] * __hidden_feature__.shape[2] * __hidden_feature__.shape[3]
 
     def forward(self, input_data):
-        input_data = input_data.type(torch.cuda.FloatTensor)
         feature = self.feature(input_data)
         return feature
 
@@ -900,8 +925,8 @@ class EEGSymFeatureExtractor(nn.Module):
             EEGSym_residual_mini_block(18, 18, [5], [2]),
             nn.AvgPool3d(kernel_size=(1, 2, 1))
         )
-        self.Block4 = EEGSym_Channel_Merging_block(18, 18, 18, self.num_channels).cuda()
-        self.Block5 = EEGSym_Temporal_Merging_block(18, 18, 36, 6).cuda()
+        self.Block4 = EEGSym_Channel_Merging_block(18, 18, 18, self.num_channels)
+        self.Block5 = EEGSym_Temporal_Merging_block(18, 18, 36, 6)
         self.Block6 = nn.Sequential(
             EEGSym_residual_mini_block(36, 36, [1], [0]),
             EEGSym_residual_mini_block(36, 36, [1], [0]),
@@ -919,22 +944,13 @@ class EEGSymFeatureExtractor(nn.Module):
         )
 
     def forward(self, input_data):
-        input_data = input_data.type(torch.cuda.FloatTensor)
-        torch.cuda.empty_cache()
         output = self.sym_layer(input_data)
-        torch.cuda.empty_cache()
         output = self.Block1(output)
-        torch.cuda.empty_cache()
         output = self.Block2(output)
-        torch.cuda.empty_cache()
         output = self.Block3(output)
-        torch.cuda.empty_cache()
         output = self.Block4(output)
-        torch.cuda.empty_cache()
         output = self.Block5(output)
-        torch.cuda.empty_cache()
         output = self.Block6(output)
-        torch.cuda.empty_cache()
         return output
 
 
@@ -949,8 +965,9 @@ if __name__ == "__main__":
     a = scio.loadmat(os.path.join('config', 'transfer_62To64.mat'))['transform_matrix']
     transfer_matrix0 = torch.tensor(a).to(torch.float32)
     transfer_matrix1 = torch.eye(64, 64).to(torch.float32)
-    net = EEG_Infinity(transfer_matrix0, transfer_matrix1).cuda()
-    test = torch.rand(64, 1, 64, 384).cuda()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    net = EEG_Infinity(transfer_matrix0, transfer_matrix1).to(device)
+    test = torch.rand(64, 1, 64, 384).to(device)
     class_output, domain_output = net(input_data=test, domain=1, alpha=1)
     print(class_output.size())
     print(domain_output.size())
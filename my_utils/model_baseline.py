@@ -90,7 +90,7 @@ class depthwise_separable_conv(nn.Module):
 class Alignment_head(nn.Module):
     def __init__(self, transfer_matrix):
         super(Alignment_head, self).__init__()
-        self.channel_transfer_matrix_fixed = transfer_matrix.cuda()
+        self.register_buffer('channel_transfer_matrix_fixed', transfer_matrix)
 
     def forward(self, input_data):
         input_data = input_data.to(torch.float32)
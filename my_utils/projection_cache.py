@@ -0,0 +1,139 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+from .trial_store import StoreSplit
+
+'''
+Cache of fold arrays with the fixed channel projection already applied.
+
+Alignment_head multiplies every batch by channel_transfer_matrix_fixed (the CAR matrix, or a
+config/transformation_matrix_*.npy product for the target) in every training step and every evaluation epoch,
+although the matrix never changes during a run. project_list applies it once per fold file and returns a
+data_list pointing at the projected copy; the model is then built with input_projected=True so it skips the
+fixed matmul. Projected arrays are stored next to their source:
+
+    <split dir>/projectedData/<data file stem>_<key>.npy           for [data_file, label_file] lists
+    <store>/projected/<key>/{data,label}.npy, folds.npz             for trial_store.StoreSplit lists
+
+where key hashes the matrix and the identity (path, size, mtime) of the source file, so a new matrix or a
+re-generated fold file gives a new cache entry instead of a stale one.
+'''
+
+
+def matrix_to_numpy(matrix):
+    if hasattr(matrix, "detach"):
+        matrix = matrix.detach().cpu().numpy()
+    return np.ascontiguousarray(matrix, dtype=np.float32)
+
+
+def projection_key(matrix, source_file):
+    '''
+    :return: hex digest of the matrix values and the source file's path, size and mtime
+    '''
+    matrix = matrix_to_numpy(matrix)
+    stat = os.stat(source_file)
+    key = hashlib.blake2b(digest_size=12)
+    key.update(str(matrix.shape).encode())
+    key.update(matrix.tobytes())
+    key.update("{0}|{1}|{2}".format(os.path.abspath(source_file), stat.st_size, stat.st_mtime_ns).encode())
+    return key.hexdigest()
+
+
+def project_file(source_file, target_file, matrix, chunk_size=256):
+    '''
+    Write matrix @ trial for every trial of source_file (N, C, T) into target_file (N, C', T) as float32 (float16
+    for a float16 source, see storage_dtype.py), chunk by chunk so that the source can stay memory-mapped. The file is renamed into place when complete,
+    so concurrent jobs never read a half-written cache entry.
+    '''
+    matrix = matrix_to_numpy(matrix)
+    eeg_data = np.load(source_file, mmap_mode='r')
+    if eeg_data.shape[1] != matrix.shape[1]:
+        raise ValueError("{0} has {1} channels, the projection expects {2}".format(
+            source_file, eeg_data.shape[1], matrix.shape[1]))
+    os.makedirs(os.path.dirname(target_file), exist_ok=True)
+    tmp_file = target_file + ".{0}.tmp".format(os.getpid())
+    dtype = np.float16 if eeg_data.dtype == np.float16 else np.float32
+    projected = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype,
+                                          shape=(eeg_data.shape[0], matrix.shape[0], eeg_data.shape[2]))
+    for begin in range(0, eeg_data.shape[0], chunk_size):
+        chunk = np.asarray(eeg_data[begin:begin + chunk_size], dtype=np.float32)
+        projected[begin:begin + chunk_size] = np.matmul(matrix, chunk)
+    projected.flush()
+    del projected
+    os.replace(tmp_file, target_file)
+    return target_file
+
+
+def project_list(data_root, data_list, matrix):
+    '''
+    Projected counterpart of a data_list ([data_file, label_file] or a trial_store.StoreSplit), computed on the
+    first call and read from the cache afterwards.
+
+    :return: a data_list of the same kind for EEGDataSet / test(), relative to data_root. An identity matrix
+             returns data_list itself.
+    '''
+    matrix = matrix_to_numpy(matrix)
+    if matrix.shape[0] == matrix.shape[1] and np.array_equal(matrix, np.eye(matrix.shape[0], dtype=np.float32)):
+        # nothing to apply (e.g. the identity source matrix of DDC/DeepCoral)
+        return data_list
+    if isinstance(data_list, str):
+        raise ValueError("{0} is a shard directory, convert the fold files before sharding them".format(data_list))
+    if isinstance(data_list, StoreSplit):
+        return project_store(data_root, data_list, matrix)
+    data_file, label_file = data_list
+    key = projection_key(matrix, os.path.join(data_root, data_file))
+    stem = os.path.splitext(os.path.basename(data_file))[0]
+    projected_file = os.path.join(os.path.dirname(data_file), "projectedData", "{0}_{1}.npy".format(stem, key))
+    if not os.path.exists(os.path.join(data_root, projected_file)):
+        project_file(os.path.join(data_root, data_file), os.path.join(data_root, projected_file), matrix)
+    return [projected_file, label_file]
+
+
+def project_store(data_root, store_split, matrix):
+    '''
+    Project a whole trial store once; every fold and split of it then reads the projected store.
+    '''
+    store = os.path.join(data_root, store_split.store)
+    key = projection_key(matrix, os.path.join(store, "data.npy"))
+    projected_store = os.path.join(store_split.store, "projected", key)
+    root = os.path.join(data_root, projected_store)
+    if not os.path.exists(os.path.join(root, "data.npy")):
+        os.makedirs(root, exist_ok=True)
+        for name in ["label.npy", "folds.npz"]:
+            shutil.copyfile(os.path.join(store, name), os.path.join(root, name))
+        with open(os.path.join(root, "meta.json"), "w") as f:
+            json.dump({"source": os.path.abspath(store), "matrix_shape": list(matrix_to_numpy(matrix).shape)}, f,
+                      indent=2)
+        # data.npy is written last: its presence marks a complete entry
+        project_file(os.path.join(store, "data.npy"), os.path.join(root, "data.npy"), matrix)
+    return StoreSplit(projected_store, store_split.fold, store_split.split)
+
+
+def project_lists(data_root, data_lists, matrix):
+    '''
+    :return: [project_list(data_root, data_list, matrix) for data_list in data_lists]
+    '''
+    return [project_list(data_root, data_list, matrix) for data_list in data_lists]
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    # check that a projected fold file gives the same model input as the fixed matmul in Alignment_head
+    rng = np.random.RandomState(0)
+    matrix = rng.randn(22, 64).astype(np.float32)
+    with tempfile.TemporaryDirectory() as data_root:
+        os.makedirs(os.path.join(data_root, "train"))
+        np.save(os.path.join(data_root, "train", "cross_0_data.npy"), rng.randn(50, 64, 384))
+        np.save(os.path.join(data_root, "train", "cross_0_label.npy"), rng.randint(0, 2, 50))
+        data_list = [os.path.join("train", "cross_0_data.npy"), os.path.join("train", "cross_0_label.npy")]
+        projected_list = project_list(data_root, data_list, matrix)
+        assert project_list(data_root, data_list, matrix) == projected_list
+        raw = np.load(os.path.join(data_root, data_list[0])).astype(np.float32)
+        projected = np.load(os.path.join(data_root, projected_list[0]))
+        print(projected_list)
+        print("shape {0} -> {1}, max abs error {2:.2e}".format(
+            raw.shape, projected.shape, np.abs(np.matmul(matrix, raw) - projected).max()))
@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+'''
+Concurrent runner of the (task, backbone) grids of the run_scripts_*.py files.
+
+A job is a (script_path, work_dir, cmd_args) entry of scripts_to_run. run_jobs() keeps up to n_jobs of them
+running at once:
+
+- each job gets its own cores_per_job CPU cores (pinned with sched_setaffinity, and --cpu_threads for torch), and
+  a job is only started while the memory available on the machine (MemAvailable, read again before every launch,
+  less memory_per_job for each job started since the last poll, which has not allocated its memory yet) still
+  holds memory_per_job. This is an admission rule, not a limit: a job using more than memory_per_job, or another
+  process, can still run the machine out of memory;
+- with gpus, the jobs are placed on the listed GPUs in turn (CUDA_VISIBLE_DEVICES), at most jobs_per_gpu each;
+- the output of a job goes to logs/jobs/<job id>.log, the job id being its --cache_prefix;
+- a failed job is run again up to retries times, and does not stop the other jobs;
+- the state of every job is kept in a json file (record/<script>_jobs.json by default): started again, the
+  grid skips the jobs that are done.
+
+    python run_scripts_DANN.py --n_jobs 8 --cores_per_job 4 --memory_per_job 8 --gpus 0,1
+
+With --in_process 1 the jobs run one after the other inside the scheduler process instead (see job_runner.py).
+'''
+
+DONE, FAILED = 'done', 'failed'
+
+
+def get_parser(description='Run the jobs of the grid concurrently.'):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--n_jobs', default='1', help='jobs running at the same time')
+    parser.add_argument('--cores_per_job', default=None, help='CPU cores of a job (default: the cores divided by n_jobs)')
+    parser.add_argument('--memory_per_job', default='0', help='GB of memory a job needs; a job is only started while the available memory of the machine holds it (0: no check)')
+    parser.add_argument('--gpus', default=None, help='comma separated GPU ids the jobs are placed on, e.g. 0,1 (default: no placement)')
+    parser.add_argument('--jobs_per_gpu', default='1', help='jobs running at the same time on one GPU')
+    parser.add_argument('--retries', default='1', help='times a failed job is run again')
+    parser.add_argument('--state_file', default=None, help='json file with the state of the jobs (default: record/<script>_jobs.json)')
+    parser.add_argument('--in_process', default='0', help='if 1, run the jobs one after the other in this process, importing the libraries and reading the shared npy files once (see my_utils/job_runner.py)')
+    parser.add_argument('--cache_gb', default=None, help='with --in_process, largest size in GB of the npy files kept in memory between the jobs (default: no limit)')
+    parser.add_argument('--log_dir', default=os.path.join('logs', 'jobs'), help='directory of the job logs')
+    return parser
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def available_memory():
+    '''
+    :return: GB of memory available to new processes (MemAvailable, which counts the reclaimable page cache),
+             None if unknown
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024 ** 2
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') / 1024 ** 3
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def default_state_file():
+    return os.path.join('record', os.path.splitext(os.path.basename(sys.argv[0]))[0] + '_jobs.json')
+
+
+def job_id(job):
+    script_path, work_dir, cmd_args = job
+    if '--cache_prefix' in cmd_args:
+        return cmd_args[cmd_args.index('--cache_prefix') + 1]
+    return ' '.join([script_path] + list(cmd_args))
+
+
+class JobState(object):
+    '''
+    {job id: {"status", "attempts", "returncode", "seconds"}} of a grid, written to path after every change.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.jobs = json.load(f)
+
+    def done(self, name):
+        return self.jobs.get(name, {}).get('status') == DONE
+
+    def attempts(self, name):
+        return self.jobs.get(name, {}).get('attempts', 0)
+
+    def update(self, name, **entries):
+        self.jobs.setdefault(name, {}).update(entries)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.jobs, f, indent=1, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class RunningJob(object):
+    def __init__(self, job, name, cores, gpu, log_dir):
+        script_path, work_dir, cmd_args = job
+        self.job, self.name, self.cores, self.gpu = job, name, cores, gpu
+        self.start = time.time()
+        command = [sys.executable, script_path] + list(cmd_args)
+        env = dict(os.environ)
+        if cores:
+            command += ['--cpu_threads', str(len(cores))]
+            env['OMP_NUM_THREADS'] = env['MKL_NUM_THREADS'] = str(len(cores))
+        if gpu is not None:
+            env['CUDA_VISIBLE_DEVICES'] = str(gpu)
+        os.makedirs(log_dir, exist_ok=True)
+        self.log = open(os.path.join(log_dir, name + '.log'), 'a')
+        self.log.write('==== {0} {1}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), ' '.join(command)))
+        self.log.flush()
+        pin = (lambda: os.sched_setaffinity(0, cores)) if cores and hasattr(os, 'sched_setaffinity') else None
+        self.process = subprocess.Popen(command, cwd=work_dir, env=env, stdout=self.log, stderr=subprocess.STDOUT,
+                                        preexec_fn=pin)
+
+    def poll(self):
+        returncode = self.process.poll()
+        if returncode is not None:
+            self.log.close()
+        return returncode
+
+
+def run_jobs(jobs, n_jobs=1, cores_per_job=None, memory_per_job=0, gpus=None, jobs_per_gpu=1, retries=1,
+             state_file=None, log_dir=os.path.join('logs', 'jobs'), poll_interval=5):
+    '''
+    Run the (script_path, work_dir, cmd_args) jobs, n_jobs at a time; see the module docstring.
+
+    :param gpus: list of GPU ids, None to leave the GPUs to the jobs
+    :return: the ids of the jobs that failed on every attempt
+    '''
+    state = JobState(state_file or default_state_file())
+    cores = available_cores()
+    if cores_per_job is None:
+        cores_per_job = max(1, len(cores) // n_jobs)
+    # the cores are split in n_jobs disjoint sets if there are enough of them
+    core_sets = [cores[k * cores_per_job:(k + 1) * cores_per_job] for k in range(n_jobs)] \
+        if cores_per_job * n_jobs <= len(cores) else [None] * n_jobs
+
+    pending = [job for job in jobs if not state.done(job_id(job))]
+    print('{0} jobs, {1} already done, {2} at a time'.format(len(jobs), len(jobs) - len(pending), n_jobs))
+    running, failed = [], []
+    # attempts of this launch, the state file counts those of all launches
+    tries = {}
+    try:
+        while pending or running:
+            # start the jobs that fit; the jobs started in this round have not allocated their memory yet
+            reserved = 0
+            while pending and len(running) < n_jobs:
+                if memory_per_job and running:
+                    memory = available_memory()
+                    if memory is not None and memory - reserved < memory_per_job:
+                        break
+                gpu = None
+                if gpus:
+                    load = {g: sum(1 for job in running if job.gpu == g) for g in gpus}
+                    gpu = min(gpus, key=lambda g: load[g])
+                    if load[gpu] >= jobs_per_gpu:
+                        break
+                used = [job.cores for job in running]
+                slot = next(core_set for core_set in core_sets if core_set is None or core_set not in used)
+                job = pending.pop(0)
+                name = job_id(job)
+                tries[name] = tries.get(name, 0) + 1
+                state.update(name, status='running', attempts=state.attempts(name) + 1)
+                print('start {0} (attempt {1})'.format(name, state.attempts(name)))
+                running.append(RunningJob(job, name, slot, gpu, log_dir))
+                reserved += memory_per_job
+
+            time.sleep(poll_interval)
+            for job in list(running):
+                returncode = job.poll()
+                if returncode is None:
+                    continue
+                running.remove(job)
+                seconds = round(time.time() - job.start)
+                if returncode == 0:
+                    state.update(job.name, status=DONE, returncode=0, seconds=seconds)
+                    print('done {0} in {1} s'.format(job.name, seconds))
+                else:
+                    state.update(job.name, status=FAILED, returncode=returncode, seconds=seconds)
+                    print('failed {0} with code {1}, see {2}'.format(job.name, returncode,
+                                                                    os.path.join(log_dir, job.name + '.log')))
+                    if tries[job.name] <= retries:
+                        pending.append(job.job)
+                    else:
+                        failed.append(job.name)
+    finally:
+        # interrupted: do not leave the running jobs behind
+        for job in running:
+            job.process.terminate()
+    if failed:
+        print('{0} jobs failed: {1}'.format(len(failed), ', '.join(failed)))
+    return failed
+
+
+def run_grid(scripts_to_run, argv=None):
+    '''
+    The entry point of the run_scripts_*.py files: run_jobs with the options of the command line.
+    '''
+    args = get_parser().parse_args(argv)
+    if args.in_process == '1':
+        if int(args.n_jobs) > 1:
+            raise ValueError("--in_process runs one job at a time, it does not go with --n_jobs")
+        from .job_runner import run_jobs_in_process
+        failed = run_jobs_in_process(scripts_to_run, retries=int(args.retries), state_file=args.state_file,
+                                     log_dir=args.log_dir, cache_gb=float(args.cache_gb) if args.cache_gb else None)
+        if failed:
+            raise SystemExit(1)
+        return
+    failed = run_jobs(scripts_to_run, n_jobs=int(args.n_jobs),
+                      cores_per_job=int(args.cores_per_job) if args.cores_per_job else None,
+                      memory_per_job=float(args.memory_per_job),
+                      gpus=args.gpus.split(',') if args.gpus else None, jobs_per_gpu=int(args.jobs_per_gpu),
+                      retries=int(args.retries), state_file=args.state_file, log_dir=args.log_dir)
+    if failed:
+        raise SystemExit(1)
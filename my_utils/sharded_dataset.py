@@ -0,0 +1,246 @@
+import os
+import json
+import numpy as np
+import torch
+import torch.utils.data as data
+
+from .trial_store import SPLITS
+
+'''
+Chunked on-disk format for corpora that do not fit in memory.
+
+A sharded split is a directory of fixed-size npy shards plus a JSON index:
+
+    <name>.shards/index.json                 trial shape, dtype, shard size and the shard list
+    <name>.shards/shard_00000_data.npy       (shard_size, C, T) trials
+    <name>.shards/shard_00000_label.npy      (shard_size,) labels
+    ...
+
+ShardedEEGDataset streams it: shards are read one after the other (shuffled at shard level every epoch and
+split between the DataLoader workers), and trials are shuffled through a bounded buffer, so memory use is one
+shard plus the buffer whatever the size of the split. The path of the shard directory (or of its index.json)
+is used as data_list, see data_loader_npy.open_eeg_dataset.
+'''
+
+INDEX_FILE = "index.json"
+
+
+class ShardWriter(object):
+    '''
+    Write trials into a shard directory chunk by chunk, so that the split never has to be in memory at once:
+
+        with ShardWriter(out_dir, shard_size=512) as writer:
+            for eeg_data, eeg_labels in chunks:
+                writer.add(eeg_data, eeg_labels)
+    '''
+    def __init__(self, out_dir, shard_size=512):
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        self.shards = []
+        self.pending_data = []
+        self.pending_labels = []
+        self.n_pending = 0
+        self.trial_shape = None
+        self.dtype = None
+        os.makedirs(out_dir, exist_ok=True)
+
+    def add(self, eeg_data, eeg_labels):
+        if self.trial_shape is None:
+            self.trial_shape = list(eeg_data.shape[1:])
+            self.dtype = str(eeg_data.dtype)
+        elif list(eeg_data.shape[1:]) != self.trial_shape:
+            raise ValueError("trials of shape {0} do not match {1}".format(eeg_data.shape[1:], self.trial_shape))
+        self.pending_data.append(np.asarray(eeg_data, dtype=self.dtype))
+        self.pending_labels.append(np.asarray(eeg_labels))
+        self.n_pending += len(eeg_labels)
+        while self.n_pending >= self.shard_size:
+            self._flush(self.shard_size)
+
+    def _flush(self, n):
+        eeg_data = np.concatenate(self.pending_data)
+        eeg_labels = np.concatenate(self.pending_labels)
+        name = "shard_{0:05d}".format(len(self.shards))
+        np.save(os.path.join(self.out_dir, name + "_data.npy"), eeg_data[:n])
+        np.save(os.path.join(self.out_dir, name + "_label.npy"), eeg_labels[:n])
+        self.shards.append({"data": name + "_data.npy", "label": name + "_label.npy", "n_trials": int(n)})
+        self.pending_data = [eeg_data[n:]]
+        self.pending_labels = [eeg_labels[n:]]
+        self.n_pending -= n
+
+    def close(self):
+        if self.n_pending:
+            self._flush(self.n_pending)
+        # the index is written last: a directory with an index.json is complete
+        with open(os.path.join(self.out_dir, INDEX_FILE), "w") as f:
+            json.dump({"n_trials": int(sum(shard["n_trials"] for shard in self.shards)),
+                       "shard_size": self.shard_size,
+                       "trial_shape": self.trial_shape,
+                       "dtype": self.dtype,
+                       "shards": self.shards}, f, indent=2)
+        return self.out_dir
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+def shard_files(data_root, data_lists, out_dir, shard_size=512, chunk_size=256):
+    '''
+    Concatenate the [data_file, label_file] pairs of data_lists into one shard directory, reading each file
+    memory-mapped chunk by chunk.
+    '''
+    with ShardWriter(os.path.join(data_root, out_dir), shard_size=shard_size) as writer:
+        for data_file, label_file in data_lists:
+            eeg_data = np.load(os.path.join(data_root, data_file), mmap_mode='r')
+            eeg_labels = np.load(os.path.join(data_root, label_file), mmap_mode='r')
+            for begin in range(0, eeg_labels.shape[0], chunk_size):
+                writer.add(eeg_data[begin:begin + chunk_size], eeg_labels[begin:begin + chunk_size])
+    return out_dir
+
+
+def shard_dir(dataset_path, split, cross_id, datafile_name):
+    return os.path.join(dataset_path, "concatedData", split,
+                        "cross_{0}_".format(cross_id) + os.path.splitext(datafile_name)[0] + ".shards")
+
+
+def fold_shard_lists(dataset_path, datafile_name, cross_id):
+    '''
+    :return: [train, eval, test] shard directories of fold cross_id, ready to replace the *_train/eval/test_list.
+    '''
+    return [shard_dir(dataset_path, split, cross_id, datafile_name) for split in SPLITS]
+
+
+def is_sharded(data_list):
+    return isinstance(data_list, str)
+
+
+def read_index(data_root, data_list):
+    '''
+    :return: the shard directory and its index, data_list being the directory or its index.json
+    '''
+    path = os.path.join(data_root, data_list)
+    if os.path.basename(path) == INDEX_FILE:
+        path = os.path.dirname(path)
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        return path, json.load(f)
+
+
+class ShardedEEGDataset(data.IterableDataset):
+    '''
+    Streaming counterpart of EEGDataSet over a shard directory. Each item is (eeg (1, C, datalen), 1, label)
+    like EEGDataSet.__getitem__, so DataLoader(batch_size=B) collates the usual (B, 1, C, datalen) batches.
+
+    :param shuffle: if True, every epoch visits the shards in a new order and passes the trials through a
+                    shuffle buffer of buffer_size trials; if False, the trials come in stored order.
+    :param random_crop: None or 'trial' (random window start per trial, see EEGDataSet)
+    :param n_crops: evenly spaced evaluation windows per trial, items are then (n_crops, 1, C, datalen)
+    '''
+    def __init__(self, data_root, data_list, start=0, datalen=256, num_channel=64, shuffle=False,
+                 buffer_size=4096, random_crop=None, n_crops=1, batch_dtype=None):
+        self.root, self.index = read_index(data_root, data_list)
+        self.start = start
+        self.datalen = datalen
+        self.num_channel = num_channel
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        if random_crop not in (None, 'trial'):
+            raise ValueError("a streamed split can only be cropped per trial")
+        self.random_crop = random_crop
+        self.n_crops = n_crops
+        self.batch_dtype = None if batch_dtype is None else np.dtype(batch_dtype)
+        self.max_offset = self.index["trial_shape"][-1] - start - datalen
+        if self.max_offset < 0:
+            raise ValueError("stored trials have {0} samples, shorter than start + datalen = {1}".format(
+                self.index["trial_shape"][-1], start + datalen))
+        self.n_data = self.index["n_trials"]
+
+    def __len__(self):
+        # with several workers each one may end on its own partial batch, so an epoch can give up to
+        # num_workers - 1 batches more than len(DataLoader); the training loops stop at len() anyway
+        return self.n_data
+
+    def _epoch_seed(self):
+        worker_info = data.get_worker_info()
+        if worker_info is None:
+            return int(torch.randint(0, 2 ** 31, (1,))), 0, 1
+        # worker seeds are base_seed + worker id, base_seed being drawn once per epoch by the DataLoader:
+        # every worker recovers the same shard order and takes its own share of it
+        return (worker_info.seed - worker_info.id) % 2 ** 31, worker_info.id, worker_info.num_workers
+
+    def _trials(self, shard_ids, rng):
+        for shard_id in shard_ids:
+            shard = self.index["shards"][shard_id]
+            eeg_data = np.load(os.path.join(self.root, shard["data"]), mmap_mode='r')
+            eeg_labels = np.load(os.path.join(self.root, shard["label"]))
+            for i in range(shard["n_trials"]):
+                if self.n_crops > 1:
+                    offsets = self.start + np.round(np.linspace(0, self.max_offset, self.n_crops)).astype(np.int64)
+                    eeg = np.stack([eeg_data[i, :, offset:offset + self.datalen] for offset in offsets])
+                    eeg = np.expand_dims(eeg, axis=1)
+                else:
+                    offset = self.start
+                    if self.random_crop == 'trial':
+                        offset += int(rng.integers(0, self.max_offset + 1))
+                    # copy the window out of the map so the shard can be released once it is consumed
+                    eeg = np.array(eeg_data[i:i + 1, :, offset:offset + self.datalen])
+                if self.batch_dtype is not None:
+                    eeg = eeg.astype(self.batch_dtype, copy=False)
+                yield torch.from_numpy(eeg), 1, int(eeg_labels[i])
+
+    def __iter__(self):
+        seed, worker_id, num_workers = self._epoch_seed()
+        n_shards = len(self.index["shards"])
+        if self.shuffle:
+            order = np.random.default_rng(seed).permutation(n_shards)
+        else:
+            order = np.arange(n_shards)
+        rng = np.random.default_rng([seed, worker_id])
+        trials = self._trials(order[worker_id::num_workers], rng)
+        if not self.shuffle:
+            yield from trials
+            return
+        buffer = []
+        for trial in trials:
+            if len(buffer) < self.buffer_size:
+                buffer.append(trial)
+                continue
+            j = int(rng.integers(0, self.buffer_size))
+            yield buffer[j]
+            buffer[j] = trial
+        for j in rng.permutation(len(buffer)):
+            yield buffer[j]
+
+    def trials(self):
+        '''
+        :return: all stored trials, (N, C, T). This reads the whole split into memory (EA/RA need it).
+        '''
+        return np.concatenate([np.load(os.path.join(self.root, shard["data"]))
+                               for shard in self.index["shards"]])
+
+
+if __name__ == "__main__":
+    import configparser
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Write the concatedData folds of a task as shard directories.')
+    parser.add_argument('--config', default='config_PhysioNetMIToMengExp3.ini', help='Path to the config.ini file')
+    parser.add_argument('--data_root', default=os.path.join(os.path.pardir, os.path.pardir, "EEGData"), help='root of the datasets')
+    parser.add_argument('--shard_size', default=512, type=int, help='trials per shard')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join("hyperparameters", args.config))
+    for domain in ['source', 'target']:
+        dataset_path = config.get('settings', domain + '_path')
+        datafile_name = config.get('settings', domain + '_datafile_name')
+        labelfile_name = config.get('settings', domain + '_labelfile_name')
+        for cross_id in range(config.getint('settings', 'NFold')):
+            for split, out_dir in zip(SPLITS, fold_shard_lists(dataset_path, datafile_name, cross_id)):
+                split_dir = os.path.join(dataset_path, "concatedData", split)
+                shard_files(args.data_root, [[os.path.join(split_dir, "cross_{0}_".format(cross_id) + datafile_name),
+                                              os.path.join(split_dir, "cross_{0}_".format(cross_id) + labelfile_name)]],
+                            out_dir, shard_size=args.shard_size)
+                print(out_dir)
@@ -0,0 +1,117 @@
+import os
+import copy
+import queue
+import logging
+import threading
+import torch
+
+'''
+Validation of the per-epoch model snapshots, in line or on a background thread.
+
+The training scripts evaluate my_net on the source and the target validation sets after every epoch, keep the
+best accuracy of each and torch.save the model that reached it. BestModelTracker does that bookkeeping.
+SnapshotEvaluator copies the weights of my_net at the end of an epoch and evaluates the copy on a worker thread
+while the next epoch trains; best-model selection and saving then follow the snapshot results as they arrive.
+'''
+
+logger = logging.getLogger(__name__)
+
+
+class BestModelTracker(object):
+    '''
+    Keep the best source/target validation accuracy of a fold and save the model that reached it to
+    models/<cache_prefix>_cross_id_<cross_id>_best_<source|target>_model.pth.
+    '''
+    def __init__(self, model_root, cache_prefix, cross_id, writer=None):
+        self.model_root = model_root
+        self.cache_prefix = cache_prefix
+        self.cross_id = cross_id
+        self.writer = writer
+        self.best_acc = {"Source": 0.0, "Target": 0.0}
+        self.best_index = {"Source": 0, "Target": 0}
+        self.lock = threading.Lock()
+
+    def model_file(self, domain_name):
+        return os.path.join(self.model_root, self.cache_prefix + '_cross_id_{0}_best_{1}_model.pth'.format(
+            self.cross_id, domain_name.lower()))
+
+    def update(self, epoch, acc_source, acc_target, model):
+        with self.lock:
+            for domain_name, acc in [("Source", acc_source), ("Target", acc_target)]:
+                logger.info('Cross: %d, Epoch: %d. Accuracy of the %s validation set: %f' % (self.cross_id, epoch, domain_name, acc))
+                if self.writer is not None:
+                    self.writer.add_scalar('%s Validation Set Accuracy' % domain_name, acc, epoch)
+            for domain_name, acc in [("Source", acc_source), ("Target", acc_target)]:
+                if acc > self.best_acc[domain_name]:
+                    self.best_acc[domain_name] = acc
+                    self.best_index[domain_name] = epoch
+                    torch.save(model, self.model_file(domain_name))
+
+
+class SnapshotEvaluator(object):
+    '''
+    Evaluate snapshots of a model on a worker thread and report them to a BestModelTracker in epoch order.
+
+    submit() deep-copies the model (the copy has no gradients and is what gets saved if it is the best) and
+    returns at once; at most max_pending snapshots wait, after which submit() blocks so that a slow evaluation
+    cannot pile up copies. On CUDA the worker runs its forwards on its own stream, so they can overlap with the
+    training kernels. drain() waits for all submitted snapshots and re-raises an error of the worker.
+    '''
+    def __init__(self, source_evaluator, target_evaluator, tracker, max_pending=2):
+        self.source_evaluator = source_evaluator
+        self.target_evaluator = target_evaluator
+        self.tracker = tracker
+        self.snapshots = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def _evaluate(self, epoch, snapshot):
+        acc_source = self.source_evaluator.evaluate(snapshot, domain=0)
+        acc_target = self.target_evaluator.evaluate(snapshot, domain=1)
+        self.tracker.update(epoch, acc_source, acc_target, snapshot)
+
+    def _run(self):
+        stream = None
+        while True:
+            item = self.snapshots.get()
+            try:
+                if item is None:
+                    return
+                if self.error is not None:
+                    continue
+                epoch, snapshot = item
+                device = next(snapshot.parameters()).device
+                if device.type == 'cuda':
+                    if stream is None:
+                        stream = torch.cuda.Stream(device=device)
+                    with torch.cuda.stream(stream):
+                        self._evaluate(epoch, snapshot)
+                    stream.synchronize()
+                else:
+                    self._evaluate(epoch, snapshot)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.snapshots.task_done()
+
+    def submit(self, model, epoch):
+        if self.error is not None:
+            raise self.error
+        snapshot = copy.deepcopy(model)
+        for param in snapshot.parameters():
+            param.grad = None
+        if next(snapshot.parameters()).device.type == 'cuda':
+            # the copy was made on the training stream, the worker's stream must not read it earlier
+            torch.cuda.current_stream().synchronize()
+        self.snapshots.put((epoch, snapshot))
+
+    def drain(self):
+        self.snapshots.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.drain()
+        self.snapshots.put(None)
+        self.worker.join()
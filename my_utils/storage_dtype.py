@@ -0,0 +1,173 @@
+import os
+import shutil
+import numpy as np
+import torch
+
+from .trial_store import StoreSplit, SPLITS
+
+'''
+Compact storage dtype for the EEG arrays.
+
+Most fold files are float64 on disk while the models compute in float32, so every trial is read, kept in memory
+and shipped to the device at twice (or, with float16, four times) the size it needs. convert_file rewrites a file
+as float32 or float16 next to the original:
+
+    <split dir>/<data file stem>_<dtype>.npy        for [data_file, label_file] lists
+    <store>_<dtype>/{data,label}.npy, folds.npz      for trial_store.StoreSplit lists
+
+EEGDataSet(..., batch_dtype='float32') then keeps the compact array and only upcasts the gathered batch.
+compare_storage_accuracy checks that a trained model gives the same predictions on the compact copy as on the
+float64 original.
+'''
+
+STORAGE_DTYPES = ('float64', 'float32', 'float16')
+
+
+def storage_file(data_file, dtype):
+    return "{0}_{1}.npy".format(os.path.splitext(data_file)[0], dtype)
+
+
+def convert_file(source_file, target_file, dtype, chunk_size=256):
+    '''
+    Write source_file as dtype into target_file, chunk by chunk from a memory map. Raises ValueError when a
+    value does not fit in dtype (float16 overflows above 65504), instead of silently storing inf.
+    '''
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError("dtype must be one of {0}".format(STORAGE_DTYPES))
+    eeg_data = np.load(source_file, mmap_mode='r')
+    max_value = np.finfo(dtype).max
+    tmp_file = target_file + ".{0}.tmp".format(os.getpid())
+    converted = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype, shape=eeg_data.shape)
+    try:
+        for begin in range(0, eeg_data.shape[0], chunk_size):
+            chunk = np.asarray(eeg_data[begin:begin + chunk_size])
+            if np.abs(chunk).max() > max_value:
+                raise ValueError("{0} has values beyond the {1} range".format(source_file, dtype))
+            converted[begin:begin + chunk_size] = chunk
+        converted.flush()
+    except ValueError:
+        del converted
+        os.remove(tmp_file)
+        raise
+    del converted
+    os.replace(tmp_file, target_file)
+    return target_file
+
+
+def storage_list(data_root, data_list, dtype):
+    '''
+    data_list ([data_file, label_file] or a trial_store.StoreSplit) pointing at the dtype copy of its data,
+    which is converted on the first call. 'float64' returns data_list itself.
+    '''
+    if dtype == 'float64':
+        return data_list
+    if isinstance(data_list, str):
+        raise ValueError("{0} is a shard directory, convert the fold files before sharding them".format(data_list))
+    if isinstance(data_list, StoreSplit):
+        store = os.path.join(data_root, data_list.store)
+        compact_store = "{0}_{1}".format(data_list.store.rstrip(os.sep), dtype)
+        root = os.path.join(data_root, compact_store)
+        if not os.path.exists(os.path.join(root, "data.npy")):
+            os.makedirs(root, exist_ok=True)
+            for name in ["label.npy", "folds.npz", "meta.json"]:
+                if os.path.exists(os.path.join(store, name)):
+                    shutil.copyfile(os.path.join(store, name), os.path.join(root, name))
+            convert_file(os.path.join(store, "data.npy"), os.path.join(root, "data.npy"), dtype)
+        return StoreSplit(compact_store, data_list.fold, data_list.split)
+    data_file, label_file = data_list
+    compact_file = storage_file(data_file, dtype)
+    if not os.path.exists(os.path.join(data_root, compact_file)):
+        convert_file(os.path.join(data_root, data_file), os.path.join(data_root, compact_file), dtype)
+    return [compact_file, label_file]
+
+
+def storage_lists(data_root, data_lists, dtype):
+    '''
+    :return: [storage_list(data_root, data_list, dtype) for data_list in data_lists]
+    '''
+    return [storage_list(data_root, data_list, dtype) for data_list in data_lists]
+
+
+def convert_concated_data(data_root, dataset_path, datafile_name, n_fold, dtype):
+    '''
+    Convert every concatedData/{train,eval,test}/cross_<id>_<datafile_name> of a dataset.
+
+    :return: the converted files, relative to data_root
+    '''
+    converted = []
+    for cross_id in range(n_fold):
+        for split in SPLITS:
+            data_file = os.path.join(dataset_path, "concatedData", split, "cross_{0}_".format(cross_id) + datafile_name)
+            converted.append(storage_list(data_root, [data_file, None], dtype)[0])
+    return converted
+
+
+def compare_storage_accuracy(torch_model, data_root, data_list, dtype, domain, datalen=384, batch_size=64,
+                             device=None):
+    '''
+    Run a trained model over the original and the dtype copy of a split in lockstep.
+
+    :return: dict with the accuracy on both, the fraction of equal predictions and the largest logit difference
+    '''
+    from .data_loader_npy import EEGDataSet, make_batch_loader
+    from .backend import default_device
+
+    device = device or default_device()
+    if isinstance(torch_model, str):
+        my_net = torch.load(torch_model, weights_only=False, map_location=device)
+    else:
+        my_net = torch_model
+    my_net = my_net.to(device).eval()
+    loaders = [make_batch_loader(EEGDataSet(data_root=data_root, data_list=split_list, datalen=datalen,
+                                            batch_dtype='float32'), batch_size=batch_size)
+               for split_list in [data_list, storage_list(data_root, data_list, dtype)]]
+    n_total = 0
+    n_correct = np.zeros(2, dtype=np.int64)
+    n_agree = 0
+    max_logit_diff = 0.0
+    with torch.no_grad():
+        for (eeg, _, label), (eeg_compact, _, _) in zip(*loaders):
+            label = label.to(device)
+            outputs = [my_net(input_data=x.to(device), domain=domain, alpha=0)[0] for x in [eeg, eeg_compact]]
+            preds = [output.argmax(dim=1) for output in outputs]
+            n_correct += np.array([int((pred == label).sum()) for pred in preds])
+            n_agree += int((preds[0] == preds[1]).sum())
+            max_logit_diff = max(max_logit_diff, float((outputs[0] - outputs[1]).abs().max()))
+            n_total += len(label)
+    return {"accuracy_float64": float(n_correct[0]) / n_total,
+            "accuracy_" + dtype: float(n_correct[1]) / n_total,
+            "prediction_agreement": n_agree / n_total,
+            "max_logit_diff": max_logit_diff}
+
+
+if __name__ == "__main__":
+    import configparser
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Rewrite the fold files of a task in a compact dtype.')
+    parser.add_argument('--config', default='config_PhysioNetMIToMengExp3.ini', help='Path to the config.ini file')
+    parser.add_argument('--data_root', default=os.path.join(os.path.pardir, os.path.pardir, "EEGData"), help='root of the datasets')
+    parser.add_argument('--dtype', default='float32', help='float32 or float16')
+    parser.add_argument('--cache_prefix', default='', help='if given, compare the accuracy of its best models (models/<cache_prefix>_cross_id_<id>_best_<domain>_model.pth) on the original and the converted test sets')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join("hyperparameters", args.config))
+    NFold = config.getint('settings', 'NFold')
+    for domain_id, domain in enumerate(['source', 'target']):
+        for data_file in convert_concated_data(args.data_root, config.get('settings', domain + '_path'),
+                                               config.get('settings', domain + '_datafile_name'), NFold, args.dtype):
+            original = np.load(os.path.join(args.data_root, data_file.replace("_" + args.dtype + ".npy", ".npy")),
+                               mmap_mode='r')
+            compact = np.load(os.path.join(args.data_root, data_file), mmap_mode='r')
+            print("{0}: {1} -> {2}, max abs error {3:.3e}".format(
+                data_file, original.dtype, compact.dtype, np.abs(original - compact.astype(original.dtype)).max()))
+        if not args.cache_prefix:
+            continue
+        for cross_id in range(NFold):
+            test_list = [os.path.join(config.get('settings', domain + '_path'), "concatedData", "test",
+                                      "cross_{0}_".format(cross_id) + config.get('settings', domain + '_' + name))
+                         for name in ['datafile_name', 'labelfile_name']]
+            model_file = os.path.join("models", args.cache_prefix + '_cross_id_{0}_best_{1}_model.pth'.format(cross_id, domain))
+            print(domain, cross_id, compare_storage_accuracy(model_file, args.data_root, test_list, args.dtype,
+                                                             domain=domain_id))
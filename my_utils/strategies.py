@@ -0,0 +1,626 @@
+import importlib
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .my_tool import mmd_rbf
+from .amp import MixedPrecision, float32
+from .domain_batch import use_domain_batch_norm
+from .INTEL import MinNormSolver, MultiObjectiveGradients, GradientGroup, min_norm_weights
+
+'''
+The per-method part of the EEG_*_anybackbone.py training: a Strategy says which model a method trains, how its
+fixed channel matrices are built, which training splits it uses and what one optimisation step does (forward,
+losses, backward). Trainer (see trainer.py) runs everything else -- data, fold loop, optimizer, logging,
+evaluation and checkpointing -- the same way for every method.
+
+    strategy = STRATEGIES['DANN'](config)
+    losses = strategy.step(my_net, data_source, data_target, p)
+
+step() leaves the gradients in the parameters and returns the named losses to log; the caller zeroes the
+gradients before and runs optimizer.step() after it. The forwards run under self.amp.autocast() and every loss
+is differentiated through self.amp.scale() (see amp.py); the Trainer sets self.amp for --precision.
+'''
+
+
+# ==== losses shared by the methods
+@float32
+def cov_loss_cos_distance(tensorA, tensorB):
+    """
+    Calculate the cosine distance between the average covariance matrices of two tensors (tensorA and tensorB).
+
+    Both tensorA and tensorB are tensors with the shape (batchsize, 1, c, T).
+    Each tensor contains batchsize samples, and each sample is a matrix with c rows and T columns.
+    """
+
+    def compute_mean_covariance(input_tensor):
+        # Remove dimensions of size 1, changing the tensor shape to (batchsize, c, T)
+        input_tensor = input_tensor.squeeze(1)
+
+        # Data centralization: subtract the mean from each feature
+        mean = input_tensor.mean(dim=-1, keepdim=True)
+        input_tensor_centered = input_tensor - mean
+
+        # Calculate the covariance matrix
+        covariance_matrices = torch.matmul(input_tensor_centered, input_tensor_centered.transpose(1, 2)) / (
+                    input_tensor_centered.shape[-1] - 1)
+
+        # Calculate the mean covariance matrix
+        mean_covariance = covariance_matrices.mean(dim=0)
+        return mean_covariance
+
+    # Compute the mean covariance matrices for two tensors
+    mean_covariance_A = compute_mean_covariance(tensorA)
+    mean_covariance_B = compute_mean_covariance(tensorB)
+
+    A_normalized = F.normalize(mean_covariance_A, p=2, dim=1)
+    B_normalized = F.normalize(mean_covariance_B, p=2, dim=1)
+
+    cosine_similarity = torch.sum(A_normalized * B_normalized, dim=1)
+
+    loss = 1 - cosine_similarity
+    return torch.mean(loss)
+
+
+@float32
+def fre_mag_loss(s_filter_output, t_filter_output):
+    # make sure the shape is (batch_size, 1, num_channels, len_channel)
+    assert s_filter_output.shape == t_filter_output.shape
+
+    # get spec by FFT
+    s_freq = torch.fft.rfft(s_filter_output, dim=3)
+    t_freq = torch.fft.rfft(t_filter_output, dim=3)
+
+    # get mag
+    s_mag = torch.abs(s_freq)
+    t_mag = torch.abs(t_freq)
+
+    # calculate mean magnitude
+    s_avg_mag = torch.mean(s_mag, dim=[0, 1, 2])
+    t_avg_mag = torch.mean(t_mag, dim=[0, 1, 2])
+
+    # calculate L2 distance
+    loss = torch.norm(s_avg_mag - t_avg_mag, p=2)
+
+    return loss
+
+
+@float32
+def euclidean_dist(x, y):
+    """
+    Args:
+      x: pytorch Variable, with shape [m, d]
+      y: pytorch Variable, with shape [n, d]
+    Returns:
+      dist: pytorch Variable, with shape [m, n]
+    """
+
+    m, n = x.size(0), y.size(0)
+    # After applying the pow() method, each individual element in xx is squared. Then, the sum is taken along axis=1 (horizontally, from the first column to the last column). At this point, the shape of xx is (m, 1). After using the expand() method, it is expanded n-1 times, so the shape of xx becomes (m, n).
+    xx = torch.pow(x, 2).sum(1, keepdim=True).expand(m, n)
+    # yy will be transposed at the end.
+    yy = torch.pow(y, 2).sum(1, keepdim=True).expand(n, m).t()
+    dist = xx + yy
+    # dist - 2 * x * yT
+    dist.addmm_(x, y.t(), beta=1, alpha=-2)
+    # The clamp() function limits the elements in dist to a specified minimum and maximum range, and finally, the square root is taken, resulting in the distance matrix between samples.
+    dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
+    dist = torch.sum(dist)  # Sum all distances
+    return dist
+
+
+# schedules of the Infinity loss weights over the progression p of the training
+a_s, b_s = 10, 0.3
+a_f, b_f, c_f = 10, 0.3, 0.6
+a_d, b_d = 10, 0.6
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+def weight_s(p, a_s, b_s):
+    return 1 - sigmoid(a_s * (p - b_s))
+
+def weight_f(p, a_f, b_f, c_f):
+    return sigmoid(a_f * (p - b_f)) - sigmoid(a_f * (p - c_f))
+
+def weight_d(p, a_d, b_d):
+    return sigmoid(a_d * (p - b_d))
+
+
+# ==== strategies
+class Strategy(object):
+    '''
+    :param config: the ConfigParser of the hyperparameters file
+    :param device: device of the training batches
+    '''
+    name = None
+    # module of my_utils with the EEG_Infinity model of the method
+    model_module = 'model_EEG_Infinity002API_any_backbone'
+    # if True, the fixed channel matrices include a common average reference
+    common_average_reference = False
+    # if False, the target training split is not even loaded
+    uses_target_train = True
+    # if True, the steps get equal-sized (source, target) batch pairs, otherwise source batches only
+    paired = True
+    supports_projection_cache = True
+    default_backbone = 'InceptionEEG'
+    # csv under record/ that append_results_to_csv adds the fold results to
+    record_file = "comparison_study.csv"
+    # the alignment losses of the steps, compiled by compile()
+    cov_loss_cos_distance = staticmethod(cov_loss_cos_distance)
+    fre_mag_loss = staticmethod(fre_mag_loss)
+    euclidean_dist = staticmethod(euclidean_dist)
+    # if True, the paired steps run the model once on both domains (EEG_Infinity.forward_domains, --fused_forward)
+    fused_forward = False
+    # with fused_forward, if True the BatchNorm layers keep per-domain batch statistics (see domain_batch.py)
+    domain_bn = True
+
+    def __init__(self, config, device='cuda'):
+        self.config = config
+        self.device = device
+        self.loss_class = torch.nn.NLLLoss()
+        self.loss_domain = torch.nn.NLLLoss()
+        self.my_LogSoftmax = torch.nn.LogSoftmax(dim=1)
+        self.amp = MixedPrecision('fp32', device)
+
+    def build_model(self, transfer_matrix_source, transfer_matrix_target, **kwargs):
+        EEG_Infinity = importlib.import_module('.' + self.model_module, __package__).EEG_Infinity
+        my_net = EEG_Infinity(transfer_matrix_source, transfer_matrix_target, **kwargs)
+        if self.fused_forward and self.domain_bn:
+            # the per-domain BatchNorm of the fused forward, set once here rather than at every step
+            use_domain_batch_norm(my_net)
+        return my_net
+
+    def compile(self, **options):
+        '''
+        Compile the alignment losses with torch.compile (--compile; the model is compiled by
+        compilation.compile_model).
+
+        :param options: keyword arguments of torch.compile
+        '''
+        self.cov_loss_cos_distance = torch.compile(cov_loss_cos_distance, **options)
+        self.fre_mag_loss = torch.compile(fre_mag_loss, **options)
+        self.euclidean_dist = torch.compile(euclidean_dist, **options)
+
+    def prepare(self, source_train_dataset, target_train_dataset):
+        '''
+        Called once per fold with the training datasets, before the first step.
+        '''
+        pass
+
+    def align_transform(self, domain):
+        '''
+        :return: the fixed transform (e.g. EA) applied to the evaluation data of domain 0 (source) or 1 (target)
+        '''
+        return None
+
+    def steps_per_epoch(self, source_loader, target_loader):
+        # only used without pairing, the paired loader sets the epoch length otherwise
+        return len(source_loader)
+
+    def grl_alpha(self, p):
+        # parameter of GRL, p stands for progression, ranging from 0 to 1
+        return 2. / (1. + np.exp(self.config.getint('GRL', 'decay') * p)) - 1
+
+    def step(self, my_net, data_source, data_target, p):
+        '''
+        :param data_source: (eeg, subject, label) source batch on the training device
+        :param data_target: the paired target batch, None if the strategy is not paired
+        :param p: progression of the training, from 0 to 1
+        :return: dict of the losses to log
+        '''
+        raise NotImplementedError
+
+    def forward_pair(self, my_net, s_eeg, t_eeg, alpha):
+        '''
+        :return: the outputs of my_net on the source batch and on the target batch
+        '''
+        if self.fused_forward:
+            return my_net.forward_domains(s_eeg, t_eeg, alpha, domain_bn=self.domain_bn)
+        return my_net(input_data=s_eeg, domain=0, alpha=alpha), my_net(input_data=t_eeg, domain=1, alpha=alpha)
+
+    def classification_loss(self, class_output, label):
+        return self.loss_class(self.my_LogSoftmax(class_output), label.long())
+
+
+class BaselineStrategy(Strategy):
+    '''
+    Source-only training.
+    '''
+    name = 'Baseline'
+    uses_target_train = False
+    paired = False
+    record_file = "comparison_study_Baseline.csv"
+
+    def step(self, my_net, data_source, data_target, p):
+        s_eeg, s_subject, s_label = data_source
+        with self.amp.autocast():
+            s_class_output, _, _, _ = my_net(input_data=s_eeg, domain=0, alpha=self.grl_alpha(p))
+            # cls loss for source data
+            err_s_label = self.classification_loss(s_class_output, s_label)
+        self.amp.scale(err_s_label).backward()
+        return {'err_s_label': err_s_label}
+
+
+class EAStrategy(BaselineStrategy):
+    '''
+    Source-only training on data aligned per domain with the Euclidean mean covariance of its training split.
+    '''
+    name = 'EA'
+    uses_target_train = True
+    supports_projection_cache = False
+    record_file = "comparison_study_EA.csv"
+
+    def mean_covariance(self, training_data):
+        from .EA_RA import EuclideanMeanCovariance
+        return EuclideanMeanCovariance(training_data, device=self.device)
+
+    def prepare(self, source_train_dataset, target_train_dataset):
+        self.source_EA = self.mean_covariance(source_train_dataset.trials())
+        self.target_EA = self.mean_covariance(target_train_dataset.trials())
+
+    def align_transform(self, domain):
+        return [self.source_EA, self.target_EA][domain]
+
+    def steps_per_epoch(self, source_loader, target_loader):
+        return min(len(target_loader), len(source_loader))
+
+    def step(self, my_net, data_source, data_target, p):
+        s_eeg, s_subject, s_label = data_source
+        return super(EAStrategy, self).step(my_net, (self.source_EA.transform(s_eeg), s_subject, s_label),
+                                            data_target, p)
+
+
+class RAStrategy(EAStrategy):
+    '''
+    EA with the Riemannian mean covariance.
+    '''
+    name = 'RA'
+    record_file = "comparison_study_RA.csv"
+
+    def mean_covariance(self, training_data):
+        from .EA_RA import RiemannMeanCovariance
+        return RiemannMeanCovariance(training_data, device=self.device)
+
+
+class DANNStrategy(Strategy):
+    '''
+    Adversarial training of the features against a domain classifier behind a gradient reversal layer.
+    With wasserstein, the domain head is a critic whose output means are the domain losses, and its gradients
+    are clipped after the backward.
+    '''
+    name = 'DANN'
+    model_module = 'model_EEG_Infinity002API_any_backboneDANN'
+    record_file = "comparison_study_DANN.csv"
+    wasserstein = False
+
+    def domain_losses(self, s_domain_output, t_domain_output):
+        if self.wasserstein:
+            return s_domain_output.float().mean(), t_domain_output.float().mean() * (-1)
+        s_domain_label = torch.ones(len(s_domain_output), dtype=torch.long, device=s_domain_output.device)
+        t_domain_label = torch.zeros(len(t_domain_output), dtype=torch.long, device=t_domain_output.device)
+        return (self.loss_domain(self.my_LogSoftmax(s_domain_output), s_domain_label),
+                self.loss_domain(self.my_LogSoftmax(t_domain_output), t_domain_label))
+
+    def forward_domains(self, my_net, data_source, data_target, alpha):
+        s_eeg, s_subject, s_label = data_source
+        t_eeg, t_subject, t_label = data_target
+        with self.amp.autocast():
+            s_outputs, t_outputs = self.forward_pair(my_net, s_eeg, t_eeg, alpha)
+            err_s_domain, err_t_domain = self.domain_losses(s_outputs[1], t_outputs[1])
+            losses = {'err_s_label': self.classification_loss(s_outputs[0], s_label),
+                      'err_t_label': self.classification_loss(t_outputs[0], t_label),
+                      'err_s_domain': err_s_domain,
+                      'err_t_domain': err_t_domain}
+        return s_outputs, t_outputs, losses
+
+    def step(self, my_net, data_source, data_target, p):
+        _, _, losses = self.forward_domains(my_net, data_source, data_target, self.grl_alpha(p))
+        err_DANN = losses['err_s_label'] + losses['err_s_domain'] + losses['err_t_domain']
+        self.amp.scale(err_DANN).backward()
+        if self.wasserstein:
+            self.amp.unscale_()
+            my_net.clip_gradients_domain_classifier()
+        return losses
+
+
+class DANNWassStrategy(DANNStrategy):
+    name = 'DANNWass'
+    model_module = 'model_EEG_Infinity002API_any_backboneDANNWass'
+    record_file = "comparison_study_DANNWass.csv"
+    wasserstein = True
+
+
+class DDCStrategy(Strategy):
+    '''
+    Source classification plus the MMD between the source and target features.
+    '''
+    name = 'DDC'
+    # the scripts imported model_EEG_Infinity002API_any_backboneV2, which is not in the tree; the DeepCoral
+    # model returns the same (class_output, feature0, feature1, feature2)
+    model_module = 'model_EEG_Infinity002API_any_backboneDeepCoral'
+    record_file = "comparison_study_DDC.csv"
+
+    def feature_distance(self, s_features, t_features):
+        return {'mmd': float32(mmd_rbf)(s_features[0], t_features[0], kernel_mul=5.0, kernel_num=10, fix_sigma=None)}
+
+    def step(self, my_net, data_source, data_target, p):
+        # alpha is useless here, just keep the signature of the model
+        alpha = self.grl_alpha(p)
+        s_eeg, s_subject, s_label = data_source
+        t_eeg, t_subject, t_label = data_target
+        with self.amp.autocast():
+            (s_class_output, *s_features), (t_class_output, *t_features) = self.forward_pair(my_net, s_eeg, t_eeg, alpha)
+            err_s_label = self.classification_loss(s_class_output, s_label)
+        losses = {'err_s_label': err_s_label}
+        final_loss = err_s_label
+        if len(s_label) == len(t_label):
+            distances = self.feature_distance(s_features, t_features)
+            final_loss = final_loss + sum(distances.values())
+            losses.update(distances)
+        self.amp.scale(final_loss).backward()
+        return losses
+
+
+class DeepCoralStrategy(DDCStrategy):
+    '''
+    Source classification plus the distances between the source and target features of three layers.
+    '''
+    name = 'DeepCoral'
+    record_file = "comparison_study_DeepCoral.csv"
+
+    def feature_distance(self, s_features, t_features):
+        return {'coral_loss{0}'.format(k): self.euclidean_dist(s_feature, t_feature) / 30000
+                for k, (s_feature, t_feature) in enumerate(zip(s_features, t_features))}
+
+
+class Infinity003Strategy(DANNStrategy):
+    '''
+    DANN with learnable alignment heads, trained by scheduled domain, frequency and covariance losses.
+    '''
+    name = 'Infinity003'
+    model_module = 'model_EEG_Infinity002_any_backbone'
+    common_average_reference = True
+    record_file = "comparison_study.csv"
+
+    def backward_adversarial(self, my_net, losses, p):
+        # calculate DANN loss
+        err_DANN = losses['err_s_label'] + weight_d(p, a_d, b_d) * losses['err_s_domain'] + \
+                   weight_d(p, a_d, b_d) * losses['err_t_domain']
+        self.amp.scale(err_DANN).backward(retain_graph=True)
+
+        # label classifer loss do not contribute to alignment head directly, so set the gradients to zero.
+        my_net.alignment_head_source.custom_zero_grad()
+        my_net.alignment_head_target.custom_zero_grad()
+
+    def filter_distance(self, s_filter_output, t_filter_output, p):
+        return 'l1_distance', F.l1_loss(s_filter_output.float(), t_filter_output.float(), reduction='mean') * weight_f(p, a_f, b_f, c_f) / 1000
+
+    def step(self, my_net, data_source, data_target, p):
+        s_outputs, t_outputs, losses = self.forward_domains(my_net, data_source, data_target, self.grl_alpha(p))
+        _, _, s_spatial_output, s_filter_output = s_outputs
+        _, _, t_spatial_output, t_filter_output = t_outputs
+        self.backward_adversarial(my_net, losses, p)
+
+        # calculate alignment head's loss for req
+        err_s_alignment_head = my_net.alignment_head_source.get_magnitude_loss()
+        err_t_alignment_head = my_net.alignment_head_target.get_magnitude_loss()
+        err_st_alignment_head = err_s_alignment_head + err_t_alignment_head
+        self.amp.scale(err_st_alignment_head).backward(retain_graph=True)
+
+        # calculate alignment head's loss
+        if len(data_source[2]) == len(data_target[2]):
+            # contribute to spatial and filter
+            name, filter_distance = self.filter_distance(s_filter_output, t_filter_output, p)
+            # contribute to spatial
+            cov_distance = self.cov_loss_cos_distance(s_spatial_output, t_spatial_output) * weight_s(p, a_s, b_s)
+            self.amp.scale(cov_distance + filter_distance).backward()
+            with torch.no_grad():
+                losses['gradient_channel'] = torch.mean(torch.abs(self.amp.unscaled(my_net.alignment_head_target.channel_transfer_matrix.grad)))
+            losses[name] = filter_distance
+            losses['cov_distance'] = cov_distance
+
+        if self.wasserstein:
+            self.amp.unscale_()
+            my_net.clip_gradients_domain_classifier()
+        return losses
+
+
+class Infinity005WassStrategy(Infinity003Strategy):
+    name = 'Infinity005Wass'
+    model_module = 'model_EEG_Infinity003Wass_any_backbone'
+    record_file = "comparison_study_EEGInfinity005Wass.csv"
+    wasserstein = True
+
+
+class Infinity006WassStrategy(Infinity005WassStrategy):
+    '''
+    Infinity005Wass where the domain loss also trains the alignment heads, and the frequency loss compares the
+    mean magnitude spectra.
+    '''
+    name = 'Infinity006Wass'
+    default_backbone = 'DeepConvNet'
+    record_file = "comparison_study_EEGInfinity006Wass.csv"
+
+    def backward_adversarial(self, my_net, losses, p):
+        self.amp.scale(losses['err_s_label']).backward(retain_graph=True)
+
+        # label classifer loss do not contribute to alignment head directly, so set the gradients to zero.
+        my_net.alignment_head_source.custom_zero_grad()
+        my_net.alignment_head_target.custom_zero_grad()
+
+        # domain classifier loss
+        self.amp.scale(weight_d(p, a_d, b_d) * losses['err_s_domain'] + weight_d(p, a_d, b_d) * losses['err_t_domain']).backward(retain_graph=True)
+
+    def filter_distance(self, s_filter_output, t_filter_output, p):
+        return 'fre_distance', self.fre_mag_loss(s_filter_output, t_filter_output) * weight_f(p, a_f, b_f, c_f) / 100
+
+
+class Infinity004Strategy(DANNStrategy):
+    '''
+    The shared parameters get the min-norm (MGDA) combination of the gradients of their losses: the feature
+    extractor of the domain and the label loss, the target channel_transfer_matrix of the domain, covariance
+    and frequency losses.
+
+    With upper_bound (MGDA-UB), the weights of the feature extractor objectives come from their gradients with
+    respect to the features instead of the feature extractor parameters, so the feature extractor parameters are
+    backpropagated once, with the weighted gradient of the features, instead of once per objective. The alignment
+    heads below it get the gradient of l_d alone, as in the default step.
+    '''
+    name = 'Infinity004'
+    model_module = 'model_EEG_Infinity002_any_backbone'
+    common_average_reference = True
+    record_file = "comparison_study_EEGInfinity004.csv"
+    upper_bound = False
+
+    def __init__(self, config, device='cuda', upper_bound=False):
+        super(Infinity004Strategy, self).__init__(config, device)
+        self.upper_bound = upper_bound
+        self.minnormsolver = MinNormSolver()
+        self.multi_objective_gradients = MultiObjectiveGradients()
+        self.alignment_gradients = MultiObjectiveGradients()
+        self.gradient_groups = {}
+
+    @staticmethod
+    def alignment_head_parameters(my_net):
+        '''
+        The parameters that custom_zero_grad() clears: the label loss does not contribute to them directly.
+        '''
+        return [param for head in [my_net.alignment_head_source, my_net.alignment_head_target]
+                for param in [head.channel_transfer_matrix, head.domain_filter.conv.weight]]
+
+    def alignment_losses(self, my_net, s_outputs, t_outputs):
+        _, _, s_spatial_output, s_filter_output = s_outputs
+        _, _, t_spatial_output, t_filter_output = t_outputs
+        # Calculate the regularization loss for the alignment head
+        err_s_alignment_head = my_net.alignment_head_source.get_magnitude_loss()
+        err_t_alignment_head = my_net.alignment_head_target.get_magnitude_loss()
+        err_st_alignment_head = err_s_alignment_head + err_t_alignment_head
+        loss_fre = F.l1_loss(s_filter_output.float(), t_filter_output.float(), reduction='mean')/1000
+        loss_cov = self.cov_loss_cos_distance(s_spatial_output, t_spatial_output)
+        return err_st_alignment_head, loss_fre, loss_cov
+
+    def gradient_group(self, name, params):
+        '''
+        The GradientGroup of a parameter group, built at the first step of a model and reused afterwards.
+        '''
+        group = self.gradient_groups.get(name)
+        if group is None or not group.holds(params):
+            group = self.gradient_groups[name] = GradientGroup(params)
+        return group
+
+    def set_transfer_matrix_grad(self, my_net, gradient_l_d, gradient_loss_cov, gradient_loss_fre, l_d, loss_cov, loss_fre):
+        # The gradient of the target_transfer_matrix, obtained by solving the three parts of the gradients {"l_d", "l_cov", "l_fre"}
+        group = self.gradient_group('transfer_matrix', [my_net.alignment_head_target.channel_transfer_matrix])
+        grads = [[gradient_l_d], [gradient_loss_cov], [gradient_loss_fre]]
+        sol, min_norm = group.min_norm_weights(self.minnormsolver, grads, [l_d, loss_cov, loss_fre])
+        group.combine(sol, grads)
+
+    def step(self, my_net, data_source, data_target, p):
+        if self.upper_bound:
+            return self.step_upper_bound(my_net, data_source, data_target, p)
+        s_outputs, t_outputs, losses = self.forward_domains(my_net, data_source, data_target, alpha=1)
+        err_s_label, err_s_domain, err_t_domain = losses['err_s_label'], losses['err_s_domain'], losses['err_t_domain']
+        # Calculate the domain classifier loss
+        l_d = err_t_domain + err_s_domain
+        err_st_alignment_head, loss_fre, loss_cov = self.alignment_losses(my_net, s_outputs, t_outputs)
+
+        # The gradients of every objective w.r.t. every trainable parameter, from a single pass over the graph:
+        # the feature extractor first, then the target transfer matrix, then the rest
+        transfer_matrix = my_net.alignment_head_target.channel_transfer_matrix
+        feature_params = [param for param in my_net.feature.parameters() if param.requires_grad]
+        shared = {id(param) for param in feature_params + [transfer_matrix]}
+        other_params = [param for param in my_net.parameters() if param.requires_grad and id(param) not in shared]
+        params = feature_params + [transfer_matrix] + other_params
+        objectives = [err_s_label, l_d, err_st_alignment_head, loss_fre, loss_cov]
+        objectives_gradients = self.multi_objective_gradients([self.amp.scale(loss) for loss in objectives], params)
+        gradients_l_y, gradients_l_d, _, gradients_fre, gradients_cov = objectives_gradients
+
+        n_feature = len(feature_params)
+        self.set_transfer_matrix_grad(my_net, gradients_l_d[n_feature], gradients_cov[n_feature], gradients_fre[n_feature],
+                                      l_d, loss_cov, loss_fre)
+
+        # The gradients of the shared parameters of the feature_extractor, obtained by solving the two parts of the gradients {"l_d", "l_y"}
+        used = [i for i in range(n_feature) if gradients_l_y[i] is not None]
+        group = self.gradient_group('feature', [feature_params[i] for i in used])
+        grads = [[gradients_l_d[i] for i in used], [gradients_l_y[i] for i in used]]
+        sol, min_norm = group.min_norm_weights(self.minnormsolver, grads, [l_d, err_s_label])
+        group.combine(sol, grads)
+
+        # The other parameters get the sum of the gradients of the objectives, without the label loss in the alignment heads
+        alignment_head = {id(param) for param in self.alignment_head_parameters(my_net)}
+        for i, param in enumerate(other_params, n_feature + 1):
+            grads = [gradients[i] for k, gradients in enumerate(objectives_gradients) if k > 0 or id(param) not in alignment_head]
+            if grads[0] is not None:
+                param.grad = sum(grads)
+
+        return self.log_losses(my_net, losses, loss_fre, loss_cov)
+
+    def step_upper_bound(self, my_net, data_source, data_target, p):
+        # keep the outputs of the feature extractor (source, then target, or both in one with fused_forward), the
+        # representation shared by l_y and l_d
+        features = []
+        hook = my_net.feature.register_forward_hook(lambda module, inputs, output: features.append(output))
+        try:
+            s_outputs, t_outputs, losses = self.forward_domains(my_net, data_source, data_target, alpha=1)
+        finally:
+            hook.remove()
+        err_s_label, err_s_domain, err_t_domain = losses['err_s_label'], losses['err_s_domain'], losses['err_t_domain']
+        l_d = err_t_domain + err_s_domain
+        err_st_alignment_head, loss_fre, loss_cov = self.alignment_losses(my_net, s_outputs, t_outputs)
+
+        feature_params = [param for param in my_net.feature.parameters() if param.requires_grad]
+        alignment_params = [param for head in [my_net.alignment_head_source, my_net.alignment_head_target]
+                            for param in head.parameters() if param.requires_grad]
+        below = {id(param) for param in feature_params + alignment_params}
+        classifier_params = [param for param in my_net.parameters() if param.requires_grad and id(param) not in below]
+
+        # l_y and l_d w.r.t. the features and the classifiers: a backward pass through the classifiers only
+        gradients_l_y, gradients_l_d = self.multi_objective_gradients([self.amp.scale(err_s_label), self.amp.scale(l_d)],
+                                                                      features + classifier_params, retain_graph=True)
+        n_features = len(features)
+        sol, min_norm = min_norm_weights(self.minnormsolver,
+                                         {"l_d": gradients_l_d[:n_features], "l_y": gradients_l_y[:n_features]},
+                                         {"l_d": l_d, "l_y": err_s_label})
+        # the alignment losses do not reach the feature extractor
+        gradients_fre, gradients_cov = self.alignment_gradients([self.amp.scale(err_st_alignment_head + loss_fre),
+                                                                 self.amp.scale(loss_cov)], alignment_params, retain_graph=True)
+
+        # One backward pass through the feature extractor, with the MGDA-UB combination of the feature gradients
+        feature_grads = [sol[0]*gradient_l_d + sol[1]*gradient_l_y
+                         for gradient_l_d, gradient_l_y in zip(gradients_l_d[:n_features], gradients_l_y[:n_features])]
+        encoder_gradients = torch.autograd.grad(features, feature_params, grad_outputs=feature_grads,
+                                                retain_graph=True, allow_unused=True)
+        # label classifer loss do not contribute to alignment head directly: the alignment heads get l_d alone,
+        # unweighted, as in step()
+        gradients_l_d_alignment = torch.autograd.grad(features, alignment_params, grad_outputs=gradients_l_d[:n_features],
+                                                      allow_unused=True)
+
+        for param, grad in zip(feature_params, encoder_gradients):
+            param.grad = grad
+        for i, param in enumerate(classifier_params, n_features):
+            grads = [gradients[i] for gradients in [gradients_l_y, gradients_l_d] if gradients[i] is not None]
+            if grads:
+                param.grad = sum(grads)
+        transfer_matrix = my_net.alignment_head_target.channel_transfer_matrix
+        for i, param in enumerate(alignment_params):
+            if param is transfer_matrix:
+                self.set_transfer_matrix_grad(my_net, gradients_l_d_alignment[i], gradients_cov[i], gradients_fre[i],
+                                              l_d, loss_cov, loss_fre)
+            else:
+                grads = [grad for grad in [gradients_l_d_alignment[i], gradients_fre[i], gradients_cov[i]] if grad is not None]
+                if grads:
+                    param.grad = sum(grads)
+
+        return self.log_losses(my_net, losses, loss_fre, loss_cov)
+
+    def log_losses(self, my_net, losses, loss_fre, loss_cov):
+        with torch.no_grad():
+            losses['gradient_channel'] = torch.mean(torch.abs(self.amp.unscaled(my_net.alignment_head_target.channel_transfer_matrix.grad)))
+        losses['loss_fre'] = loss_fre
+        losses['loss_cov'] = loss_cov
+        return losses
+
+
+STRATEGIES = {strategy.name: strategy for strategy in [
+    BaselineStrategy, EAStrategy, RAStrategy, DANNStrategy, DANNWassStrategy, DDCStrategy, DeepCoralStrategy,
+    Infinity003Strategy, Infinity004Strategy, Infinity005WassStrategy, Infinity006WassStrategy]}
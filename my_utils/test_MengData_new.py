@@ -1,69 +1,209 @@
 import os
+import copy
+import numpy as np
 import torch.backends.cudnn as cudnn
 import torch.utils.data
-from .data_loader_npy import EEGDataSet
-
-def test(test_list, torch_model, domain, start=0,num_channel=62, device='cuda'):
-
-    data_root = os.path.join(os.path.pardir,os.path.pardir,"EEGData")
-    model_root = "models"
-    cudnn.benchmark = True
-    batch_size = 64
-    """load data"""
-
-    dataset = EEGDataSet(
-        data_root=data_root,
-        data_list=test_list,
-        start=start,
-        num_channel=num_channel,
-        datalen = 384,
-    )
-
-
-    dataloader = torch.utils.data.DataLoader(
-        dataset=dataset,
-        batch_size=batch_size,
-        shuffle=False,
-        num_workers=4
-    )
-
-    """ test """
+from .data_loader_npy import open_eeg_dataset, make_batch_loader, TensorEEGDataset, TensorEEGLoader
+from .backend import default_device
+
+def crop_average_forward(my_net, eeg, domain, align_transform=None):
+    '''
+    Class logits of a batch. A multi-crop batch (B, K, 1, C, T) from EEGDataSet(n_crops=K) goes through the
+    model as one (B * K, 1, C, T) batch and the logits of the K crops of each trial are averaged.
+    my_net may be a list of models, which then share the (aligned) batch and give a list of logits.
+    '''
+    n_crops = eeg.shape[1] if eeg.dim() == 5 else 1
+    if n_crops > 1:
+        eeg = eeg.flatten(0, 1)
+    if align_transform is not None:
+        eeg = align_transform.transform(eeg)
+    class_outputs = []
+    for model in (my_net if isinstance(my_net, (list, tuple)) else [my_net]):
+        class_output, _, _, _ = model(input_data=eeg, domain=domain, alpha=0)
+        if n_crops > 1:
+            class_output = class_output.view(-1, n_crops, class_output.shape[-1]).mean(dim=1)
+        class_outputs.append(class_output)
+    return class_outputs if isinstance(my_net, (list, tuple)) else class_outputs[0]
+
+
+def load_model(torch_model, model_root="models", map_location=None):
+    '''
+    :param torch_model: a model, or the file name of a model saved with torch.save under model_root
+    :param map_location: device the tensors of a saved model are loaded onto (e.g. a GPU model on a CPU machine)
+    '''
     if isinstance(torch_model, str):
-        my_net = torch.load(os.path.join(
-            model_root, torch_model
-        )).eval()
-    else:
-        my_net = torch_model.eval()
-
-
-    my_net = my_net.to(device)
-
-    len_dataloader = len(dataloader)
-    data_target_iter = iter(dataloader)
-
-    i = 0
-    n_total = 0
-    n_correct = 0
-    while i < len_dataloader:
-
-        # test model using target data
-        data_target = next(data_target_iter)
-        t_eeg, t_subject, t_label = data_target
-        batch_size = len(t_label)
-
-
-        t_eeg = t_eeg.to(device)
-        t_label = t_label.to(device)
-
-        class_output, _, _, _ = my_net(input_data=t_eeg, domain=domain, alpha=0)
-
-        pred = class_output.data.max(1, keepdim=True)[1]
-
-        n_correct += pred.eq(t_label.data.view_as(pred)).cpu().sum()
-        n_total += batch_size
-
-        i += 1
-
-    accu = n_correct.data.numpy() * 1.0 / n_total
-
-    return accu
+        return torch.load(os.path.join(model_root, torch_model), map_location=map_location, weights_only=False)
+    return torch_model
+
+
+def load_models(torch_models, model=None, model_root="models", map_location=None):
+    '''
+    :param torch_models: list of models, file names (see load_model) or state_dicts
+    :param model: a model of the architecture of the state_dicts; each state_dict is loaded into a copy of it
+    '''
+    my_nets = []
+    for torch_model in torch_models:
+        if isinstance(torch_model, dict):
+            if model is None:
+                raise ValueError("state_dicts need the model they belong to")
+            my_net = copy.deepcopy(model)
+            my_net.load_state_dict(torch_model)
+        else:
+            my_net = load_model(torch_model, model_root, map_location=map_location)
+        my_nets.append(my_net)
+    return my_nets
+
+
+def classification_metrics(confusion):
+    '''
+    :param confusion: (n_classes, n_classes) counts, rows are the true and columns the predicted classes
+    :return: dict with accuracy, balanced_accuracy (mean recall over the classes present) and Cohen's kappa
+    '''
+    confusion = np.asarray(confusion, dtype=np.float64)
+    n_total = confusion.sum()
+    accuracy = np.trace(confusion) / n_total
+    support = confusion.sum(axis=1)
+    recall = np.diag(confusion)[support > 0] / support[support > 0]
+    expected = np.dot(support, confusion.sum(axis=0)) / n_total ** 2
+    kappa = (accuracy - expected) / (1 - expected) if expected < 1 else float('nan')
+    return {"accuracy": float(accuracy),
+            "balanced_accuracy": float(recall.mean()),
+            "kappa": float(kappa),
+            "confusion": confusion.astype(np.int64)}
+
+
+class Evaluator(object):
+    '''
+    Accuracy of a model on one split, with the split loaded once.
+
+    test() reloads the npy file and starts a new DataLoader with 4 workers on every call, i.e. twice per epoch.
+    An Evaluator is built once per fold: the split is read at construction and kept as a tensor on `device`
+    (in_memory=True, no workers), or served by a DataLoader with persistent workers (in_memory=False, e.g. for
+    a sharded split). evaluate() then does no file I/O. A fixed align_transform (EA/RA) is applied to the
+    cached tensor once instead of to every batch of every epoch.
+
+    The pass runs under torch.inference_mode and accumulates the confusion matrix on the device, so the only
+    device-to-host transfer is the matrix at the end. With batch_size=None (in_memory only) the batch starts
+    at max_batch_size and is halved whenever the device runs out of memory; the working size is kept for the
+    following calls. The models are in eval mode, so the batch size does not change the outputs.
+
+    evaluate_many() runs several models (checkpoints, folds) on every batch of a single pass, and also scores
+    their ensemble, the mean of their class probabilities.
+    '''
+    def __init__(self, test_list, num_channel=62, start=0, datalen=384, batch_size=None, device=None, n_crops=1,
+                 align_transform=None, in_memory=True, num_workers=4, max_batch_size=1024,
+                 data_root=os.path.join(os.path.pardir, os.path.pardir, "EEGData"), mmap=False):
+        cudnn.benchmark = True
+        device = device or default_device()
+        self.device = device
+        self.align_transform = align_transform
+        dataset = open_eeg_dataset(
+            data_root=data_root,
+            data_list=test_list,
+            start=start,
+            num_channel=num_channel,
+            datalen=datalen,
+            n_crops=n_crops,
+            mmap=mmap,
+        )
+        in_memory = in_memory and not isinstance(dataset, torch.utils.data.IterableDataset)
+        self.auto_batch_size = batch_size is None and in_memory
+        if batch_size is None:
+            batch_size = min(len(dataset), max_batch_size) if in_memory else 64
+        if in_memory:
+            dataset = TensorEEGDataset(dataset, device=device)
+            if align_transform is not None:
+                with torch.no_grad():
+                    eegs = dataset.eegs.flatten(0, dataset.eegs.dim() - 4)
+                    eegs = align_transform.transform(eegs.to(device))
+                    dataset.eegs = eegs.view(dataset.eegs.shape[:-3] + eegs.shape[-3:])
+                self.align_transform = None
+            self.dataloader = TensorEEGLoader(dataset, batch_size=batch_size, shuffle=False)
+        else:
+            self.dataloader = make_batch_loader(
+                dataset=dataset,
+                batch_size=batch_size,
+                shuffle=False,
+                num_workers=num_workers,
+                persistent_workers=num_workers > 0
+            )
+
+    def confusion_matrices(self, my_nets, domain, ensemble=False):
+        '''
+        :return: one confusion matrix per model, plus one for the ensemble of the models if ensemble is True
+        '''
+        confusions = None
+        with torch.inference_mode():
+            for t_eeg, t_subject, t_label in self.dataloader:
+                t_eeg = t_eeg.to(self.device, non_blocking=True)
+                t_label = t_label.to(self.device, non_blocking=True)
+
+                class_outputs = crop_average_forward(my_nets, t_eeg, domain, align_transform=self.align_transform)
+                if ensemble:
+                    class_outputs.append(torch.stack([output.softmax(dim=1) for output in class_outputs]).mean(dim=0))
+
+                n_classes = class_outputs[0].shape[1]
+                counts = torch.stack([torch.bincount(t_label * n_classes + output.argmax(dim=1),
+                                                     minlength=n_classes * n_classes) for output in class_outputs])
+                confusions = counts if confusions is None else confusions + counts
+        # the single transfer of the pass
+        return list(confusions.view(-1, n_classes, n_classes).cpu().numpy())
+
+    def confusion_matrix(self, my_net, domain):
+        return self.confusion_matrices([my_net], domain)[0]
+
+    def _confusion_matrices(self, my_nets, domain, ensemble=False):
+        while True:
+            try:
+                return self.confusion_matrices(my_nets, domain, ensemble)
+            except torch.cuda.OutOfMemoryError:
+                if not self.auto_batch_size or self.dataloader.batch_size == 1:
+                    raise
+                torch.cuda.empty_cache()
+                self.dataloader.batch_size = self.dataloader.batch_size // 2
+
+    def evaluate_metrics(self, torch_model, domain):
+        '''
+        :return: classification_metrics of the model on the split (accuracy, balanced_accuracy, kappa, confusion)
+        '''
+        my_net = load_model(torch_model, map_location=self.device).eval()
+        my_net = my_net.to(self.device)
+        return classification_metrics(self._confusion_matrices([my_net], domain)[0])
+
+    def evaluate(self, torch_model, domain):
+        return self.evaluate_metrics(torch_model, domain)["accuracy"]
+
+    def evaluate_many(self, torch_models, domain, model=None, ensemble=True):
+        '''
+        Score several models in one pass over the split.
+
+        :param torch_models: list of models, file names or state_dicts (see load_models)
+        :param model: the architecture of the state_dicts, if torch_models are state_dicts
+        :return: dict with "models", the classification_metrics of each model in order, and, if ensemble is True,
+                 "ensemble", the metrics of the averaged class probabilities
+        '''
+        my_nets = [my_net.eval().to(self.device) for my_net in load_models(torch_models, model, map_location=self.device)]
+        metrics = [classification_metrics(confusion)
+                   for confusion in self._confusion_matrices(my_nets, domain, ensemble and len(my_nets) > 1)]
+        result = {"models": metrics[:len(my_nets)]}
+        if ensemble:
+            result["ensemble"] = metrics[-1]
+        return result
+
+
+def test(test_list, torch_model, domain, start=0,num_channel=62, device=None, n_crops=1):
+    '''
+    One-off accuracy of torch_model on test_list; use an Evaluator for a split that is evaluated repeatedly.
+    '''
+    evaluator = Evaluator(test_list, num_channel=num_channel, start=start, device=device, n_crops=n_crops)
+    return evaluator.evaluate(torch_model, domain)
+
+
+def test_many(test_list, torch_models, domain, start=0, num_channel=62, device=None, n_crops=1, model=None,
+              align_transform=None, data_root=os.path.join(os.path.pardir, os.path.pardir, "EEGData"), mmap=False):
+    '''
+    One-off Evaluator.evaluate_many: all of torch_models (and their ensemble) on a single read of test_list.
+    '''
+    evaluator = Evaluator(test_list, num_channel=num_channel, start=start, device=device, n_crops=n_crops,
+                          align_transform=align_transform, data_root=data_root, mmap=mmap)
+    return evaluator.evaluate_many(torch_models, domain, model=model)
@@ -0,0 +1,363 @@
+import os
+import sys
+import copy
+import pickle
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from torch.optim import SGD
+from torch.utils.tensorboard import SummaryWriter
+
+from .data_loader_npy import open_eeg_dataset, make_eeg_loader, PairedDomainLoader
+from .trial_store import fold_store_lists
+from .sharded_dataset import fold_shard_lists
+from .storage_dtype import storage_lists
+from .projection_cache import project_lists
+from .test_MengData_new import Evaluator, load_models, test_many
+from .snapshot_evaluation import BestModelTracker, SnapshotEvaluator
+from .amp import MixedPrecision
+from .compilation import compile_model
+from .backend import resolve_device, configure_cpu, channels_last, available_cores
+from .my_tool import CustomLRScheduler, generate_normalized_tensor_eye
+from .recorder import append_results_to_csv
+from . import array_cache
+
+'''
+Training engine of the EEG_*_anybackbone.py methods.
+
+Trainer runs the cross validation of one method: per fold it builds the split lists, the model and its fixed
+channel matrices, the loaders and the evaluators, trains for n_epoch epochs, keeps the best source/target
+models and scores them on the test splits; at the end it writes the record/ files. What differs between the
+methods is in the Strategy it is given (see strategies.py), so a change to the data path, the step loop or
+the evaluation is made here once for all of them.
+
+The folds are independent (their own cross_<id> files, checkpoints and logs): with --parallel_folds N, run()
+trains N of them at a time, each in its own spawned process with its own Trainer and a 1/N share of the CPU
+cores (and, with several GPUs, its own GPU), and gathers their results in fold order.
+'''
+
+DOMAINS = ['source', 'target']
+# the messages of the training go to the my_utils loggers: stdout for a script (log_to_stdout), the log file of
+# the job when the job runner runs it in process (see job_runner.py)
+logger = logging.getLogger(__name__)
+# DataLoader worker processes of a training split (not used with --in_memory)
+NUM_WORKERS = 4
+
+
+def fold_lists(config, domain, cross_id):
+    '''
+    :return: [train, eval, test] [data_file, label_file] lists of fold cross_id under concatedData
+    '''
+    return [[os.path.join(config.get('settings', domain + '_path'), "concatedData", split,
+                          "cross_{0}_".format(cross_id) + config.get('settings', domain + '_' + name))
+             for name in ['datafile_name', 'labelfile_name']]
+            for split in ["train", "eval", "test"]]
+
+
+def log_to_stdout():
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+
+
+def train_fold_process(strategy, config, args, device, data_root, model_root, cross_id):
+    '''
+    Train one fold in a worker process of Trainer.run, strategy being the pickled Strategy.
+    '''
+    log_to_stdout()
+    trainer = Trainer(pickle.loads(strategy), config, args, device=device, data_root=data_root, model_root=model_root)
+    return trainer.train_fold(cross_id)
+
+
+def to_device(batch, device):
+    return tuple(t.to(device, non_blocking=True) if torch.is_tensor(t) else t for t in batch)
+
+
+class Trainer(object):
+    '''
+    :param strategy: the Strategy of the method
+    :param config: the ConfigParser of the hyperparameters file
+    :param args: the parsed arguments of EEG_train.py
+    '''
+    def __init__(self, strategy, config, args, device=None,
+                 data_root=os.path.join(os.path.pardir, os.path.pardir, "EEGData"), model_root='models'):
+        if args.projection_cache == '1' and not strategy.supports_projection_cache:
+            raise ValueError("{0} does not support --projection_cache".format(strategy.name))
+        if args.fused_forward == '1' and not strategy.paired:
+            raise ValueError("{0} trains on source batches only, --fused_forward is for the paired methods".format(strategy.name))
+        device = resolve_device(device)
+        if int(args.parallel_folds) > 1:
+            # the fold processes get the strategy as it was given, before the changes below
+            self.strategy_pickle = pickle.dumps(strategy)
+        if torch.device(device).type == 'cpu' or args.cpu_threads:
+            num_threads = configure_cpu(int(args.cpu_threads) if args.cpu_threads else None,
+                                        num_workers=0 if args.in_memory == '1' else NUM_WORKERS)
+            logger.info("{0} threads".format(num_threads))
+        self.strategy = strategy
+        strategy.amp = MixedPrecision(args.precision, device)
+        strategy.fused_forward = args.fused_forward == '1'
+        strategy.domain_bn = args.domain_bn == '1'
+        if args.compile == '1':
+            strategy.compile()
+        self.config = config
+        self.args = args
+        self.device = device
+        self.data_root = data_root
+        self.model_root = model_root
+        self.cache_prefix = args.cache_prefix
+        # the fold files are opened memory-mapped instead of read into the memory of the process; the splits of a
+        # trial store are always mapped, they then index the one shared store instead of copying their trials out
+        self.mmap = args.mmap == '1' or args.trial_store == '1'
+        self.n_epoch = config.getint('settings', 'n_epoch')
+
+    def num_channel(self, domain):
+        return self.config.getint('settings', domain + '_num_channel')
+
+    def split_lists(self, cross_id):
+        '''
+        :return: {domain: [train, eval, test]} data lists of the fold, in the format chosen by the arguments
+        '''
+        lists = {}
+        for domain in DOMAINS:
+            lists[domain] = fold_lists(self.config, domain, cross_id)
+            if self.args.trial_store == '1':
+                # every trial is stored once, the folds are index arrays into the store
+                lists[domain] = fold_store_lists(self.config.get('settings', domain + '_path'),
+                                                 self.config.get('settings', domain + '_datafile_name'), cross_id)
+            if self.args.sharded == '1':
+                # out-of-core: each split is a directory of npy shards read as a stream
+                lists[domain] = fold_shard_lists(self.config.get('settings', domain + '_path'),
+                                                 self.config.get('settings', domain + '_datafile_name'), cross_id)
+            if self.args.storage_dtype != 'float64':
+                # compact copies of the fold files, converted on first use; batches are upcast to float32
+                lists[domain] = storage_lists(self.data_root, lists[domain], self.args.storage_dtype)
+        return lists
+
+    def fixed_matrices(self):
+        '''
+        :return: the fixed source and target channel matrices of the alignment heads
+        '''
+        CAR_matrix = {}
+        for domain in DOMAINS:
+            CAR_matrix[domain] = torch.eye(self.num_channel(domain))
+            if self.strategy.common_average_reference:
+                CAR_matrix[domain] = CAR_matrix[domain] - torch.ones(
+                    [self.num_channel(domain), self.num_channel(domain)]) / self.num_channel(domain)
+        transfer_matrix_source = CAR_matrix['source'].to(self.device)
+        transfer_matrix_target = torch.matmul(
+            torch.tensor(array_cache.load(os.path.join('config', self.config.get('settings', 'file_name_transfer_matrix')))).to(
+                torch.float32), CAR_matrix['target']).to(self.device)
+        return transfer_matrix_source, transfer_matrix_target
+
+    def build_model(self):
+        transfer_matrix_source, transfer_matrix_target = self.fixed_matrices()
+        _right_idx_ = torch.tensor(array_cache.load(os.path.join("config", self.config.get('settings', 'right_idx')))-1).to(self.device)
+        _left_idx_ = torch.tensor(array_cache.load(os.path.join("config", self.config.get('settings', 'left_idx')))-1).to(self.device)
+        if self.args.prior_information == '1':
+            logger.info("prior_information used!")
+        else:
+            logger.info("no prior_information used!")
+            transfer_matrix_source = generate_normalized_tensor_eye(self.num_channel('source'), self.num_channel('source'))
+            transfer_matrix_target = generate_normalized_tensor_eye(self.num_channel('source'), self.num_channel('target'))
+        return self.strategy.build_model(transfer_matrix_source, transfer_matrix_target,
+                                         num_channels=self.num_channel('source'), FIR_order=17,
+                                         backbone_type=self.args.backbone_type or self.strategy.default_backbone,
+                                         right_idx=_right_idx_, left_idx=_left_idx_,
+                                         input_projected=self.args.projection_cache == '1')
+
+    def train_loader(self, domain, data_list):
+        dataset = open_eeg_dataset(
+            data_root=self.data_root,
+            data_list=data_list,
+            num_channel=self.num_channel(domain),
+            datalen=self.config.getint('settings', domain + '_datalen'),
+            random_crop=None if self.args.random_crop == 'none' else self.args.random_crop,
+            batch_dtype=None if self.args.storage_dtype == 'float64' else 'float32',
+            mmap=self.mmap
+        )
+        dataloader = make_eeg_loader(
+            dataset=dataset,
+            batch_size=self.config.getint('settings', 'batch_size'),
+            shuffle=True,
+            drop_last=self.args.drop_last == '1',
+            num_workers=NUM_WORKERS,
+            in_memory=self.args.in_memory == '1',
+            device=self.device)
+        return dataset, dataloader
+
+    def train_fold(self, cross_id):
+        '''
+        :return: the best [source, target] validation accuracies and the [source, target] test accuracies
+        '''
+        logger.info("Cross validation {0}-fold".format(cross_id))
+        strategy = self.strategy
+        writer = SummaryWriter(os.path.join('logs', self.cache_prefix + '_Cross_{0}'.format(cross_id)))
+        lists = self.split_lists(cross_id)
+        for domain in DOMAINS:
+            logger.info(domain.capitalize() + " dataset")
+            for data_list in lists[domain]:
+                logger.info(str(data_list))
+
+        # load model
+        my_net = self.build_model()
+        if self.args.projection_cache == '1':
+            # project the fold files once with the fixed matrices, the alignment heads then skip that matmul
+            for domain in DOMAINS:
+                lists[domain] = project_lists(self.data_root, lists[domain],
+                                              getattr(my_net, 'alignment_head_' + domain).channel_transfer_matrix_fixed)
+        my_net = my_net.to(self.device)
+        if self.args.channels_last == '1':
+            channels_last(my_net)
+        if self.args.compile == '1':
+            # the training steps and the validation passes run the compiled submodules
+            compile_model(my_net)
+
+        source_train_dataset, source_train_dataloader = self.train_loader('source', lists['source'][0])
+        target_train_dataset, target_train_dataloader = None, None
+        if strategy.uses_target_train:
+            target_train_dataset, target_train_dataloader = self.train_loader('target', lists['target'][0])
+        strategy.prepare(source_train_dataset, target_train_dataset)
+
+        # the validation splits are loaded once per fold and evaluated every epoch
+        source_evaluator, target_evaluator = [
+            Evaluator(lists[domain][1], num_channel=self.num_channel(domain), n_crops=int(self.args.eval_crops),
+                      device=self.device, align_transform=strategy.align_transform(domain_id), data_root=self.data_root,
+                      mmap=self.mmap)
+            for domain_id, domain in enumerate(DOMAINS)]
+
+        if strategy.paired:
+            # equal-sized (source, target) batch pairs, prefetched onto the device on a background thread
+            train_loader = PairedDomainLoader(source_train_dataloader, target_train_dataloader,
+                                              cycle=self.args.cycle_shorter == '1', device=self.device)
+            len_dataloader = len(train_loader)
+        else:
+            train_loader = source_train_dataloader
+            len_dataloader = strategy.steps_per_epoch(source_train_dataloader, target_train_dataloader)
+
+        # setup optimizer
+        total_steps = self.n_epoch * len_dataloader
+        optimizer = SGD(my_net.parameters(), lr=self.config.getfloat('optimizer', 'lr'),
+                        momentum=self.config.getfloat('optimizer', 'momentum'))
+        scheduler = CustomLRScheduler(optimizer, mu=self.config.getfloat('optimizer', 'mu'),
+                                      alpha=self.config.getfloat('optimizer', 'alpha'),
+                                      beta=self.config.getfloat('optimizer', 'beta'), total_steps=total_steps)
+        strategy.amp.bind(optimizer)
+
+        # training
+        best_model_tracker = BestModelTracker(self.model_root, self.cache_prefix, cross_id, writer)
+        if self.args.async_eval == '1':
+            snapshot_evaluator = SnapshotEvaluator(source_evaluator, target_evaluator, best_model_tracker)
+
+        for epoch in range(self.n_epoch):
+            my_net.train()
+            for i, batch in enumerate(train_loader):
+                if i == len_dataloader:
+                    break
+                if strategy.paired:
+                    data_source, data_target = batch
+                else:
+                    data_source, data_target = to_device(batch, self.device), None
+                my_net.zero_grad()
+
+                # p stands for progression, ranging from 0 to 1.
+                p = float(i + epoch * len_dataloader) / self.n_epoch / len_dataloader
+                losses = strategy.step(my_net, data_source, data_target, p)
+
+                # update weights
+                strategy.amp.step(optimizer)
+                scheduler.step(epoch * len_dataloader + i)
+                if self.config.getint('debug', 'isdebug'):
+                    logger.info('epoch: %d, [iter: %d / all %d], ' % (epoch, i + 1, len_dataloader) +
+                                ', '.join('%s: %f' % (name, loss.item()) for name, loss in losses.items()))
+
+                with torch.no_grad():
+                    for name, loss in losses.items():
+                        writer.add_scalar(name, loss, epoch * len_dataloader + i)
+
+            if self.args.async_eval == '1':
+                # evaluated on a copy of the weights while the next epoch trains
+                snapshot_evaluator.submit(my_net, epoch)
+            else:
+                best_model_tracker.update(epoch, source_evaluator.evaluate(my_net, domain=0),
+                                          target_evaluator.evaluate(my_net, domain=1), my_net)
+
+        if self.args.async_eval == '1':
+            # the best models are only final once the last snapshots are evaluated
+            snapshot_evaluator.close()
+        logger.info('============ Summary =============')
+        # the best source and target models are loaded once and scored, with their ensemble, in one pass per test split
+        best_models = load_models([self.cache_prefix + '_cross_id_{0}_best_{1}_model.pth'.format(cross_id, name)
+                                   for name in DOMAINS], model_root=self.model_root,
+                                  map_location=self.device)
+        test_acc = []
+        for domain_id, domain in enumerate(DOMAINS):
+            test_metrics = test_many(test_list=lists[domain][2], torch_models=best_models, domain=domain_id,
+                                     num_channel=self.num_channel(domain), device=self.device,
+                                     n_crops=int(self.args.eval_crops),
+                                     align_transform=strategy.align_transform(domain_id), data_root=self.data_root,
+                                     mmap=self.mmap)
+            test_acc.append(test_metrics["models"][domain_id]["accuracy"])
+            logger.info('Accuracy of the %s test set: %f' % (domain.capitalize(), test_acc[-1]))
+            logger.info('Accuracy of the other best model and of the ensemble on the %s test set: %f, %f' % (
+                domain.capitalize(), test_metrics["models"][1 - domain_id]["accuracy"], test_metrics["ensemble"]["accuracy"]))
+
+        writer.close()
+        best_acc = [best_model_tracker.best_acc["Source"], best_model_tracker.best_acc["Target"]]
+        best_index = [best_model_tracker.best_index["Source"], best_model_tracker.best_index["Target"]]
+        logger.info('Accuracy of the Exp12(Source) validation set: {0} at {1}'.format(best_acc[0], best_index[0]))
+        logger.info('Accuracy of the Exp3(Target) validation set: {0} at {1}'.format(best_acc[1], best_index[1]))
+        return best_acc, test_acc
+
+    def fold_devices(self, n_processes):
+        '''
+        :return: the device of each fold process: the visible GPUs in turn if the device is 'cuda' without an index
+        '''
+        device = torch.device(self.device)
+        if device.type == 'cuda' and device.index is None and torch.cuda.device_count() > 1:
+            return ['cuda:{0}'.format(k % torch.cuda.device_count()) for k in range(n_processes)]
+        return [self.device] * n_processes
+
+    def train_folds_parallel(self, NFold, n_processes):
+        '''
+        :return: the train_fold results of the NFold folds, trained n_processes at a time
+        '''
+        args = copy.copy(self.args)
+        args.parallel_folds = '1'
+        # each process gets its share of the cores, its DataLoader workers included
+        args.cpu_threads = self.args.cpu_threads or str(max(
+            1, available_cores() // n_processes - (0 if self.args.in_memory == '1' else NUM_WORKERS)))
+        devices = self.fold_devices(n_processes)
+        logger.info("{0} folds in {1} processes with {2} threads each".format(NFold, n_processes, args.cpu_threads))
+        # spawn: a forked process cannot use CUDA once the parent did
+        with ProcessPoolExecutor(n_processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(train_fold_process, self.strategy_pickle, self.config, args,
+                                       devices[cross_id % n_processes], self.data_root, self.model_root, cross_id)
+                       for cross_id in range(NFold)]
+            return [future.result() for future in futures]
+
+    def run(self):
+        '''
+        Train all folds and write record/<cache_prefix>_{val,test}_metric.npy and the strategy's csv.
+
+        :return: record_val_metric, record_test_metric, (2, NFold) source/target accuracies
+        '''
+        NFold = self.config.getint('settings', 'NFold')
+        record_val_metric = np.zeros([2, NFold])
+        record_test_metric = np.zeros([2, NFold])
+        logger.info(self.cache_prefix)
+        n_processes = min(int(self.args.parallel_folds), NFold)
+        if n_processes > 1:
+            fold_results = self.train_folds_parallel(NFold, n_processes)
+        else:
+            fold_results = [self.train_fold(cross_id) for cross_id in range(NFold)]
+        for cross_id, (best_acc, test_acc) in enumerate(fold_results):
+            record_val_metric[:, cross_id], record_test_metric[:, cross_id] = best_acc, test_acc
+
+        np.save(os.path.join("record", self.cache_prefix + "_val_metric.npy"), record_val_metric)
+        np.save(os.path.join("record", self.cache_prefix + "_test_metric.npy"), record_test_metric)
+        logger.info("============Final Summary==================================")
+        for name, record in [("record_val_metric", record_val_metric), ("record_test_metric", record_test_metric)]:
+            logger.info("{0}\n{1}\n{2}".format(name, record, np.mean(record, axis=1)))
+        append_results_to_csv(self.cache_prefix, record_val_metric, record_test_metric,
+                              file_path=os.path.join("record", self.strategy.record_file))
+        return record_val_metric, record_test_metric
@@ -0,0 +1,124 @@
+import os
+import json
+import hashlib
+import numpy as np
+from . import array_cache
+
+'''
+Deduplicated trial store.
+
+The concatedData layout keeps cross_<id>_data_*.npy for train/eval/test in every fold, so each trial of a dataset
+is written (and read) once per fold. A store keeps every trial once and describes the folds with index arrays:
+
+    <dataset_path>/packedData/<datafile stem>/data.npy     all distinct trials, (N, C, T)
+    <dataset_path>/packedData/<datafile stem>/label.npy    their labels, (N,)
+    <dataset_path>/packedData/<datafile stem>/folds.npz    cross_<id>_<split> -> trial indices into data.npy
+    <dataset_path>/packedData/<datafile stem>/meta.json    source files, fold count and sizes
+'''
+
+SPLITS = ('train', 'eval', 'test')
+
+
+class StoreSplit(object):
+    '''
+    Stands in for a [data_file, label_file] data_list: EEGDataSet(data_root, StoreSplit(...)) reads one split
+    of one fold out of a trial store located at os.path.join(data_root, store).
+    '''
+    def __init__(self, store, fold, split):
+        if split not in SPLITS:
+            raise ValueError("split must be one of {0}".format(SPLITS))
+        self.store = store
+        self.fold = fold
+        self.split = split
+
+    def __repr__(self):
+        return "StoreSplit({0}, cross_{1}, {2})".format(self.store, self.fold, self.split)
+
+
+def store_root(dataset_path, datafile_name):
+    return os.path.join(dataset_path, "packedData", os.path.splitext(datafile_name)[0])
+
+
+def fold_store_lists(dataset_path, datafile_name, cross_id):
+    '''
+    :return: [train, eval, test] StoreSplit of fold cross_id, ready to replace the *_train/eval/test_list.
+    '''
+    root = store_root(dataset_path, datafile_name)
+    return [StoreSplit(root, cross_id, split) for split in SPLITS]
+
+
+def open_store_split(data_root, store_split, mmap_mode=None):
+    '''
+    :return: eeg_data, eeg_labels of the whole store and the index array of the requested split.
+    '''
+    root = os.path.join(data_root, store_split.store)
+    eeg_data = array_cache.load(os.path.join(root, "data.npy"), mmap_mode=mmap_mode)
+    eeg_labels = array_cache.load(os.path.join(root, "label.npy"), mmap_mode=mmap_mode)
+    with np.load(os.path.join(root, "folds.npz")) as folds:
+        index = folds["cross_{0}_{1}".format(store_split.fold, store_split.split)]
+    return eeg_data, eeg_labels, index
+
+
+def pack_concated_data(data_root, dataset_path, datafile_name, labelfile_name, n_fold):
+    '''
+    Convert the concatedData/{train,eval,test}/cross_<id>_* files of a dataset into a trial store.
+    Trials are identified by their bytes, so a trial appearing in several folds is stored only once.
+
+    :return: path of the written store
+    '''
+    trial_ids = {}
+    trials = []
+    labels = []
+    folds = {}
+    for cross_id in range(n_fold):
+        for split in SPLITS:
+            split_dir = os.path.join(data_root, dataset_path, "concatedData", split)
+            eeg_data = np.load(os.path.join(split_dir, "cross_{0}_".format(cross_id) + datafile_name), mmap_mode='r')
+            eeg_labels = np.load(os.path.join(split_dir, "cross_{0}_".format(cross_id) + labelfile_name))
+            index = np.empty(eeg_labels.shape[0], dtype=np.int64)
+            for i in range(eeg_labels.shape[0]):
+                trial = np.ascontiguousarray(eeg_data[i])
+                key = hashlib.blake2b(trial.tobytes(), digest_size=16).digest()
+                if key not in trial_ids:
+                    trial_ids[key] = len(trials)
+                    trials.append(trial)
+                    labels.append(eeg_labels[i])
+                elif labels[trial_ids[key]] != eeg_labels[i]:
+                    raise ValueError("trial {0} of cross_{1} {2} has conflicting labels".format(i, cross_id, split))
+                index[i] = trial_ids[key]
+            folds["cross_{0}_{1}".format(cross_id, split)] = index
+
+    root = os.path.join(data_root, store_root(dataset_path, datafile_name))
+    os.makedirs(root, exist_ok=True)
+    np.save(os.path.join(root, "data.npy"), np.stack(trials))
+    np.save(os.path.join(root, "label.npy"), np.asarray(labels))
+    np.savez(os.path.join(root, "folds.npz"), **folds)
+    with open(os.path.join(root, "meta.json"), "w") as f:
+        json.dump({"datafile_name": datafile_name,
+                   "labelfile_name": labelfile_name,
+                   "n_fold": n_fold,
+                   "n_trials": len(trials),
+                   "n_indexed": int(sum(index.shape[0] for index in folds.values()))}, f, indent=2)
+    return root
+
+
+if __name__ == "__main__":
+    import configparser
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Pack the concatedData folds of a task into deduplicated trial stores.')
+    parser.add_argument('--config', default='config_PhysioNetMIToMengExp3.ini', help='Path to the config.ini file')
+    parser.add_argument('--data_root', default=os.path.join(os.path.pardir, os.path.pardir, "EEGData"), help='root of the datasets')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join("hyperparameters", args.config))
+    for domain in ['source', 'target']:
+        store = pack_concated_data(args.data_root,
+                                   config.get('settings', domain + '_path'),
+                                   config.get('settings', domain + '_datafile_name'),
+                                   config.get('settings', domain + '_labelfile_name'),
+                                   config.getint('settings', 'NFold'))
+        with open(os.path.join(store, "meta.json")) as f:
+            meta = json.load(f)
+        print("{0}: {1} distinct trials for {2} indexed trials -> {3}".format(domain, meta["n_trials"], meta["n_indexed"], store))